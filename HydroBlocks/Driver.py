@@ -3,6 +3,7 @@ from dateutil.relativedelta import relativedelta
 import HydroBlocks# as HB
 import sys
 import pickle
+import numpy as np
 
 def Read_Metadata_File(file):
 
@@ -11,33 +12,357 @@ def Read_Metadata_File(file):
 
  return metadata
 
-#Read in the metadata file
-metadata_file = sys.argv[1]
-metadata = Read_Metadata_File(metadata_file)
-info = metadata
-
-#Define idate and fdate
-idate = datetime.datetime(metadata['startdate']['year'],metadata['startdate']['month'],metadata['startdate']['day'],0)
-fdate = datetime.datetime(metadata['enddate']['year'],metadata['enddate']['month'],metadata['enddate']['day'],0) + datetime.timedelta(days=1)
-
-#Run the segments for the model
-sidate = idate
-sfdate = idate
-while sidate < fdate:
- sfdate = sidate + relativedelta(years=metadata['segment']['years_per_segment'])
- if sfdate > fdate: sfdate = fdate
- #Set the parameters
- info['idate'] = sidate
- info['fdate'] = sfdate
- #Run the model
- #Initialize
- HB = HydroBlocks.initialize(info)
- #Run the model
- HB.run(info)
- #Finalize
- HB.finalize()
- #Update initial time step
- sidate = sfdate
+def Run_Segments(metadata,resume=False):
 
+ info = metadata
 
+ #Define idate and fdate
+ idate = datetime.datetime(metadata['startdate']['year'],metadata['startdate']['month'],metadata['startdate']['day'],0)
+ fdate = datetime.datetime(metadata['enddate']['year'],metadata['enddate']['month'],metadata['enddate']['day'],0) + datetime.timedelta(days=1)
 
+ #Keep the model in memory between segments (only the output file is rotated)? Opt-in:
+ #by default every segment starts a new model from the restart file of the previous one
+ persistent = metadata['segment'].get('persistent',False)
+ #Write a restart file at the end of every segment?
+ restart = metadata['segment'].get('restart',True)
+
+ #Continue from the latest checkpoint (if any)
+ checkpoint = None
+ if resume:
+  from pyIO.restart import Latest_Checkpoint
+  checkpoint_dir = metadata.get('checkpoint',{}).get('dir','%s/checkpoints' % metadata['restart']['dir'])
+  checkpoint = Latest_Checkpoint(checkpoint_dir)
+  if checkpoint is None: print("No checkpoint found in %s" % checkpoint_dir)
+  else: checkpoint = (checkpoint[0],datetime.datetime.strptime(checkpoint[1]['date'],'%Y-%m-%d %H:%M:%S'))
+
+ #Run the segments for the model
+ HB = None
+ sidate = idate
+ sfdate = idate
+ while sidate < fdate:
+  sfdate = sidate + relativedelta(years=metadata['segment']['years_per_segment'])
+  if sfdate > fdate: sfdate = fdate
+  #Skip the segments that were completed before the checkpoint
+  if (checkpoint is not None) and (sfdate <= checkpoint[1]):
+   sidate = sfdate
+   continue
+  #Set the parameters
+  info['idate'] = sidate
+  info['fdate'] = sfdate
+  #Initialize (or move the model to the new segment)
+  if HB is None: HB = HydroBlocks.initialize(info)
+  else: HB.rollover(info,restart)
+  #Restore the state of the checkpoint
+  if checkpoint is not None:
+   HB.resume(checkpoint[0])
+   checkpoint = None
+  #Run the model
+  HB.run(info)
+  #Finalize
+  if (persistent == False) or (sfdate == fdate):
+   HB.finalize()
+   HB = None
+  #Update initial time step
+  sidate = sfdate
+
+ return
+
+def Catchment_Cost(metadata):
+
+ #Relative cost of a catchment (number of hrus x number of time steps)
+ import netCDF4 as nc
+ fp = nc.Dataset(metadata['input_file'])
+ nhru = len(fp.dimensions['hsu'])
+ fp.close()
+ idate = datetime.datetime(metadata['startdate']['year'],metadata['startdate']['month'],metadata['startdate']['day'],0)
+ fdate = datetime.datetime(metadata['enddate']['year'],metadata['enddate']['month'],metadata['enddate']['day'],0) + datetime.timedelta(days=1)
+ nsteps = int((fdate - idate).total_seconds()/metadata['dt'])
+
+ return (nhru,nsteps)
+
+def Run_Catchment(task):
+
+ #Run a single catchment (called in a fresh worker process since the Noah-MP
+ #state lives in the module globals of the Fortran library)
+ import os
+ import time
+ import traceback
+ result = {'metadata_file':task['metadata_file'],'nhru':task['nhru'],'nsteps':task['nsteps'],
+           'ncores':task['ncores'],'pid':os.getpid()}
+
+ #Size the threads of the worker before the libraries are loaded
+ for var in ['OMP_NUM_THREADS','MKL_NUM_THREADS']: os.environ[var] = str(task['ncores'])
+
+ #Send the output of the catchment (including the Fortran output) to its log file
+ log = open(task['log'],'w')
+ sys.stdout.flush()
+ sys.stderr.flush()
+ os.dup2(log.fileno(),1)
+ os.dup2(log.fileno(),2)
+
+ tic = time.time()
+ try:
+  metadata = Read_Metadata_File(task['metadata_file'])
+  metadata['ncores'] = task['ncores']
+  Run_Segments(metadata,task['resume'])
+  result['status'] = 'ok'
+ except BaseException as error:
+  #exit('Error: ...') raises SystemExit
+  traceback.print_exc()
+  result['status'] = 'failed'
+  result['error'] = str(error)
+ result['wall_time'] = time.time() - tic
+ sys.stdout.flush()
+ sys.stderr.flush()
+ log.close()
+
+ return result
+
+def Catchment_Process(task,connection):
+
+ #Entry point of the process of a catchment (sends back its result)
+ connection.send(Run_Catchment(task))
+ connection.close()
+
+ return
+
+def Start_Catchment(task,context):
+
+ #Run the catchment in a new process; the result comes back through a pipe
+ import time
+ (reader,writer) = context.Pipe(duplex=False)
+ process = context.Process(target=Catchment_Process,args=(task,writer))
+ process.start()
+ writer.close()
+
+ return {'task':task,'process':process,'reader':reader,'tic':time.time()}
+
+def Finish_Catchment(worker):
+
+ #Result of the catchment process. A process that dies without sending it (killed,
+ #out of memory, segmentation fault in the Fortran) is recorded as a failed catchment.
+ import time
+ try:
+  result = worker['reader'].recv()
+ except EOFError:
+  result = None
+ worker['reader'].close()
+ worker['process'].join()
+ if result is None:
+  task = worker['task']
+  result = {'metadata_file':task['metadata_file'],'nhru':task['nhru'],'nsteps':task['nsteps'],
+            'ncores':task['ncores'],'pid':worker['process'].pid,'status':'failed',
+            'error':'The worker process died (exit code %s)' % worker['process'].exitcode,
+            'wall_time':time.time() - worker['tic']}
+
+ return result
+
+def Estimate_Costs(tasks,timings_file=None):
+
+ #Cost model of the catchments. With the timings of a previous run (its summary
+ #file) the cost is the time per hru per time step of the catchment (or the
+ #median of all the catchments if it was not run) x nhru x number of time steps;
+ #otherwise it is nhru x number of time steps.
+ import os
+ import json
+ rates = {}
+ if (timings_file is not None) and os.path.exists(timings_file):
+  for result in json.load(open(timings_file))['catchments']:
+   if (result['status'] != 'ok') or (result['nhru']*result['nsteps'] == 0): continue
+   rates[result['metadata_file']] = result['wall_time']/(result['nhru']*result['nsteps'])
+ if len(rates) > 0: default_rate = float(np.median(list(rates.values())))
+ else: default_rate = 1.0
+ for task in tasks:
+  rate = rates.get(task['metadata_file'],default_rate)
+  task['cost'] = rate*task['nhru']*task['nsteps']
+
+ return
+
+def Catchment_Tasks(metadata_files,ncores,resume,log_dir,timings_file=None):
+
+ #Set up the catchment tasks ordered largest first by the cost model
+ import os
+ tasks = []
+ results = []
+ for metadata_file in metadata_files:
+  try:
+   (nhru,nsteps) = Catchment_Cost(Read_Metadata_File(metadata_file))
+  except Exception as error:
+   #The catchment can't be set up; report it without running it
+   results.append({'metadata_file':metadata_file,'nhru':0,'nsteps':0,'ncores':0,
+                   'status':'failed','error':str(error),'wall_time':0.0})
+   print('%-40s failed: %s' % (os.path.basename(metadata_file),error))
+   continue
+  name = os.path.splitext(os.path.basename(metadata_file))[0]
+  tasks.append({'metadata_file':metadata_file,'nhru':nhru,'nsteps':nsteps,'ncores':ncores,
+                'resume':resume,'log':'%s/%s.log' % (log_dir,name)})
+ Estimate_Costs(tasks,timings_file)
+ tasks = sorted(tasks,key=lambda task: task['cost'],reverse=True)
+
+ return (tasks,results)
+
+def Print_Result(result):
+
+ import os
+ print('%-40s %6s nhru:%8d nsteps:%8d time:%10.2f s' % (os.path.basename(result['metadata_file']),
+       result['status'],result['nhru'],result['nsteps'],result['wall_time']))
+ sys.stdout.flush()
+
+ return
+
+def Write_Summary(summary_file,results,wall_time,**kwargs):
+
+ #Write the status/timing summary (it also feeds the cost model of the next run)
+ import json
+ summary = {'wall_time':wall_time,
+            'failed':len([result for result in results if result['status'] != 'ok']),
+            'catchments':results}
+ summary.update(kwargs)
+ json.dump(summary,open(summary_file,'w'),indent=1)
+ print('Finished %d catchments in %.2f s (%d failed); summary in %s' % (len(results),wall_time,summary['failed'],summary_file))
+
+ return summary
+
+def Run_Catchments(metadata_files,nworkers=1,ncores=None,resume=False,summary_file=None,log_dir=None,timings_file=None):
+
+ #Run a list of catchments (one metadata file each) across a pool of processes
+ import os
+ import time
+ import multiprocessing
+ import multiprocessing.connection
+
+ #Size the threads per worker against the width of the pool
+ if ncores is None: ncores = multiprocessing.cpu_count()
+ nworkers = max(min(nworkers,len(metadata_files)),1)
+ ncores_worker = max(ncores//nworkers,1)
+ if summary_file is None: summary_file = 'catchments_summary.json'
+ if timings_file is None: timings_file = summary_file
+ if log_dir is None: log_dir = os.path.dirname(os.path.abspath(summary_file))
+ os.system('mkdir -p %s' % log_dir)
+
+ #Order the work largest first
+ (tasks,results) = Catchment_Tasks(metadata_files,ncores_worker,resume,log_dir,timings_file)
+ print('Running %d catchments on %d workers (%d cores each)' % (len(tasks),nworkers,ncores_worker))
+
+ #Run the catchments (a new process per catchment, up to nworkers at a time)
+ tic = time.time()
+ context = multiprocessing.get_context('spawn')
+ workers = []
+ while (len(tasks) > 0) or (len(workers) > 0):
+  while (len(tasks) > 0) and (len(workers) < nworkers): workers.append(Start_Catchment(tasks.pop(0),context))
+  #Wait for a result (or for a worker to die)
+  ready = multiprocessing.connection.wait([worker['reader'] for worker in workers])
+  for worker in [worker for worker in workers if worker['reader'] in ready]:
+   workers.remove(worker)
+   result = Finish_Catchment(worker)
+   results.append(result)
+   Print_Result(result)
+ wall_time = time.time() - tic
+
+ return Write_Summary(summary_file,results,wall_time,nworkers=nworkers,ncores_worker=ncores_worker)
+
+def Run_Catchments_MPI(metadata_files,ncores=1,resume=False,summary_file=None,log_dir=None,timings_file=None):
+
+ #Run a list of catchments across MPI ranks. Rank 0 hands out the catchments
+ #(largest predicted cost first) to the other ranks as they become free; each
+ #rank runs its catchments one at a time with ncores threads.
+ import os
+ import time
+ import multiprocessing
+ from mpi4py import MPI
+ comm = MPI.COMM_WORLD
+ rank = comm.Get_rank()
+ size = comm.Get_size()
+ if size < 2: exit('Error: The MPI scheduler needs at least 2 ranks (1 scheduler and 1 or more workers)')
+ if summary_file is None: summary_file = 'catchments_summary.json'
+ if timings_file is None: timings_file = summary_file
+ if log_dir is None: log_dir = os.path.dirname(os.path.abspath(summary_file))
+
+ if rank == 0:
+
+  os.system('mkdir -p %s' % log_dir)
+  (tasks,results) = Catchment_Tasks(metadata_files,ncores,resume,log_dir,timings_file)
+  print('Running %d catchments on %d ranks (%d cores each)' % (len(tasks),size-1,ncores))
+  sys.stdout.flush()
+
+  #Dynamic work queue (a rank asks for work by sending the result of its last catchment)
+  tic = time.time()
+  busy_time = np.zeros(size)
+  predicted = np.zeros(size)
+  status = MPI.Status()
+  nactive = size - 1
+  while nactive > 0:
+   #Poll so that the scheduler does not hold on to a core
+   while comm.Iprobe(source=MPI.ANY_SOURCE,tag=0) == False: time.sleep(0.01)
+   result = comm.recv(source=MPI.ANY_SOURCE,tag=0,status=status)
+   source = status.Get_source()
+   if result is not None:
+    results.append(result)
+    busy_time[source] += result['wall_time']
+    Print_Result(result)
+   if len(tasks) > 0:
+    task = tasks.pop(0)
+    predicted[source] += task['cost']
+    comm.send(task,dest=source,tag=1)
+   else:
+    comm.send(None,dest=source,tag=1)
+    nactive -= 1
+  wall_time = time.time() - tic
+
+  #Load imbalance across the worker ranks (max/mean busy time - 1)
+  busy_time = busy_time[1:]
+  mean = np.mean(busy_time)
+  imbalance = float(np.max(busy_time)/mean - 1) if mean > 0 else 0.0
+  efficiency = float(np.sum(busy_time)/(len(busy_time)*wall_time)) if wall_time > 0 else 0.0
+  print('Rank busy time (s): min %.2f mean %.2f max %.2f' % (np.min(busy_time),mean,np.max(busy_time)))
+  print('Load imbalance: %.1f %% (parallel efficiency %.1f %%)' % (100*imbalance,100*efficiency))
+  ranks = [{'rank':r+1,'busy_time':float(busy_time[r]),'predicted_cost':float(predicted[r+1])}
+           for r in range(len(busy_time))]
+  summary = Write_Summary(summary_file,results,wall_time,nranks=size,ncores_worker=ncores,
+                          load_imbalance=imbalance,parallel_efficiency=efficiency,ranks=ranks)
+
+ else:
+
+  #Each catchment runs in a fresh process (the Noah-MP state is global to the process;
+  #a process that dies is reported as a failed catchment)
+  context = multiprocessing.get_context('spawn')
+  result = None
+  while True:
+   comm.send(result,dest=0,tag=0)
+   task = comm.recv(source=0,tag=1)
+   if task is None: break
+   result = Finish_Catchment(Start_Catchment(task,context))
+   result['rank'] = rank
+  summary = None
+
+ comm.Barrier()
+
+ return summary
+
+if __name__ == '__main__':
+
+ import argparse
+ parser = argparse.ArgumentParser(description='Run HydroBlocks')
+ parser.add_argument('metadata_files',nargs='+')
+ parser.add_argument('--resume',action='store_true') #continue from the latest checkpoint
+ parser.add_argument('--workers',type=int,default=None) #run the catchments on a process pool
+ parser.add_argument('--cores',type=int,default=None) #cores shared by the workers
+ parser.add_argument('--summary',default=None)
+ parser.add_argument('--logs',default=None)
+ parser.add_argument('--timings',default=None) #summary of a previous run (default: --summary if it exists)
+ parser.add_argument('--mpi',action='store_true') #distribute the catchments across MPI ranks
+ args = parser.parse_args()
+
+ if args.mpi:
+  #Run the catchments (--cores is the number of cores of each rank)
+  ncores = args.cores if args.cores is not None else 1
+  Run_Catchments_MPI(args.metadata_files,ncores,args.resume,args.summary,args.logs,args.timings)
+ elif (len(args.metadata_files) == 1) and (args.workers is None):
+  #Read in the metadata file
+  metadata = Read_Metadata_File(args.metadata_files[0])
+  #Run the model
+  Run_Segments(metadata,args.resume)
+ else:
+  #Run the catchments
+  nworkers = args.workers if args.workers is not None else 1
+  Run_Catchments(args.metadata_files,nworkers,args.cores,args.resume,args.summary,args.logs,args.timings)
@@ -7,6 +7,7 @@ import time
 import sys
 import scipy.sparse as sparse
 import pickle
+import tempfile
 
 #def assign_string(nelem,pstring):
 def assign_string(dtype,pstring):
@@ -41,6 +42,9 @@ class HydroBlocks:
   print("Initializing Noah-MP")
   self.initialize_noahmp()
 
+  #Initialize the static weights of the soil moisture diagnostics
+  self.initialize_output_diagnostics()
+
   #Initialize subsurface module
   print("Initializing subsurface module")
   self.initialize_subsurface()
@@ -49,6 +53,9 @@ class HydroBlocks:
   #print("Initializing Human Water Management")
   self.initialize_hwu(info)
 
+  #Initialize the forcing readers
+  self.initialize_forcing()
+
   #Other metrics
   self.dE = 0.0
   self.r = 0.0
@@ -65,62 +72,145 @@ class HydroBlocks:
   self.beg_wb = np.zeros(self.nhru,dtype=np.float32)
   self.end_wb = np.zeros(self.nhru,dtype=np.float32)
   self.itime = 0
+  #Work arrays of the time step (see scratch)
+  self.scratch_arrays = {}
 
   #Restart from initial conditions?
   self.restart()
 
+  #Spin up the model state when there is no restart
+  if self.cold_start and info.get('spinup',{}).get('enabled',False): self.spinup(info)
+
   return
   
+ def spinup(self,info):
+
+  #Cycle the forcing of the spin-up window until the soil moisture, the water table
+  #depth and the soil water deficit change by less than the tolerances between two
+  #cycles. The spun-up state is cached (keyed by a hash of the input file and the
+  #configuration) so that later runs of the same configuration start from it.
+  from pyIO.restart import Read_Restart,Restart_Writer
+  spinup = info['spinup']
+  tolerance = {'smc':0.001,'zwt':0.01,'si':0.001} #m3/m3, m, m
+  tolerance.update(spinup.get('tolerance',{}))
+  max_cycles = spinup.get('max_cycles',20)
+  sidate = self.idate
+  sfdate = self.fdate
+  if 'startdate' in spinup:
+   sidate = datetime.datetime(spinup['startdate']['year'],spinup['startdate']['month'],spinup['startdate']['day'],0)
+  if 'enddate' in spinup:
+   sfdate = datetime.datetime(spinup['enddate']['year'],spinup['enddate']['month'],spinup['enddate']['day'],0) + datetime.timedelta(days=1)
+  cache_dir = spinup.get('cache_dir','%s/spinup' % info['restart']['dir'])
+  file = '%s/%s.h5' % (cache_dir,self.spinup_key(info,sidate,sfdate,tolerance,max_cycles))
+
+  if os.path.exists(file):
+
+   print("Spin-up state from the cache %s" % file)
+   (state,attributes) = Read_Restart(file,attributes=True)
+   self.restore_state(state,attributes['scalars'])
+
+  else:
+
+   #Move to the spin-up window (no output or checkpoints)
+   print("Spinning up over %s to %s" % (sidate.strftime('%Y-%m-%d'),sfdate.strftime('%Y-%m-%d')))
+   checkpoint_interval = self.checkpoint_interval
+   self.checkpoint_interval = None
+   self.output_enabled = False
+   self.meteorology.close()
+   self.water_use.close()
+   self.segment_information(dict(info,idate=sidate,fdate=sfdate))
+   self.initialize_forcing()
+
+   #Cycle the window until convergence
+   converged = False
+   for cycle in range(max_cycles):
+    previous = self.spinup_variables()
+    self.itime = 0
+    self.run(info)
+    current = self.spinup_variables()
+    change = {}
+    for var in current: change[var] = float(np.max(np.abs(current[var] - previous[var])))
+    print('Spin-up cycle %d: %s' % (cycle+1,' '.join(['%s:%.6f' % (var,change[var]) for var in change])))
+    if all([change[var] <= tolerance[var] for var in change]):
+     converged = True
+     break
+
+   #Cache the converged state
+   if converged:
+    os.system('mkdir -p %s' % cache_dir)
+    (state,scalars) = self.checkpoint_state()
+    Restart_Writer(None,False).save(file,state,{'scalars':scalars,'cycles':cycle+1,
+                                   'idate':sidate.strftime('%Y-%m-%d'),'fdate':sfdate.strftime('%Y-%m-%d')})
+   else:
+    print("Warning: The spin-up did not converge after %d cycles" % max_cycles)
+
+   #Back to the segment
+   self.meteorology.close()
+   self.water_use.close()
+   self.segment_information(info)
+   self.initialize_forcing()
+   self.itime = 0
+   self.output_enabled = True
+   self.checkpoint_interval = checkpoint_interval
+
+  #The diagnostics start from zero
+  for var in ['dE','r','dr','et','etran','esoil','ecan','prcp','q','errwat','erreng']: setattr(self,var,0.0)
+
+  return
+
+ def spinup_variables(self,):
+
+  #State variables checked for the convergence of the spin-up
+  variables = {'smc':np.copy(self.noahmp.smc),'zwt':np.copy(self.noahmp.zwt)}
+  if self.subsurface_module == 'dtopmodel': variables['si'] = np.copy(self.dtopmodel.si)
+
+  return variables
+
+ def spinup_key(self,info,sidate,sfdate,tolerance,max_cycles):
+
+  #Hash of the input file (path, size and modification time as in the shared forcing
+  #and the contents of the parameter groups, without reading the forcing) and of the
+  #configuration that the spun-up state depends on
+  import json
+  import hashlib
+  key = hashlib.sha1()
+  stat = os.stat(info['input_file'])
+  key.update(json.dumps([os.path.abspath(info['input_file']),stat.st_size,stat.st_mtime]).encode())
+  def update(grp):
+   for var in sorted(grp.variables):
+    key.update(var.encode())
+    key.update(np.ascontiguousarray(np.ma.getdata(grp.variables[var][:])).tobytes())
+   for name in sorted(grp.groups): update(grp.groups[name])
+  for group in ['parameters','flow_matrix','wmatrix','outlet']:
+   if group in self.input_fp.groups: update(self.input_fp.groups[group])
+  config = {}
+  for var in ['dt','dz','subsurface_module','surface_flow_flag','mkl_flag','kinematic_wave_solver','water_management','ensemble']:
+   config[var] = info.get(var,None)
+  config['window'] = [sidate.strftime('%Y-%m-%d %H:%M:%S'),sfdate.strftime('%Y-%m-%d %H:%M:%S')]
+  config['tolerance'] = tolerance
+  config['max_cycles'] = max_cycles
+  key.update(json.dumps(config,sort_keys=True,default=str).encode())
+
+  return key.hexdigest()[0:16]
+
  def restart(self,):
 
   file_restart = '%s/%s.h5' % (self.metadata['restart']['dir'],self.idate.strftime('%Y-%m-%d'))
   if (os.path.exists(file_restart) == False 
       or self.metadata['restart']['flag'] == False):
     print("Cold startup")
+    self.cold_start = True
     return
+  self.cold_start = False
 
-  #Read in the restart information
-  fp = h5py.File(file_restart,'r')
-  self.noahmp.smceq[:] = fp['smceq'][:]
-  self.noahmp.albold[:] = fp['albold'][:]
-  self.noahmp.sneqvo[:] = fp['sneqvo'][:]
-  self.noahmp.stc[:] = fp['stc'][:]
-  self.noahmp.sh2o[:] = fp['sh2o'][:]
-  self.noahmp.smc[:] = fp['smc'][:]
-  self.noahmp.tah[:] = fp['tah'][:]
-  self.noahmp.eah[:] = fp['eah'][:]
-  self.noahmp.fwet[:] = fp['fwet'][:]
-  self.noahmp.canliq[:] = fp['canliq'][:]
-  self.noahmp.canice[:] = fp['canice'][:]
-  self.noahmp.tv[:] = fp['tv'][:]
-  self.noahmp.tg[:] = fp['tg'][:]
-  self.noahmp.qsfc1d[:] = fp['qsfc1d'][:]
-  self.noahmp.qsnow[:] = fp['qsnow'][:]
-  self.noahmp.isnow[:] = fp['isnow'][:]
-  self.noahmp.zsnso[:] = fp['zsnso'][:]
-  self.noahmp.sndpth[:] = fp['sndpth'][:]
-  self.noahmp.swe[:] = fp['swe'][:]
-  self.noahmp.snice[:] = fp['snice'][:]
-  self.noahmp.snliq[:] = fp['snliq'][:]
-  self.noahmp.zwt[:] = fp['zwt'][:]
-  self.noahmp.wa[:] = fp['wa'][:]
-  self.noahmp.wt[:] = fp['wt'][:]
-  self.noahmp.wslake[:] = fp['wslake'][:]
-  self.noahmp.lfmass[:] = fp['lfmass'][:]
-  self.noahmp.rtmass[:] = fp['rtmass'][:]
-  self.noahmp.stmass[:] = fp['stmass'][:]
-  self.noahmp.wood[:] = fp['wood'][:]
-  self.noahmp.stblcp[:] = fp['stblcp'][:]
-  self.noahmp.fastcp[:] = fp['fastcp'][:]
-  self.noahmp.plai[:] = fp['plai'][:]
-  self.noahmp.psai[:] = fp['psai'][:]
-  self.noahmp.cm[:] = fp['cm'][:]
-  self.noahmp.ch[:] = fp['ch'][:]
-  self.noahmp.tauss[:] = fp['tauss'][:]
-  self.noahmp.smcwtd[:] = fp['smcwtd'][:]
-  self.noahmp.deeprech[:] = fp['deeprech'][:]
-  self.noahmp.rech[:] = fp['rech'][:]
-  fp.close()
+  #Read in the restart information (one bulk read) and scatter it into noahmp
+  from pyIO.restart import Read_Restart,NOAHMP_STATE
+  state = Read_Restart(file_restart)
+  for var in NOAHMP_STATE:
+   #A restart of a single run initializes all the ensemble members
+   if (self.nens > 1) and (state[var].shape[0] == self.nhru_catchment):
+    state[var] = np.concatenate([state[var],]*self.nens)
+   getattr(self.noahmp,var)[:] = state[var]
 
   return
  
@@ -131,9 +221,7 @@ class HydroBlocks:
   self.dtt = self.dt#info['dtt']
   self.nsoil = len(info['dz'])#['nsoil']
   self.ncores = info['ncores']
-  self.idate = info['idate']
-  self.fdate = info['fdate']
-  self.mkl_flag = info['mkl_flag']
+  self.mkl_flag = info.get('mkl_flag',False)
   self.dt_timedelta = datetime.timedelta(seconds=self.dt)
   self.input_fp = nc.Dataset(info['input_file'])
   self.dx = self.input_fp.groups['metadata'].dx
@@ -141,10 +229,108 @@ class HydroBlocks:
   self.surface_flow_flag = info['surface_flow_flag']
   self.subsurface_module = info['subsurface_module']
   self.hwu_flag = info['water_management']['hwu_flag']
-  self.pct = self.input_fp.groups['parameters'].variables['area_pct'][:]/100
-  self.pct = self.pct/np.sum(self.pct)
+  #Ensemble members (the members are stacked as nens blocks of the catchment hrus)
+  self.ensemble_information(info)
+  self.pct = self.read_parameter('area_pct')/100
+  self.pct = np.ma.getdata(self.pct/np.sum(self.pct)) #(plain array for the weighted sums)
   self.metadata = info
-  self.m =  self.input_fp.groups['parameters'].variables['m'][:]  #Noemi
+  self.restart_writer = None
+  self.output_enabled = True
+  #Checkpoints of the full model state every interval_days of model time
+  checkpoint = info.get('checkpoint',{})
+  self.checkpoint_interval = None
+  if checkpoint.get('interval_days',None) is not None:
+   self.checkpoint_interval = 86400*checkpoint['interval_days'] #seconds
+  self.checkpoint_dir = checkpoint.get('dir','%s/checkpoints' % info['restart']['dir'])
+  self.checkpoint_keep = checkpoint.get('keep',2) #number of checkpoints kept on disk
+  self.checkpoint_writer = None
+  self.m =  self.read_parameter('m')  #Noemi
+  #Number of time steps read per netcdf access of the forcing (default: ~1 month)
+  self.forcing_block_size = info.get('forcing',{}).get('block_size',int(30*86400/self.dt))
+  #Decode the next forcing block in a background thread?
+  self.forcing_prefetch = info.get('forcing',{}).get('prefetch',False)
+  #Share one copy of the forcing (memory mapped) between the processes running this catchment?
+  self.forcing_shared = info.get('forcing',{}).get('shared',False)
+  shared_dir = '/dev/shm'
+  if os.path.isdir(shared_dir) == False: shared_dir = tempfile.gettempdir()
+  self.forcing_shared_dir = info.get('forcing',{}).get('shared_dir',shared_dir)
+
+  #Output frequency (dt, daily or monthly) and aggregation mode per variable
+  self.output_frequency = info['output'].get('frequency','dt')
+  self.output_aggregation = {}
+  for var in info['output']['vars']:
+   self.output_aggregation[var] = info['output'].get('aggregation',{}).get(var,'mean')
+
+  #Define the dates of the first segment
+  self.segment_information(info)
+
+  return
+
+ def ensemble_information(self,info):
+
+  #Run nens parameter/forcing members in the same model (nens*nhru cells). The
+  #parameters and forcing of the catchment are tiled over the members and scaled
+  #by the factors of each member, e.g. "ensemble":{"members":3,
+  #"parameters":{"SATDK":[0.5,1.0,2.0]},"forcing":{"precip":[1.0,1.1,0.9]}}
+  ensemble = info.get('ensemble',{})
+  self.nens = ensemble.get('members',1)
+  self.nhru_catchment = self.nhru
+  self.nhru = self.nens*self.nhru_catchment
+  self.ensemble_parameters = {}
+  self.ensemble_forcing = {}
+  if self.nens == 1: return
+  if self.hwu_flag == True:
+   exit('Error: The ensemble mode does not support human water use (water_management/hwu_flag)')
+  for (group,factors) in [('parameters',self.ensemble_parameters),('forcing',self.ensemble_forcing)]:
+   for var in ensemble.get(group,{}):
+    values = np.array(ensemble[group][var],dtype=np.float64)
+    if values.size != self.nens:
+     exit('Error: The ensemble %s factors of %s must have one value per member (%d)' % (group,var,self.nens))
+    factors[var] = np.repeat(values,self.nhru_catchment)
+
+  return
+
+ def read_parameter(self,var):
+
+  #Parameter of the hrus (tiled over the ensemble members)
+  data = self.input_fp.groups['parameters'].variables[var][:]
+  if self.nens == 1: return data
+  data = np.ma.concatenate([data,]*self.nens)
+  if var in self.ensemble_parameters: data = data*self.ensemble_parameters[var]
+
+  return data
+
+ def read_forcing(self,reader,itime):
+
+  #Forcing of the time step (tiled over the ensemble members)
+  data = reader.read(itime)
+  if self.nens == 1: return data
+  members = {}
+  for var in data:
+   members[var] = self.scratch('forcing_%s' % var,self.pct,data[var].dtype)
+   members[var].reshape((self.nens,self.nhru_catchment))[...] = data[var]
+   if var in self.ensemble_forcing: members[var] *= self.ensemble_forcing[var]
+
+  return members
+
+ def segment_information(self,info):
+
+  #Define the period of the segment
+  self.idate = info['idate']
+  self.fdate = info['fdate']
+
+  #Per phase timing of the time loop (opt-in with profiling/enabled; dumped as json at
+  #the end of each segment). With allocations
+  #set (debug), the time steps that allocate allocation_threshold bytes or more in a
+  #phase once warmed up are counted as well (default: one single precision value per
+  #hru, but above the size of the buffers numpy's ufuncs use for small arrays)
+  from pyProfiler.profiler import Profiler
+  profiling = info.get('profiling',{})
+  threshold = max(4*self.nhru,16*np.getbufsize())
+  self.profiler = Profiler(profiling.get('enabled',False),profiling.get('allocations',False),
+                           profiling.get('allocation_threshold',threshold))
+  self.profiler_file = info.get('profiling',{}).get('file',
+                       '%s/%s_profile.json' % (info['output']['dir'],self.idate.strftime('%Y-%m-%d')))
 
   #Create a list of all the dates
   dates = []
@@ -201,7 +387,7 @@ class HydroBlocks:
   #Set info
   self.noahmp.iz0tlnd = 0
   self.noahmp.sldpth[:] = np.array(self.metadata['dz'])
-  self.noahmp.z_ml[:] = np.sum(self.noahmp.sldpth) 
+  self.noahmp.z_ml[:] = np.sum(self.noahmp.sldpth[0:self.nhru_catchment]) #(same for all the ensemble members)
   self.noahmp.zsoil[:] = -np.cumsum(self.noahmp.sldpth[:],axis=1)
   self.noahmp.zsnso[:] = 0.0
   self.noahmp.zsnso[:,3::] = self.noahmp.zsoil[:]
@@ -250,28 +436,28 @@ class HydroBlocks:
   self.noahmp.slopetyp[:] = 3
   self.noahmp.albold[:] = 0.5
   #Define the data
-  self.noahmp.vegtyp[:] = self.input_fp.groups['parameters'].variables['land_cover'][:]
+  self.noahmp.vegtyp[:] = self.read_parameter('land_cover')
   self.noahmp.soiltyp[:] = np.arange(1,self.noahmp.ncells+1)
-  self.noahmp.clay_pct  = self.input_fp.groups['parameters'].variables['clay'][:] # Noemi
-  self.noahmp.smcmax[:] = self.input_fp.groups['parameters'].variables['MAXSMC'][:]
-  self.noahmp.smcref[:] = self.input_fp.groups['parameters'].variables['REFSMC'][:]
-  self.noahmp.smcdry[:] = self.input_fp.groups['parameters'].variables['DRYSMC'][:]
+  self.noahmp.clay_pct  = self.read_parameter('clay') # Noemi
+  self.noahmp.smcmax[:] = self.read_parameter('MAXSMC')
+  self.noahmp.smcref[:] = self.read_parameter('REFSMC')
+  self.noahmp.smcdry[:] = self.read_parameter('DRYSMC')
   for ilayer in range(self.noahmp.sh2o.shape[1]):
-   self.noahmp.sh2o[:,ilayer] = self.input_fp.groups['parameters'].variables['MAXSMC'][:]
+   self.noahmp.sh2o[:,ilayer] = self.read_parameter('MAXSMC')
    #self.noahmp.sh2o[:,ilayer] = self.input_fp.groups['parameters'].variables['REFSMC'][:] #Noemi, start at REFSMC
   self.noahmp.smc[:] = self.noahmp.sh2o[:]
   self.noahmp.smcwtd[:] = self.noahmp.sh2o[:,0]
   #Initialize the soil parameters
-  self.noahmp.bb0[:] = self.input_fp.groups['parameters'].variables['BB'][:]
-  self.noahmp.drysmc0[:] = self.input_fp.groups['parameters'].variables['DRYSMC'][:]
-  self.noahmp.f110[:] = self.input_fp.groups['parameters'].variables['F11'][:]
-  self.noahmp.maxsmc0[:] = self.input_fp.groups['parameters'].variables['MAXSMC'][:]
-  self.noahmp.refsmc0[:] = self.input_fp.groups['parameters'].variables['REFSMC'][:]
-  self.noahmp.satpsi0[:] = self.input_fp.groups['parameters'].variables['SATPSI'][:]
-  self.noahmp.satdk0[:] = self.input_fp.groups['parameters'].variables['SATDK'][:]
-  self.noahmp.satdw0[:] = self.input_fp.groups['parameters'].variables['SATDW'][:]
-  self.noahmp.wltsmc0[:] = self.input_fp.groups['parameters'].variables['WLTSMC'][:]
-  self.noahmp.qtz0[:] = self.input_fp.groups['parameters'].variables['QTZ'][:]
+  self.noahmp.bb0[:] = self.read_parameter('BB')
+  self.noahmp.drysmc0[:] = self.read_parameter('DRYSMC')
+  self.noahmp.f110[:] = self.read_parameter('F11')
+  self.noahmp.maxsmc0[:] = self.read_parameter('MAXSMC')
+  self.noahmp.refsmc0[:] = self.read_parameter('REFSMC')
+  self.noahmp.satpsi0[:] = self.read_parameter('SATPSI')
+  self.noahmp.satdk0[:] = self.read_parameter('SATDK')
+  self.noahmp.satdw0[:] = self.read_parameter('SATDW')
+  self.noahmp.wltsmc0[:] = self.read_parameter('WLTSMC')
+  self.noahmp.qtz0[:] = self.read_parameter('QTZ')
 
   #Set lat/lon (declination calculation)
   self.noahmp.lat[:] = 0.0174532925*self.input_fp.groups['metadata'].latitude
@@ -295,6 +481,31 @@ class HydroBlocks:
   #Define the parameters
   self.noahmp.initialize_parameters()
 
+  #Views of the module arrays used in the time loop
+  from pyNoahMP.state import NoahMP_State
+  self.state = NoahMP_State(self.noahmp)
+
+  return
+
+ def initialize_output_diagnostics(self,):
+
+  #The soil layers and the depth to bedrock do not change during the simulation
+  sldpth = self.noahmp.sldpth
+  cs = np.cumsum(sldpth[0,:])
+
+  #Root zone (layers within the top 0.5 m)
+  self.root_mask = cs <= 0.5
+  self.root_pct = sldpth[0,self.root_mask]/np.sum(sldpth[0,self.root_mask])
+  self.root_layers = int(np.sum(self.root_mask)) #(the top root_layers layers)
+
+  #Layers above the depth to bedrock (closest layer interface to m)
+  m = np.ma.getdata(self.m)
+  self.bedrock_layer = np.argmin(np.abs(cs[np.newaxis,:]-m[:,np.newaxis]),axis=1)
+  mask = np.arange(sldpth.shape[1])[np.newaxis,:] < self.bedrock_layer[:,np.newaxis]
+  self.bedrock_sldpth = np.where(mask,sldpth,0.0).astype(sldpth.dtype)
+  self.bedrock_depth = np.sum(self.bedrock_sldpth,axis=1)
+  self.bedrock_depth[self.bedrock_layer == 0] = np.nan #no layer above bedrock
+
   return
 
  def initialize_subsurface(self,):
@@ -315,23 +526,64 @@ class HydroBlocks:
   self.richards.dx = self.dx
   self.richards.nhru = self.nhru
   #print(self.nhru)
-  self.richards.m[:] = self.input_fp.groups['parameters'].variables['m'][:]
+  self.richards.m[:] = self.read_parameter('m')
   #self.richards.dem[:] = self.input_fp.groups['parameters'].variables['dem'][:]
-  self.richards.dem[:] = self.input_fp.groups['parameters'].variables['hand'][:]
-  self.richards.slope[:] = self.input_fp.groups['parameters'].variables['slope'][:]
+  self.richards.dem[:] = self.read_parameter('hand')
+  self.richards.slope[:] = self.read_parameter('slope')
   #self.richards.hand[:] = self.input_fp.groups['parameters'].variables['hand'][:]
-  self.richards.area[:] = self.input_fp.groups['parameters'].variables['area'][:]
+  self.richards.area[:] = self.read_parameter('area')
   self.richards.width = sparse.csr_matrix((self.input_fp.groups['wmatrix'].variables['data'][:],
                                   self.input_fp.groups['wmatrix'].variables['indices'][:],
                                   self.input_fp.groups['wmatrix'].variables['indptr'][:]),
-                                  shape=(self.nhru,self.nhru),dtype=np.float64)
+                                  shape=(self.nhru_catchment,self.nhru_catchment),dtype=np.float64)
                                   #dtype=np.float64)[0:self.nhru,0:self.nhru]
+  #The ensemble members are not connected (block diagonal operator)
+  if self.nens > 1: self.richards.width = sparse.block_diag([self.richards.width,]*self.nens,format='csr')
   #print(self.richards.width.shape)
   self.richards.I = self.richards.width.copy()
   self.richards.I[self.richards.I != 0] = 1
   
   return
 
+ def kinematic_wave_solver(self,solver):
+
+  #Solver of the kinematic wave system of Dynamic TOPMODEL for the flow matrix
+  from pyDTopmodel import solvers
+  (F,area,dx) = (self.dtopmodel.flow_matrix,self.dtopmodel.area,self.dtopmodel.dx)
+  if solver == 'spsolve': return solvers.Sparse_Solver(F,area,dx)
+  #The basins (weakly connected components) are solved in parallel on ncores threads
+  if solver == 'compiled': return solvers.Compiled_Solver(F,area,dx,nthreads=self.ncores)
+  return solvers.Topological_Solver(F,area,dx,nthreads=self.ncores)
+
+ def resolve_kinematic_wave_solver(self,):
+
+  #Solver of the kinematic wave (compiled: forward substitution over the hrus ordered
+  #along the flow network in kinematic_wave_tools, built by pyDTopmodel/src/compile.py;
+  #topological: the same in python; spsolve: sparse LU of the preassembled system every
+  #substep; mkl: the MKL DSS solver of dynamic_topmodel_tools). auto uses the compiled
+  #solver when it has been built and never MKL. Without kinematic_wave_solver the legacy
+  #mkl_flag is a preference: MKL when dynamic_topmodel_tools has been built and auto
+  #otherwise (only kinematic_wave_solver mkl requires it).
+  solver = self.metadata.get('kinematic_wave_solver',None)
+  if solver is None and self.mkl_flag:
+   try:
+    import dynamic_topmodel_tools
+    solver = 'mkl'
+   except ImportError:
+    print('mkl_flag is set but dynamic_topmodel_tools (MKL) is not built; using the auto kinematic wave solver')
+    solver = 'auto'
+  if solver is None: solver = 'auto'
+  if solver == 'auto':
+   try:
+    from pyDTopmodel import kinematic_wave_tools
+    solver = 'compiled'
+   except ImportError:
+    solver = 'topological'
+  if solver not in ['compiled','topological','spsolve','mkl']:
+   exit('Error: Unknown kinematic_wave_solver %s (auto, compiled, topological, spsolve or mkl)' % solver)
+
+  return solver
+
  def initialize_dtopmodel(self,):
 
   from pyDTopmodel import dynamic_topmodel as dtopmodel
@@ -339,6 +591,10 @@ class HydroBlocks:
   #Define some metadata
   nhru_outlet = self.input_fp.groups['outlet'].groups['summary'].variables['hru_dst'].size
 
+  #Solver of the kinematic wave
+  solver = self.resolve_kinematic_wave_solver()
+  self.mkl_flag = (solver == 'mkl')
+
   #Initialize Dynamic Topmodel
   self.dtopmodel = dtopmodel.Dynamic_Topmodel(self.nhru,nhru_outlet,self.mkl_flag)
 
@@ -351,44 +607,63 @@ class HydroBlocks:
   self.dtopmodel.area[:] = 0.0 #meters^2
   self.dtopmodel.dx[:] = self.dx #meters
   #print self.input_fp.groups['parameters'].variables['m'][:]
-  self.dtopmodel.m[:] = self.input_fp.groups['parameters'].variables['m'][:] #Noemi
+  self.dtopmodel.m[:] = self.read_parameter('m') #Noemi
   #self.dtopmodel.sdmax[:] = 100.0#self.input_fp.groups['parameters'].variables['sdmax'][:]
-  self.dtopmodel.sdmax[:] = self.input_fp.groups['parameters'].variables['sdmax'][:] #Noemi
+  self.dtopmodel.sdmax[:] = self.read_parameter('sdmax') #Noemi
   #Set cluster information
-  self.dtopmodel.pct[:] = self.input_fp.groups['parameters'].variables['area_pct'][:]/100
-  self.dtopmodel.area[:] = self.input_fp.groups['parameters'].variables['area'][:]
+  self.dtopmodel.pct[:] = self.read_parameter('area_pct')/100
+  self.dtopmodel.area[:] = self.read_parameter('area')
   af = 1.0 #anisotropy factor
-  self.dtopmodel.T0[:] = af*self.input_fp.groups['parameters'].variables['SATDK'][:]*self.dtopmodel.m
-  self.dtopmodel.sti[:] = self.input_fp.groups['parameters'].variables['ti'][:]
-  self.dtopmodel.beta[:] = self.input_fp.groups['parameters'].variables['slope'][:]
-  self.dtopmodel.carea[:] = self.input_fp.groups['parameters'].variables['carea'][:]
-  self.dtopmodel.channel[:] = self.input_fp.groups['parameters'].variables['channel'][:]
-  self.dtopmodel.dem[:] = self.input_fp.groups['parameters'].variables['dem'][:] 
-  self.dtopmodel.mannings[:] = self.input_fp.groups['parameters'].variables['mannings'][:]
+  self.dtopmodel.T0[:] = af*self.read_parameter('SATDK')*self.dtopmodel.m
+  self.dtopmodel.sti[:] = self.read_parameter('ti')
+  self.dtopmodel.beta[:] = self.read_parameter('slope')
+  self.dtopmodel.carea[:] = self.read_parameter('carea')
+  self.dtopmodel.channel[:] = self.read_parameter('channel')
+  self.dtopmodel.dem[:] = self.read_parameter('dem') 
+  self.dtopmodel.mannings[:] = self.read_parameter('mannings')
   #Set outlet information
   self.dtopmodel.area_outlet[:] = self.dx**2*self.input_fp.groups['outlet'].groups['summary'].variables['counts'][:]
-  self.dtopmodel.pct = self.dtopmodel.pct/np.sum(self.dtopmodel.pct)
+  self.dtopmodel.pct = self.nens*self.dtopmodel.pct/np.sum(self.dtopmodel.pct) #sums to 1 per member
   ti_mean = np.sum(self.dtopmodel.pct*self.dtopmodel.sti[:])
  
-  #Calculate the sti
+  #Calculate the sti (relative to the mean transmissivity of each member)
   lnT0 = np.log(self.dtopmodel.T0)
-  lnTe = np.sum(self.dtopmodel.pct*lnT0)
-  self.dtopmodel.sti = self.dtopmodel.sti - (lnT0 - lnTe)
+  lnTe = np.sum((self.dtopmodel.pct*lnT0).reshape(self.nens,self.nhru_catchment),axis=1)
+  self.dtopmodel.sti = self.dtopmodel.sti - (lnT0 - np.repeat(lnTe,self.nhru_catchment))
 
   #Set weight matrix
   self.dtopmodel.flow_matrix = sparse.csr_matrix((self.input_fp.groups['flow_matrix'].variables['data'][:],
 			          self.input_fp.groups['flow_matrix'].variables['indices'][:],
 			          self.input_fp.groups['flow_matrix'].variables['indptr'][:]),
- 				  dtype=np.float64)[0:self.nhru,0:self.nhru]
+ 				  dtype=np.float64)[0:self.nhru_catchment,0:self.nhru_catchment]
+  #The ensemble members are not connected (block diagonal operator)
+  if self.nens > 1: self.dtopmodel.flow_matrix = sparse.block_diag([self.dtopmodel.flow_matrix,]*self.nens,format='csr')
   self.dtopmodel.flow_matrix.setdiag(self.dtopmodel.flow_matrix.diagonal()) #Ensure the zeros are not sparse (for kinematic wave solution).
   self.dtopmodel.flow_matrix_T = sparse.csr_matrix(self.dtopmodel.flow_matrix.T) #transposed
   self.dtopmodel.flow_matrix_T.setdiag(self.dtopmodel.flow_matrix_T.diagonal()) #Ensure the zeros are not sparse  (for kinematic wave solution).
 
   #Initialize the solver
   if self.mkl_flag: self.dtopmodel.dtt.initialize(self.dtopmodel.flow_matrix_T.indices,self.dtopmodel.flow_matrix_T.indptr)
+  else:
+   self.dtopmodel.solver = self.kinematic_wave_solver(solver)
+   if solver != 'spsolve':
+    print('Kinematic wave solver (%s): %d basins in %d groups, %d levels, %d hrus in %d cycles' % (solver,
+          self.dtopmodel.solver.nbasins,self.dtopmodel.solver.gstart.size-1,self.dtopmodel.solver.nlevels,
+          self.dtopmodel.solver.ncyclic,self.dtopmodel.solver.ncycles))
+
+  #Pipelined routing: the surface (with the excess runoff of the previous time step)
+  #and the subsurface are solved concurrently (see Dynamic_Topmodel.update)
+  if self.metadata.get('pipelined_routing',False):
+   if self.mkl_flag: print('pipelined_routing is not available with the mkl solver (one MKL DSS handle); the routing is sequential')
+   else:
+    self.dtopmodel.pipelined = True
+    self.dtopmodel.solver_surface = self.kinematic_wave_solver(solver)
 
   #Initialize the soil moisture deficit values
   self.dtopmodel.si[:] = 0.0
+
+  #Distribution of the lateral divergence over the soil layers
+  self.lateral_divergence = dtopmodel.Lateral_Divergence(self.state.sldpth)
  
   return
 
@@ -396,7 +671,7 @@ class HydroBlocks:
 
   from pyHWU.Human_Water_Use import Human_Water_Use as hwu
   self.hwu = hwu(self,info)
-  self.hwu.area = self.input_fp.groups['parameters'].variables['area'][:]
+  self.hwu.area = self.read_parameter('area')
 
   if self.hwu.hwu_flag == True:
    print("Initializing Human Water Management")
@@ -404,31 +679,77 @@ class HydroBlocks:
 
   return
 
+ def initialize_forcing(self,):
+
+  from pyIO.forcing import Forcing_Reader,Shared_Forcing_Reader
+  from pyIO.lock import hdf5_lock
+
+  #Determine the first time step for the meteorology
+  with hdf5_lock:
+   var = self.input_fp.groups['meteorology'].variables['time']
+   ndates = var[:]
+   ndate = nc.date2num(self.idate,units=var.units,calendar=var.calendar)
+  self.minitial_itime = np.where(ndates == ndate)[0][0]
+  ntime = len(self.dates)
+
+  #Meteorology
+  vars = ['lwdown','swdown','psurf','wind','tair','spfh','precip']
+  if self.forcing_shared:
+   self.meteorology = Shared_Forcing_Reader(self.input_fp,self.metadata['input_file'],'meteorology',vars,
+                                    self.minitial_itime,ntime,self.forcing_block_size,self.forcing_shared_dir)
+  else:
+   self.meteorology = Forcing_Reader(self.input_fp,'meteorology',vars,self.minitial_itime,
+                                    ntime,self.forcing_block_size,self.forcing_prefetch)
+
+  #Water use
+  vars = []
+  if self.hwu.hwu_flag == True:
+   if self.hwu.hwu_indust_flag == True: vars.append('industrial')
+   if self.hwu.hwu_domest_flag == True: vars.append('domestic')
+   if self.hwu.hwu_lstock_flag == True: vars.append('livestock')
+  if self.forcing_shared and (len(vars) > 0):
+   self.water_use = Shared_Forcing_Reader(self.input_fp,self.metadata['input_file'],'water_use',vars,
+                                  self.minitial_itime,ntime,self.forcing_block_size,self.forcing_shared_dir)
+  else:
+   self.water_use = Forcing_Reader(self.input_fp,'water_use',vars,self.minitial_itime,
+                                  ntime,self.forcing_block_size,self.forcing_prefetch)
+
+  return
+
  def run(self,info):
 
-  #Run the model
-  date = self.idate
+  #Run the model (from the checkpoint time step when resuming)
+  date = self.idate + self.itime*self.dt_timedelta
   tic = time.time()
-  self.noahmp.dzwt[:] = 0.0
-
-  if self.subsurface_module == 'dtopmodel': self.dtopmodel.ex[:] = 0.0
+  self.meteorology.wait_time = 0.0
+  self.water_use.wait_time = 0.0
+  if self.itime == 0:
+   self.state.dzwt[:] = 0.0
+   if self.subsurface_module == 'dtopmodel': self.dtopmodel.ex[:] = 0.0
+  profiler = self.profiler
   while date < self.fdate:
 
    #Update input data
+   t0 = profiler.tic()
    self.update_input(date)
+   profiler.toc('update_input',t0)
 
    #Save the original precip
-   precip = np.copy(self.noahmp.prcp)
+   precip = self.scratch('precip',self.state.prcp)
+   precip[:] = self.state.prcp
 
    #Calculate initial NOAH water balance
+   t0 = profiler.tic()
    self.initialize_water_balance()
+   profiler.toc('water_energy_balance',t0)
 
    #Update model
    self.update(date)
    
    #Return precip to original value
-   self.noahmp.prcp[:] = precip[:] 
+   self.state.prcp[:] = precip[:] 
 
+   t0 = profiler.tic()
    #Calculate final water balance
    self.finalize_water_balance()
 
@@ -437,22 +758,37 @@ class HydroBlocks:
 
    #Update the energy balance error
    self.calculate_energy_balance_error()
+   profiler.toc('water_energy_balance',t0)
  
    #Update time and date
    self.date = date
    info['date'] = date
 
-   #Update output
-   self.update_output(date)
+   #Update output (not during the spin-up)
+   t0 = profiler.tic()
+   if self.output_enabled: self.update_output(date)
+   profiler.toc('update_output',t0)
 
    #Update time step
    date = date + self.dt_timedelta
    self.itime = self.itime + 1
+   profiler.warm = True #(the work arrays are allocated in the first time step)
+
+   #Save a checkpoint of the model state
+   if (self.checkpoint_interval is not None) and (date < self.fdate):
+    if (date - self.idate).total_seconds() % self.checkpoint_interval == 0: self.save_checkpoint(date)
 
    #Output some statistics
    if (date.hour == 0) and (date.day == 1):
     print(date.strftime("%Y-%m-%d"),'%10.4f'%(time.time()-tic),'et:%10.4f'%self.et,'prcp:%10.4f'%self.prcp,'q:%10.4f'%self.q,'WB ERR:%10.6f' % self.errwat,'ENG ERR:%10.6f' % self.erreng)
 
+  #Time spent in the time loop
+  self.run_time = time.time() - tic
+
+  #Report the time spent waiting on the forcing
+  print('Forcing I/O wait: %.4f s' % (self.meteorology.wait_time + self.water_use.wait_time))
+  for line in profiler.allocation_report(): print(line)
+
   return
 
  def update_input(self,date):
@@ -475,64 +811,68 @@ class HydroBlocks:
   self.noahmp.yearlen = (datetime.datetime(date.year+1,1,1,0) - datetime.datetime(date.year,1,1,1,0)).days + 1
 
   #Update meteorology
-  meteorology = self.input_fp.groups['meteorology']
-  if date == self.idate:
-   #determine the first time step for the meteorology
-   var = meteorology.variables['time']
-   ndates = var[:]
-   #convert current date to num
-   ndate = nc.date2num(date,units=var.units,calendar=var.calendar)
-   #identify the position
-   self.minitial_itime = np.where(ndates == ndate)[0][0]
-  i = self.itime + self.minitial_itime
-  self.noahmp.lwdn[:] = meteorology.variables['lwdown'][i,:] #W/m2
-  self.noahmp.swdn[:] = meteorology.variables['swdown'][i,:] #W/m2
-  self.noahmp.psfc[:] = meteorology.variables['psurf'][i,:] #Pa
-  self.noahmp.p_ml[:] = meteorology.variables['psurf'][i,:] #Pa
-  self.noahmp.u_ml[:] = (meteorology.variables['wind'][i,:]**2/2)**0.5 #m/s
-  self.noahmp.v_ml[:] = (meteorology.variables['wind'][i,:]**2/2)**0.5 #m/s
-  self.noahmp.t_ml[:] = meteorology.variables['tair'][i,:] #K
-  self.noahmp.q_ml[:] = meteorology.variables['spfh'][i,:] #Kg/Kg
-  self.noahmp.qsfc1d[:] = meteorology.variables['spfh'][i,:] #Kg/Kg
-  self.noahmp.prcp[:] = meteorology.variables['precip'][i,:] #mm/s
+  meteorology = self.read_forcing(self.meteorology,self.itime)
+  self.state.lwdn[:] = meteorology['lwdown'] #W/m2
+  self.state.swdn[:] = meteorology['swdown'] #W/m2
+  self.state.psfc[:] = meteorology['psurf'] #Pa
+  self.state.p_ml[:] = meteorology['psurf'] #Pa
+  wind = self.scratch('wind',meteorology['wind'])
+  np.square(meteorology['wind'],out=wind)
+  np.divide(wind,2,out=wind)
+  self.state.u_ml[:] = np.sqrt(wind,out=wind) #m/s
+  self.state.v_ml[:] = self.state.u_ml[:] #m/s
+  self.state.t_ml[:] = meteorology['tair'] #K
+  self.state.q_ml[:] = meteorology['spfh'] #Kg/Kg
+  self.state.qsfc1d[:] = meteorology['spfh'] #Kg/Kg
+  self.state.prcp[:] = meteorology['precip'] #mm/s
 
   #Set the partial pressure of CO2 and O2
-  self.noahmp.co2air[:] = 355.E-6*self.noahmp.psfc[:]# ! Partial pressure of CO2 (Pa) ! From NOAH-MP-WRF
-  self.noahmp.o2air[:] = 0.209*self.noahmp.psfc[:]# ! Partial pressure of O2 (Pa)  ! From NOAH-MP-WRF
+  np.multiply(355.E-6,self.state.psfc,out=self.state.co2air)# ! Partial pressure of CO2 (Pa) ! From NOAH-MP-WRF
+  np.multiply(0.209,self.state.psfc,out=self.state.o2air)# ! Partial pressure of O2 (Pa)  ! From NOAH-MP-WRF
 
   # Update water demands
   if self.hwu.hwu_flag == True:
    if (date.hour*3600)%self.hwu.dta == 0:
-    water_use = self.input_fp.groups['water_use']
+    water_use = self.read_forcing(self.water_use,self.itime)
     if self.hwu.hwu_indust_flag == True:
-     self.hwu.demand_indust[:]  = water_use.variables['industrial'][i,:] #m/s
-     self.hwu.deficit_indust[:] = np.copy(self.hwu.demand_indust[:])
+     self.hwu.demand_indust[:]  = water_use['industrial'] #m/s
+     self.hwu.deficit_indust[:] = self.hwu.demand_indust
     if self.hwu.hwu_domest_flag == True:
-     self.hwu.demand_domest[:]  = water_use.variables['domestic'][i,:] #m/s
-     self.hwu.deficit_domest[:] = np.copy(self.hwu.demand_domest[:])
+     self.hwu.demand_domest[:]  = water_use['domestic'] #m/s
+     self.hwu.deficit_domest[:] = self.hwu.demand_domest
     if self.hwu.hwu_lstock_flag == True:
-     self.hwu.demand_lstock[:]  = water_use.variables['livestock'][i,:] #m/s
-     self.hwu.deficit_lstock[:] = np.copy(self.hwu.demand_lstock[:])
+     self.hwu.demand_lstock[:]  = water_use['livestock'] #m/s
+     self.hwu.deficit_lstock[:] = self.hwu.demand_lstock
 
 
   return
 
  def update(self,date):
 
+  profiler = self.profiler
+
   # Apply irrigation
+  t0 = profiler.tic()
   self.hwu.Human_Water_Irrigation(self,date)
+  profiler.toc('Human_Water_Irrigation',t0)
   
   # Update subsurface
+  t0 = profiler.tic()
   self.update_subsurface()
+  profiler.toc('update_subsurface',t0)
 
   # Update NOAH
+  t0 = profiler.tic()
   self.noahmp.run_model(self.ncores)
+  profiler.toc('noahmp.run_model',t0)
 
+  t0 = profiler.tic()
   # Calculate water demands and supplies, and allocate volumes
   self.hwu.Calc_Human_Water_Demand_Supply(self,date)
 
   # Abstract Surface Water and Groundwater
   self.hwu.Water_Supply_Abstraction(self,date)
+  profiler.toc('hwu_allocation',t0)
 
 
 
@@ -540,21 +880,23 @@ class HydroBlocks:
 
  def update_subsurface(self,):
 
-  self.noahmp.dzwt[:] = 0.0
+  self.state.dzwt[:] = 0.0
 
   if self.subsurface_module == 'dtopmodel':
 
-   #Calculate the updated soil moisture deficit
-   si0 = np.copy(self.noahmp.si0)
-   si1 = np.copy(self.noahmp.si1)
+   from pyDTopmodel import dynamic_topmodel as dtopmodel
 
-   #Calculate the change in deficit
-   self.dtopmodel.si[:] = si1[:]
-   self.dtopmodel.dsi[:] = np.copy(si1 - si0)
-   self.dtopmodel.r[:] = -self.dtopmodel.dsi[:]/self.dtopmodel.dt
+   #Calculate the change in deficit (in single precision as in Noah-MP)
+   tmp = self.scratch('dsi',self.state.si1)
+   self.dtopmodel.si[:] = self.state.si1
+   np.subtract(self.state.si1,self.state.si0,out=tmp)
+   self.dtopmodel.dsi[:] = tmp
+   np.divide(self.dtopmodel.dsi,self.dtopmodel.dt,out=self.dtopmodel.r)
+   np.negative(self.dtopmodel.r,out=self.dtopmodel.r)
 
    #Add the surface runoff
-   self.dtopmodel.qsurf[:] = self.noahmp.runsf[:]/1000.0
+   np.divide(self.state.runsf,1000.0,out=tmp)
+   self.dtopmodel.qsurf[:] = tmp
 
    #Update dynamic topmodel
    self.dtopmodel.update(self.ncores)
@@ -568,180 +910,273 @@ class HydroBlocks:
    #print self.dtopmodel.dt*self.dtopmodel.r
    #self.noahmp.dzwt[:] = dsi+self.dtopmodel.dt*self.dtopmodel.ex-self.dtopmodel.dt*self.dtopmodel.r
    #self.noahmp.dzwt[:] = 0
-   self.noahmp.hdiv[:] = 0
-   ls = []
-   for ihru in range(self.nhru):
-    cs = np.cumsum(self.noahmp.sldpth[ihru,:])
-    m = cs>np.abs(self.noahmp.zwt[ihru])
-    if np.sum(m) > 0:
-     idx = np.where(m)[0][0]
-     #weight the extraction
-     fs = self.noahmp.sldpth[ihru,idx:]/np.sum(self.noahmp.sldpth[ihru,idx:])
-     self.noahmp.hdiv[ihru,idx:] = 1000*fs*(self.dtopmodel.qout[ihru]-self.dtopmodel.qin[ihru])
-    else:
-     self.noahmp.hdiv[ihru,:] = 0.0
+   #Distribute the lateral divergence over the soil layers below the water table
+   self.lateral_divergence(self.state.zwt,self.dtopmodel.qout,self.dtopmodel.qin,self.state.hdiv)
 
   elif self.subsurface_module == 'richards':
 
    #Assign noahmp variables to subsurface module
-   self.richards.theta[:] = self.noahmp.smc[:]
-   self.richards.thetar[:] = self.noahmp.drysmc0[:]
-   self.richards.thetas[:] = self.noahmp.maxsmc0[:]
-   self.richards.b[:] = self.noahmp.bb0[:]
-   self.richards.satpsi[:] = self.noahmp.satpsi0[:]
-   self.richards.ksat[:] = self.noahmp.satdk0[:]
-   self.richards.dz[:] = self.noahmp.sldpth[:]
+   self.richards.theta[:] = self.state.smc[:]
+   self.richards.thetar[:] = self.state.drysmc0[:]
+   self.richards.thetas[:] = self.state.maxsmc0[:]
+   self.richards.b[:] = self.state.bb0[:]
+   self.richards.satpsi[:] = self.state.satpsi0[:]
+   self.richards.ksat[:] = self.state.satdk0[:]
+   self.richards.dz[:] = self.state.sldpth[:]
 
    #Update subsurface module
    self.richards.update()
 
    #Assign subsurface module variables to noahmp
-   self.noahmp.hdiv[:] = self.richards.hdiv[:]
+   self.state.hdiv[:] = self.richards.hdiv[:]
    
   return
 
+ def scratch(self,name,like,dtype=None):
+
+  #Work array of the time step (allocated with the shape and memory layout of like
+  #on first use and then reused, so the time loop does not allocate temporaries)
+  array = self.scratch_arrays.get(name,None)
+  if array is None:
+   array = np.zeros_like(like,dtype=dtype)
+   self.scratch_arrays[name] = array
+
+  return array
+
+ def weighted_sum(self,values):
+
+  #np.sum(self.pct*values) without the temporary (values are cast by the copy as the
+  #ufunc would, but without its buffers)
+  tmp = self.scratch('weighted_%s' % values.dtype.str,self.pct,np.result_type(self.pct,values))
+  np.copyto(tmp,values)
+  np.multiply(self.pct,tmp,out=tmp)
+
+  return np.sum(tmp)
+
+ def water_storage(self,out):
+
+  #Canopy, snow, aquifer and soil water (mm)
+  NOAH = self.state
+  layers = self.scratch('soil_water_layers',NOAH.smc)
+  smw = self.scratch('soil_water',NOAH.zwt)
+  np.multiply(NOAH.sldpth,1000,out=layers)
+  np.multiply(layers,NOAH.smc,out=layers)
+  np.sum(layers,axis=1,out=smw)
+  np.add(NOAH.canliq,NOAH.canice,out=out)
+  np.add(out,NOAH.swe,out=out)
+  np.add(out,NOAH.wa,out=out)
+  np.add(out,smw,out=out)
+
+  return out
+
  def initialize_water_balance(self,):
  
-  smw = np.sum(1000*self.noahmp.sldpth*self.noahmp.smc,axis=1)
-  self.beg_wb = np.copy(self.noahmp.canliq + self.noahmp.canice + self.noahmp.swe + self.noahmp.wa + smw)
-  self.dzwt0 = np.copy(self.noahmp.dzwt)
+  self.water_storage(self.beg_wb)
+  self.dzwt0[:] = self.state.dzwt
 
   return 
 
  def finalize_water_balance(self,):
 
-  NOAH = self.noahmp
-  smw = np.sum(1000*NOAH.sldpth*NOAH.smc,axis=1) 
-  self.end_wb = np.copy(NOAH.canliq + NOAH.canice + NOAH.swe + NOAH.wa + smw)
+  self.water_storage(self.end_wb)
   
   return
 
  def calculate_water_balance_error(self,):
 
-  NOAH = self.noahmp
+  NOAH = self.state
   HWU = self.hwu
   dt = self.dt
-  if self.subsurface_module == 'dtopmodel':
-   #tmp = np.copy(self.end_wb - self.beg_wb - NOAH.dt*(NOAH.prcp-NOAH.ecan-
-   #      NOAH.etran-NOAH.esoil-NOAH.runsf-NOAH.runsb) - 1000*self.dzwt0)
-   tmp = np.copy(self.end_wb - self.beg_wb - NOAH.dt*(NOAH.prcp-NOAH.ecan-
-         NOAH.etran-NOAH.esoil-NOAH.runsf-NOAH.runsb-np.sum(NOAH.hdiv,axis=1)))
-  elif self.subsurface_module == 'richards':
-   tmp = np.copy(self.end_wb - self.beg_wb - NOAH.dt*(NOAH.prcp-NOAH.ecan-
-         NOAH.etran-NOAH.esoil-NOAH.runsf-NOAH.runsb-np.sum(NOAH.hdiv,axis=1)))
-  else:
-   tmp = np.copy(self.end_wb - self.beg_wb - NOAH.dt*(NOAH.prcp-NOAH.ecan-
-         NOAH.etran-NOAH.esoil-NOAH.runsf-NOAH.runsb))
-  self.errwat += np.sum(self.pct*tmp)
-  self.q = self.q + dt*np.sum(self.pct*NOAH.runsb) + dt*np.sum(self.pct*NOAH.runsf)
-  self.et = self.et + dt*np.sum(self.pct*(NOAH.ecan + NOAH.etran + NOAH.esoil))
-  self.etran += dt*np.sum(self.pct*NOAH.etran)
-  self.ecan += dt*np.sum(self.pct*NOAH.ecan)
-  self.esoil += dt*np.sum(self.pct*NOAH.esoil)
-  self.prcp = self.prcp + dt*np.sum(self.pct*NOAH.prcp)
+  #Net flux of the time step (mm)
+  flux = self.scratch('net_flux',NOAH.prcp)
+  np.subtract(NOAH.prcp,NOAH.ecan,out=flux)
+  np.subtract(flux,NOAH.etran,out=flux)
+  np.subtract(flux,NOAH.esoil,out=flux)
+  np.subtract(flux,NOAH.runsf,out=flux)
+  np.subtract(flux,NOAH.runsb,out=flux)
+  #if self.subsurface_module == 'dtopmodel':
+  # tmp = (self.end_wb - self.beg_wb - NOAH.dt*(NOAH.prcp-NOAH.ecan-
+  #       NOAH.etran-NOAH.esoil-NOAH.runsf-NOAH.runsb) - 1000*self.dzwt0)
+  if self.subsurface_module in ['dtopmodel','richards']:
+   hdiv = self.scratch('net_hdiv',NOAH.prcp)
+   np.sum(NOAH.hdiv,axis=1,out=hdiv)
+   np.subtract(flux,hdiv,out=flux)
+  np.multiply(NOAH.dt,flux,out=flux)
+  tmp = self.scratch('water_balance_error',NOAH.prcp)
+  np.subtract(self.end_wb,self.beg_wb,out=tmp)
+  np.subtract(tmp,flux,out=tmp)
+  self.errwat += self.weighted_sum(tmp)
+  self.q = self.q + dt*self.weighted_sum(NOAH.runsb) + dt*self.weighted_sum(NOAH.runsf)
+  np.add(NOAH.ecan,NOAH.etran,out=flux)
+  np.add(flux,NOAH.esoil,out=flux)
+  self.et = self.et + dt*self.weighted_sum(flux)
+  self.etran += dt*self.weighted_sum(NOAH.etran)
+  self.ecan += dt*self.weighted_sum(NOAH.ecan)
+  self.esoil += dt*self.weighted_sum(NOAH.esoil)
+  self.prcp = self.prcp + dt*self.weighted_sum(NOAH.prcp)
 
   return
 
  def calculate_energy_balance_error(self,):
 
-  NOAH = self.noahmp
-  tmp = np.copy(NOAH.sav+NOAH.sag-NOAH.fira-NOAH.fsh-NOAH.fcev-NOAH.fgev-NOAH.fctr-NOAH.ssoil)
-  self.erreng += np.sum(self.pct*tmp)
+  NOAH = self.state
+  tmp = self.scratch('energy_balance_error',NOAH.sav)
+  np.add(NOAH.sav,NOAH.sag,out=tmp)
+  for var in ['fira','fsh','fcev','fgev','fctr','ssoil']: np.subtract(tmp,getattr(NOAH,var),out=tmp)
+  self.erreng += self.weighted_sum(tmp)
 
   return
 
  def update_output(self,date):
 
-  NOAH = self.noahmp
+  NOAH = self.state
   HWU = self.hwu
   HB = self
   itime = self.itime
 
-  #Create the netcdf file
-  if date == self.idate: self.create_netcdf_file()
-
-  #General info
-  grp = self.output_fp.groups['metadata']
-  dates = grp.variables['date']
-  dates[itime] = nc.date2num(date,units=dates.units,calendar=dates.calendar)
-  
-  #Update the variables
-  grp = self.output_fp.groups['data']
+  #Create the netcdf file (the forcing prefetch is already running)
+  if date == self.idate:
+   from pyIO.lock import hdf5_lock
+   with hdf5_lock: self.create_netcdf_file()
 
-  
   tmp = {}
   #NoahMP
-  tmp['smc'] = np.copy(NOAH.smc) #m3/m3
-  tmp['g'] = np.copy(NOAH.ssoil) #W/m2
-  tmp['sh'] = np.copy(NOAH.fsh) #W/m2
-  tmp['lh'] = np.copy(NOAH.fcev + NOAH.fgev + NOAH.fctr) #W/m2
-  tmp['qbase'] = NOAH.dt*np.copy(NOAH.runsb) #mm
-  tmp['qsurface'] = NOAH.dt*np.copy(NOAH.runsf) #mm
-  tmp['runoff'] = NOAH.dt*(np.copy(NOAH.runsf)+np.copy(NOAH.runsb)) #mm 
-  tmp['prcp'] = NOAH.dt*np.copy(NOAH.prcp) #mm
-  tmp['trad'] = np.copy(NOAH.trad) #K
-  tmp['stc'] = np.copy(NOAH.stc[:,3]) #K
-  tmp['tv'] = np.copy(NOAH.tv) #K
-  tmp['salb'] = np.copy(NOAH.salb) 
-  tmp['wtd'] = np.copy(NOAH.zwt) #m
+  tmp['smc'] = NOAH.smc #m3/m3
+  tmp['g'] = NOAH.ssoil #W/m2
+  tmp['sh'] = NOAH.fsh #W/m2
+  tmp['lh'] = self.scratch('lh',NOAH.fcev)
+  np.add(NOAH.fcev,NOAH.fgev,out=tmp['lh'])
+  np.add(tmp['lh'],NOAH.fctr,out=tmp['lh']) #W/m2
+  tmp['qbase'] = np.multiply(NOAH.dt,NOAH.runsb,out=self.scratch('qbase',NOAH.runsb)) #mm
+  tmp['qsurface'] = np.multiply(NOAH.dt,NOAH.runsf,out=self.scratch('qsurface',NOAH.runsf)) #mm
+  tmp['runoff'] = self.scratch('runoff',NOAH.runsf)
+  np.add(NOAH.runsf,NOAH.runsb,out=tmp['runoff'])
+  np.multiply(NOAH.dt,tmp['runoff'],out=tmp['runoff']) #mm 
+  tmp['prcp'] = np.multiply(NOAH.dt,NOAH.prcp,out=self.scratch('prcp',NOAH.prcp)) #mm
+  tmp['trad'] = NOAH.trad #K
+  tmp['stc'] = NOAH.stc[:,3] #K
+  tmp['tv'] = NOAH.tv #K
+  tmp['salb'] = NOAH.salb 
+  tmp['wtd'] = NOAH.zwt #m
   #tmp['totsmc'] = np.sum(NOAH.sldpth*NOAH.smc,axis=1)/np.sum(NOAH.sldpth[0]) #m3/m3
-  tmp['hdiv'] = np.copy(NOAH.hdiv)
+  tmp['hdiv'] = NOAH.hdiv
 
+  #Soil moisture diagnostics (only when requested)
+  vars = self.metadata['output']['vars']
   # root zone
-  cs = np.cumsum(NOAH.sldpth[0,:])
-  mask = cs <= 0.5
-  pct = NOAH.sldpth[0,mask]/np.sum(NOAH.sldpth[0,mask])
-  tmp['smc_root'] = np.sum(pct*NOAH.smc[:,mask],axis=1) #m3/m3
+  if 'smc_root' in vars:
+   smc = NOAH.smc[:,0:self.root_layers]
+   layers = np.multiply(self.root_pct,smc,out=self.scratch('smc_root_layers',smc))
+   tmp['smc_root'] = np.sum(layers,axis=1,out=self.scratch('smc_root',NOAH.zwt)) #m3/m3
   # top soil layer
-  tmp['smc1'] = np.copy(NOAH.smc[:,0])
+  if 'smc1' in vars:
+   tmp['smc1'] = NOAH.smc[:,0]
   # total soil moisture / soil water storage -- only until depth to bedrock
-  dl = [ np.argmin(np.abs(cs-self.m[i])) for i in range(self.nhru)]
-  tmp['totsmc'] = [ np.sum(NOAH.sldpth[i,:dl[i]]*NOAH.smc[i,:dl[i]])/np.sum(NOAH.sldpth[i,:dl[i]])  for i in range(self.nhru)]
-  
- 
+  if 'totsmc' in vars:
+   layers = self.scratch('totsmc_layers',self.bedrock_sldpth)
+   np.copyto(layers,NOAH.smc) #(memory layout of bedrock_sldpth)
+   np.multiply(self.bedrock_sldpth,layers,out=layers)
+   tmp['totsmc'] = np.sum(layers,axis=1,out=self.scratch('totsmc',self.bedrock_depth))
+   np.divide(tmp['totsmc'],self.bedrock_depth,out=tmp['totsmc']) #m3/m3
+
   #Dynamic TOPMODEL
   if self.subsurface_module == 'dtopmodel':
    TOPMODEL = self.dtopmodel
-   tmp['swd'] = np.copy(10**3*TOPMODEL.si) #mm
-   tmp['qout_subsurface'] = np.copy(TOPMODEL.qout) #m2/s
-   tmp['qout_surface'] = np.copy(TOPMODEL.qout_surface) #m2/s
-   tmp['sstorage'] = np.copy(TOPMODEL.storage_surface)
+   tmp['swd'] = np.multiply(10**3,TOPMODEL.si,out=self.scratch('swd',TOPMODEL.si)) #mm
+   tmp['qout_subsurface'] = TOPMODEL.qout #m2/s
+   tmp['qout_surface'] = TOPMODEL.qout_surface #m2/s
+   tmp['sstorage'] = TOPMODEL.storage_surface
 
   #General
-  tmp['errwat'] = np.copy(HB.errwat)
+  tmp['errwat'] = HB.errwat
 
   # Water Management
   if self.hwu.hwu_agric_flag == True:
-   tmp['demand_agric'] = np.copy(HWU.demand_agric)*NOAH.dt       #m
-   tmp['deficit_agric'] = np.copy(HWU.deficit_agric)*NOAH.dt     #m
-   tmp['irrig_agric'] = np.copy(HWU.irrigation)*(NOAH.dt/1000.0)   #m
+   for var in ['demand_agric','deficit_agric']:
+    tmp[var] = np.multiply(getattr(HWU,var),NOAH.dt,out=self.scratch(var,getattr(HWU,var))) #m
+   tmp['irrig_agric'] = np.multiply(HWU.irrigation,NOAH.dt/1000.0,out=self.scratch('irrig_agric',HWU.irrigation))   #m
 
   if self.hwu.hwu_flag == True:
-   if self.hwu.hwu_indust_flag == True:
-     tmp['demand_indust'] = np.copy(HWU.demand_indust)*NOAH.dt #m
-     tmp['deficit_indust'] = np.copy(HWU.deficit_indust)*NOAH.dt #m
-     tmp['alloc_indust'] = np.copy(HWU.demand_indust-HWU.deficit_indust)*NOAH.dt #m
-   if self.hwu.hwu_domest_flag == True:
-     tmp['demand_domest'] = np.copy(HWU.demand_domest)*NOAH.dt #m
-     tmp['deficit_domest'] = np.copy(HWU.deficit_domest)*NOAH.dt #m
-     tmp['alloc_domest'] = np.copy(HWU.demand_domest-HWU.deficit_domest)*NOAH.dt #m
-   if self.hwu.hwu_lstock_flag == True:
-     tmp['demand_lstock'] = np.copy(HWU.demand_lstock)*NOAH.dt #m
-     tmp['deficit_lstock'] = np.copy(HWU.deficit_lstock)*NOAH.dt #m
-     tmp['alloc_lstock'] = np.copy(HWU.demand_lstock-HWU.deficit_lstock)*NOAH.dt #m
+   for (sector,flag) in [('indust',HWU.hwu_indust_flag),('domest',HWU.hwu_domest_flag),('lstock',HWU.hwu_lstock_flag)]:
+    if flag == False: continue
+    demand = getattr(HWU,'demand_%s' % sector)
+    deficit = getattr(HWU,'deficit_%s' % sector)
+    tmp['demand_%s' % sector] = np.multiply(demand,NOAH.dt,out=self.scratch('demand_%s' % sector,demand)) #m
+    tmp['deficit_%s' % sector] = np.multiply(deficit,NOAH.dt,out=self.scratch('deficit_%s' % sector,deficit)) #m
+    alloc = np.subtract(demand,deficit,out=self.scratch('alloc_%s' % sector,demand))
+    tmp['alloc_%s' % sector] = np.multiply(alloc,NOAH.dt,out=alloc) #m
    if self.hwu.hwu_sf_flag == True:
-     tmp['alloc_sf'] = np.copy(HWU.alloc_sf) #m
-   if self.hwu.hwu_gw_flag == True:                                                                                              tmp['alloc_gw'] = np.copy(HWU.alloc_gw) #m
-
-  #Output the variables
-  for var in self.metadata['output']['vars']:
-   grp.variables[var][itime,:] = tmp[var][:]
+     tmp['alloc_sf'] = HWU.alloc_sf #m
+   if self.hwu.hwu_gw_flag == True:                                                                                              tmp['alloc_gw'] = HWU.alloc_gw #m
+
+  #Split the hrus by ensemble member
+  if self.nens > 1:
+   for var in tmp:
+    if np.ndim(tmp[var]) > 0: tmp[var] = tmp[var].reshape((self.nens,self.nhru_catchment) + tmp[var].shape[1:])
+
+  #Stage the variables (written to the file once the buffer is full)
+  if self.output_frequency == 'dt':
+   tmp['date'] = nc.date2num(date,units=self.output_date_units,calendar=self.output_date_calendar)
+   self.output_buffer.stage(itime,tmp)
+  else:
+   #Accumulate over the output period and only stage the aggregated record
+   if self.output_aggregator.count == 0: self.output_period = date
+   self.output_aggregator.accumulate(tmp)
+   next_date = date + self.dt_timedelta
+   if (next_date >= self.fdate) or (self.output_record(next_date) != self.output_record(date)):
+    record = self.output_aggregator.record()
+    record['date'] = nc.date2num(self.output_period,units=self.output_date_units,calendar=self.output_date_calendar)
+    self.output_buffer.stage(self.output_record(date),record)
 
 
   return
 
+ def output_record(self,date):
+
+  #Output record that holds this date
+  if self.output_frequency == 'daily':
+   return (date.date() - self.idate.date()).days
+  elif self.output_frequency == 'monthly':
+   return 12*(date.year - self.idate.year) + date.month - self.idate.month
+  else:
+   return int((date - self.idate).total_seconds()/self.dt)
+
+ def output_chunksizes(self,var,dims,ntime,nhru):
+
+  #Explicit chunk shape for this variable
+  chunksizes = self.metadata['output'].get('chunksizes',{})
+  if var in chunksizes: return tuple(chunksizes[var])
+
+  #Chunks of ~1 MB for time series reads (long time, few hrus) or map reads (all hrus)
+  chunking = self.metadata['output'].get('chunking','default')
+  nsoil = 1
+  if 'soil' in dims: nsoil = self.nsoil
+  if chunking == 'timeseries':
+   #(the time extent is a few output buffers, aligned with them, so that a chunk is
+   #completed by a few flushes instead of being rewritten by every flush of the segment)
+   buffer_size = self.output_buffer_size()
+   nt = max(1,min(ntime,4*buffer_size,2**18//nsoil))
+   if nt > buffer_size: nt = buffer_size*(nt//buffer_size)
+   nh = max(1,min(nhru,2**18//(nt*nsoil)))
+  elif chunking == 'map':
+   nt = 1
+   nh = nhru
+  else:
+   return None
+  chunks = (nt,nh)
+  if 'ensemble' in dims: chunks = (nt,1,nh)
+  if 'soil' in dims: return chunks + (nsoil,)
+  else: return chunks
+
+ def output_buffer_size(self,):
+
+  #Number of output records staged before each write (a day of time steps by default)
+  return self.metadata['output'].get('buffer_size',int(86400/self.dt))
+
  def create_netcdf_file(self,):
 
+  #(called with pyIO.lock.hdf5_lock held)
+
   #Create the output directory if necessary
   os.system('mkdir -p %s' % self.metadata['output']['dir'])
 
@@ -787,7 +1222,7 @@ class HydroBlocks:
              'demand_agric':{'description':'Irrigation water demand','units':'m','dims':('time','hru',),'precision':4},
              'deficit_agric':{'description':'Irrigation water deficit','units':'m','dims':('time','hru',),'precision':4},
              'irrig_agric':{'description':'Irrigated water volume','units':'m','dims':('time','hru',),'precision':4},
-             'demand_indust':{'description':'Industrial water demand','units':'m','dims':('time','hru',)},'precision':4,
+             'demand_indust':{'description':'Industrial water demand','units':'m','dims':('time','hru',),'precision':4},
              'deficit_indust':{'description':'Industrial water deficit','units':'m','dims':('time','hru',),'precision':4},
              'alloc_indust':{'description':'Industrial water allocated','units':'m','dims':('time','hru',),'precision':4},
              'demand_domest':{'description':'Domestic demand','units':'m','dims':('time','hru',),'precision':4},
@@ -802,19 +1237,36 @@ class HydroBlocks:
 
   #Create the dimensions
   print('Creating the dimensions')
-  ntime = 24*3600*((self.fdate - self.idate).days)/self.dt
+  ntime = self.output_record(self.fdate - self.dt_timedelta) + 1
   nhru = len(fp_in.dimensions['hsu'])
   fp_out.createDimension('hru',nhru)
   fp_out.createDimension('time',ntime)
   fp_out.createDimension('soil',self.nsoil)
+  if self.nens > 1: fp_out.createDimension('ensemble',self.nens)
+
+  #Compression (least_significant_digit quantizes the data so that zlib pays off)
+  compression = self.metadata['output'].get('compression',{})
+  zlib = compression.get('zlib',False)
+  complevel = compression.get('complevel',4)
+  shuffle = compression.get('shuffle',True)
 
   #Create the output
   print('Creating the data group')
   grp = fp_out.createGroup('data')
   for var in self.metadata['output']['vars']:
-   ncvar = grp.createVariable(var,'f4',metadata[var]['dims'],least_significant_digit=metadata[var]['precision'])#,zlib=True)
+   dims = metadata[var]['dims']
+   if self.nens > 1: dims = ('time','ensemble') + dims[1:]
+   chunksizes = self.output_chunksizes(var,dims,ntime,nhru)
+   ncvar = grp.createVariable(var,'f4',dims,least_significant_digit=metadata[var]['precision'],
+                              zlib=zlib,complevel=complevel,shuffle=shuffle,chunksizes=chunksizes)
+   if chunksizes is not None:
+    #Hold all the chunks that a buffered [t0:t1,...] write touches (up to 64 MB)
+    nbytes = 4*chunksizes[0]*np.prod([len(fp_out.dimensions[dim]) for dim in dims[1:]])
+    ncvar.set_var_chunk_cache(size=int(min(nbytes,2**26)))
    ncvar.description = metadata[var]['description']
    ncvar.units = metadata[var]['units']
+   if self.output_frequency != 'dt':
+    ncvar.aggregation = '%s %s' % (self.output_frequency,self.output_aggregation[var])
 
   #Create the metadata
   print('Creating the metadata group')
@@ -843,57 +1295,240 @@ class HydroBlocks:
   for value in range(nhru):hrus.append(value)
   hru[:] = np.array(hrus)
   hru.description = 'hru ids'
+  #Ensemble members
+  if self.nens > 1:
+   print('Defining the ensemble members')
+   ens = grp.createVariable('ensemble','i4',('ensemble',))
+   ens[:] = np.arange(self.nens)
+   ens.description = 'ensemble member ids'
+   for var in self.ensemble_parameters:
+    factors = grp.createVariable('factor_%s' % var,'f8',('ensemble',))
+    factors[:] = self.ensemble_parameters[var][::self.nhru_catchment]
+    factors.description = 'ensemble factors of the parameter %s' % var
+   for var in self.ensemble_forcing:
+    factors = grp.createVariable('factor_forcing_%s' % var,'f8',('ensemble',))
+    factors[:] = self.ensemble_forcing[var][::self.nhru_catchment]
+    factors.description = 'ensemble factors of the forcing %s' % var
+
+  #Initialize the output buffer
+  self.initialize_output_writer()
 
   return
 
- def finalize(self,):
+ def open_netcdf_file(self,):
+
+  #Reopen the output file of the segment to continue writing it (resume from a checkpoint)
+  from pyIO.lock import hdf5_lock
+  ofile = '%s/%s.nc' % (self.metadata['output']['dir'],self.idate.strftime('%Y-%m-%d'))
+  with hdf5_lock:
+   self.output_fp = nc.Dataset(ofile,'a')
+   self.initialize_output_writer()
+
+  return
+
+ def initialize_output_writer(self,):
+
+  fp_out = self.output_fp
+  dates = fp_out.groups['metadata'].variables['date']
+  self.output_date_units = dates.units
+  self.output_date_calendar = dates.calendar
+
+  #Initialize the output buffer
+  from pyIO.output import Output_Buffer
+  variables = {'date':dates}
+  for var in self.metadata['output']['vars']:
+   variables[var] = fp_out.groups['data'].variables[var]
+  buffer_size = self.output_buffer_size()
+  asynchronous = self.metadata['output'].get('async_flush',False)
+  queue_size = self.metadata['output'].get('queue_size',2)
+  self.output_buffer = Output_Buffer(variables,buffer_size,asynchronous,queue_size)
+
+  #Initialize the temporal aggregation
+  if self.output_frequency != 'dt':
+   from pyIO.output import Output_Aggregator
+   shapes = {}
+   for var in self.metadata['output']['vars']:
+    shapes[var] = fp_out.groups['data'].variables[var].shape[1:]
+   self.output_aggregator = Output_Aggregator(shapes,self.output_aggregation)
+
+  return
+
+ def rollover(self,info,restart=True):
+
+  #Move to the next segment (info['idate'] to info['fdate']) keeping the model in
+  #memory; only the output file is rotated (and the restart written if requested)
+  if info['idate'] != self.fdate:
+   exit('Error: The next segment must start at %s' % self.fdate.strftime('%Y-%m-%d'))
+  self.finalize_segment(restart)
+
+  #Define the new segment
+  self.segment_information(info)
+  self.itime = 0
+
+  #The diagnostics start from zero in each segment
+  for var in ['dE','r','dr','et','etran','esoil','ecan','prcp','q','errwat','erreng']: setattr(self,var,0.0)
+
+  #Point the forcing readers to the new segment (the restart is still being written
+  #in the background; initialize_forcing and create_netcdf_file hold the hdf5 lock)
+  self.initialize_forcing()
+
+  return
+
+ def finalize_segment(self,restart=True):
+
+  #Save the restart file
+  if restart: self.save_restart()
+
+  #Checkpoint the end of the segment (a resumed run starts with the next segment)
+  if self.checkpoint_interval is not None: self.save_checkpoint(self.fdate)
+
+  #Stop the forcing readers
+  self.meteorology.close()
+  self.water_use.close()
+
+  #Write the remaining output
+  self.output_buffer.close()
+  print('Output writer: %d flushes, max backlog %d buffers, blocked %.4f s, drain %.4f s' % (
+        self.output_buffer.nflush,self.output_buffer.max_backlog,
+        self.output_buffer.blocked_time,self.output_buffer.drain_time))
+
+  #Dump the per phase timing
+  self.profiler.count('bytes_read',self.meteorology.bytes_read + self.water_use.bytes_read)
+  self.profiler.count('bytes_written',self.output_buffer.bytes_written)
+  self.profiler.count('forcing_wait_time',self.meteorology.wait_time + self.water_use.wait_time)
+  self.profiler.count('output_blocked_time',self.output_buffer.blocked_time + self.output_buffer.drain_time)
+  self.profiler.dump(self.profiler_file,total=getattr(self,'run_time',None),nhru=self.nhru,
+                     nsteps=self.itime,subsurface_module=self.subsurface_module,ncores=self.ncores)
+
+  #Close the output file (the restart and checkpoint writers may still be writing)
+  from pyIO.lock import hdf5_lock
+  with hdf5_lock: self.output_fp.close()
+
+  return
+
+ def save_restart(self,):
 
   #Create the restart directory if necessary
   os.system('mkdir -p %s' % self.metadata['restart']['dir'])
 
-  #Save the restart file
+  #Save the restart file (packed into a single record and written in the background)
+  from pyIO.restart import Restart_Writer,NOAHMP_STATE
   file_restart = '%s/%s.h5' % (self.metadata['restart']['dir'],self.fdate.strftime('%Y-%m-%d'))
-  fp = h5py.File(file_restart,'w')
-  fp['smceq'] = self.noahmp.smceq[:]
-  fp['albold'] = self.noahmp.albold[:]
-  fp['sneqvo'] = self.noahmp.sneqvo[:]
-  fp['stc'] = self.noahmp.stc[:]
-  fp['sh2o'] = self.noahmp.sh2o[:]
-  fp['smc'] = self.noahmp.smc[:]
-  fp['tah'] = self.noahmp.tah[:]
-  fp['eah'] = self.noahmp.eah[:]
-  fp['fwet'] = self.noahmp.fwet[:]
-  fp['canliq'] = self.noahmp.canliq[:]
-  fp['canice'] = self.noahmp.canice[:]
-  fp['tv'] = self.noahmp.tv[:]
-  fp['tg'] = self.noahmp.tg[:]
-  fp['qsfc1d'] = self.noahmp.qsfc1d[:]
-  fp['qsnow'] = self.noahmp.qsnow[:]
-  fp['isnow'] = self.noahmp.isnow[:]
-  fp['zsnso'] = self.noahmp.zsnso[:]
-  fp['sndpth'] = self.noahmp.sndpth[:]
-  fp['swe'] = self.noahmp.swe[:]
-  fp['snice'] = self.noahmp.snice[:]
-  fp['snliq'] = self.noahmp.snliq[:]
-  fp['zwt'] = self.noahmp.zwt[:]
-  fp['wa'] = self.noahmp.wa[:]
-  fp['wt'] = self.noahmp.wt[:]
-  fp['wslake'] = self.noahmp.wslake[:]
-  fp['lfmass'] = self.noahmp.lfmass[:]
-  fp['rtmass'] = self.noahmp.rtmass[:]
-  fp['stmass'] = self.noahmp.stmass[:]
-  fp['wood'] = self.noahmp.wood[:]
-  fp['stblcp'] = self.noahmp.stblcp[:]
-  fp['fastcp'] = self.noahmp.fastcp[:]
-  fp['plai'] = self.noahmp.plai[:]
-  fp['psai'] = self.noahmp.psai[:]
-  fp['cm'] = self.noahmp.cm[:]
-  fp['ch'] = self.noahmp.ch[:]
-  fp['tauss'] = self.noahmp.tauss[:]
-  fp['smcwtd'] = self.noahmp.smcwtd[:]
-  fp['deeprech'] = self.noahmp.deeprech[:]
-  fp['rech'] = self.noahmp.rech[:]
-  fp.close()
+  if self.restart_writer is None:
+   compression = self.metadata['restart'].get('compression',None) #gzip level
+   if compression is True: compression = 4
+   if compression is False: compression = None
+   self.restart_writer = Restart_Writer(compression,self.metadata['restart'].get('async',True))
+  state = {}
+  for var in NOAHMP_STATE: state[var] = getattr(self.noahmp,var)
+  self.restart_writer.save(file_restart,state)
+
+  return
+
+ def checkpoint_state(self,):
+
+  #Everything needed to continue the run exactly from the current time step
+  from pyIO.restart import NOAHMP_STATE,NOAHMP_CHECKPOINT,Collect_State
+  state = {}
+  scalars = {}
+  for var in NOAHMP_STATE + NOAHMP_CHECKPOINT: state['noahmp/%s' % var] = getattr(self.noahmp,var)
+  for var in ['beg_wb','end_wb','dzwt0']: state['hydroblocks/%s' % var] = getattr(self,var)
+  for var in ['dE','r','dr','et','etran','esoil','ecan','prcp','q','errwat','erreng']:
+   scalars['hydroblocks/%s' % var] = float(getattr(self,var))
+  if self.subsurface_module == 'dtopmodel': Collect_State(self.dtopmodel,'dtopmodel',state,scalars)
+  if self.subsurface_module == 'richards': Collect_State(self.richards,'richards',state,scalars)
+  if self.hwu.hwu_flag == True: Collect_State(self.hwu,'hwu',state,scalars,ndim=1)
+  if (self.output_frequency != 'dt') and hasattr(self,'output_aggregator'):
+   for var in self.output_aggregator.accumulators:
+    state['output_aggregator/%s' % var] = self.output_aggregator.accumulators[var]
+
+  return (state,scalars)
+
+ def restore_state(self,state,scalars):
+
+  #Copy a state of checkpoint_state back into the model
+  from pyIO.restart import Scatter_State
+  for key in state:
+   (group,var) = key.split('/',1)
+   if group == 'noahmp': getattr(self.noahmp,var)[...] = state[key]
+   elif group == 'hydroblocks': getattr(self,var)[...] = state[key]
+  for key in scalars:
+   (group,var) = key.split('/',1)
+   if group == 'hydroblocks': setattr(self,var,scalars[key])
+  if self.subsurface_module == 'dtopmodel': Scatter_State(self.dtopmodel,'dtopmodel',state,scalars)
+  if self.subsurface_module == 'richards': Scatter_State(self.richards,'richards',state,scalars)
+  if self.hwu.hwu_flag == True: Scatter_State(self.hwu,'hwu',state,scalars)
+
+  return
+
+ def save_checkpoint(self,date):
+
+  from pyIO.restart import Restart_Writer
+  from pyIO.lock import hdf5_lock
+
+  #Make sure the output file holds all the time steps up to the checkpoint
+  self.output_buffer.sync()
+  with hdf5_lock: self.output_fp.sync()
+
+  #Save the state (written in the background)
+  os.system('mkdir -p %s' % self.checkpoint_dir)
+  if self.checkpoint_writer is None: self.checkpoint_writer = Restart_Writer(None,True)
+  (state,scalars) = self.checkpoint_state()
+  attributes = {'date':date.strftime('%Y-%m-%d %H:%M:%S'),
+                'idate':self.idate.strftime('%Y-%m-%d %H:%M:%S'),
+                'fdate':self.fdate.strftime('%Y-%m-%d %H:%M:%S'),
+                'itime':self.itime,
+                'scalars':scalars}
+  if (self.output_frequency != 'dt') and hasattr(self,'output_aggregator'):
+   attributes['output_aggregator'] = {'count':self.output_aggregator.count}
+   if self.output_aggregator.count > 0:
+    attributes['output_aggregator']['period'] = self.output_period.strftime('%Y-%m-%d %H:%M:%S')
+  file = '%s/checkpoint_%s.h5' % (self.checkpoint_dir,date.strftime('%Y-%m-%d_%H%M%S'))
+  self.checkpoint_writer.save(file,state,attributes)
+
+  #Remove the older checkpoints (the previous one is complete once save returns)
+  files = sorted([f for f in os.listdir(self.checkpoint_dir) if f.startswith('checkpoint_') and f.endswith('.h5')])
+  files = [f for f in files if f != os.path.basename(file)]
+  for f in files[0:max(len(files)-(self.checkpoint_keep-1),0)]:
+   os.remove('%s/%s' % (self.checkpoint_dir,f))
+
+  return
+
+ def resume(self,file):
+
+  #Continue the segment from a checkpoint (taken within this segment or at its start)
+  from pyIO.restart import Read_Restart
+  (state,attributes) = Read_Restart(file,attributes=True)
+  date = datetime.datetime.strptime(attributes['date'],'%Y-%m-%d %H:%M:%S')
+  if (date < self.idate) or (date >= self.fdate):
+   exit('Error: The checkpoint %s is not within the segment' % file)
+  print("Resuming from %s" % file)
+
+  #Restore the state
+  self.restore_state(state,attributes['scalars'])
+  self.itime = int(round((date - self.idate).total_seconds()/self.dt))
+
+  #Continue writing the output file (the records after the checkpoint are overwritten)
+  if self.itime > 0:
+   self.open_netcdf_file()
+   if self.output_frequency != 'dt':
+    info = attributes.get('output_aggregator',{'count':0})
+    for var in self.output_aggregator.accumulators:
+     self.output_aggregator.accumulators[var][...] = state['output_aggregator/%s' % var]
+    self.output_aggregator.count = info['count']
+    if info['count'] > 0:
+     self.output_period = datetime.datetime.strptime(info['period'],'%Y-%m-%d %H:%M:%S')
+
+  return
+
+ def finalize(self,):
+
+  #Finalize the last segment
+  self.finalize_segment()
+
+  #Wait for the restart and checkpoint files to be written
+  if self.restart_writer is not None: self.restart_writer.wait()
+  if self.checkpoint_writer is not None: self.checkpoint_writer.wait()
    
   #Close the LSM
   self.noahmp.finalize()
@@ -904,8 +1539,7 @@ class HydroBlocks:
    if self.mkl_flag: self.dtopmodel.dtt.finalize()
    del self.dtopmodel
 
-  #Close the files
+  #Close the input file
   self.input_fp.close()
-  self.output_fp.close()
 
   return
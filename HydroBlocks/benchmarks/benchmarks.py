@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import platform
+import resource
+import subprocess
+import numpy as np
+import netCDF4 as nc
+import scipy.sparse as sparse
+
+#End-to-end performance benchmark of HydroBlocks on synthetic catchments. The input
+#files follow the layout written by Preprocessing.py (metadata, parameters,
+#meteorology, water_use, flow_matrix, wmatrix and outlet groups) so no external
+#data are needed. Each case runs in its own process and the timings of
+#initialize/run/finalize, the per phase profile and the peak memory are written
+#to a json file so that regressions can be tracked between commits.
+#
+#python benchmarks.py --nhru 100 1000 10000 50000 --output results.json
+
+dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('%s/../' % dir)
+
+def Create_Synthetic_Catchment(file,nhru,idate,fdate,dt,hwu=False,seed=1):
+
+ np.random.seed(seed)
+ fp = nc.Dataset(file,'w',format='NETCDF4')
+
+ #Dates of the forcing (one extra time step as in Preprocessing.py)
+ dates = []
+ date = idate
+ while date <= fdate:
+  dates.append(date)
+  date = date + datetime.timedelta(seconds=dt)
+ dates = np.array(dates)
+ ntime = dates.size
+ fp.createDimension('hsu',nhru)
+ fp.createDimension('time',ntime)
+
+ #Metadata
+ dx = 30.0
+ grp = fp.createGroup('metadata')
+ grp.latitude = 35.0
+ grp.longitude = 275.0
+ grp.dx = dx
+
+ #Drainage network (each hru drains into one or two of the previous ten hrus and hru 0
+ #drains into the outlet, which is stored as an extra column as in Preprocessing.py)
+ rows = [0,]
+ cols = [nhru,]
+ vals = [1.0,]
+ for i in range(1,nhru):
+  ndst = min(i,np.random.randint(1,3))
+  dst = np.random.choice(np.arange(max(0,i-10),i),ndst,replace=False)
+  w = np.random.uniform(0.2,1.0,ndst)
+  rows += [i,]*ndst
+  cols += list(dst)
+  vals += list(w/np.sum(w))
+ flow_matrix = sparse.csr_matrix((vals,(rows,cols)),shape=(nhru,nhru+1),dtype=np.float64)
+ flow_matrix.sort_indices()
+
+ #Width of the connections between neighbouring hrus (m)
+ wmatrix = flow_matrix[:,0:nhru].tocsr()
+ wmatrix.data[:] = dx*np.random.randint(1,20,wmatrix.data.size)
+ wmatrix = sparse.csr_matrix(wmatrix + wmatrix.T)
+ wmatrix.sort_indices()
+
+ #Area (m2) and contributing area (m2)
+ area = dx**2*np.random.randint(10,1000,nhru).astype(np.float64)
+ carea = np.copy(area)
+ for i in range(nhru-1,0,-1):
+  (i0,i1) = (flow_matrix.indptr[i],flow_matrix.indptr[i+1])
+  carea[flow_matrix.indices[i0:i1]] += flow_matrix.data[i0:i1]*carea[i]
+
+ for (name,matrix) in [('flow_matrix',flow_matrix),('wmatrix',wmatrix)]:
+  grp = fp.createGroup(name)
+  grp.createDimension('connections_columns',matrix.indices.size)
+  grp.createDimension('connections_rows',matrix.indptr.size)
+  grp.createVariable('data','f4',('connections_columns',))
+  grp.createVariable('indices','f4',('connections_columns',))
+  grp.createVariable('indptr','f4',('connections_rows',))
+  grp.variables['data'][:] = matrix.data
+  grp.variables['indices'][:] = matrix.indices
+  grp.variables['indptr'][:] = matrix.indptr
+
+ #Outlet (a single outlet that receives the flow of hru 0)
+ grp = fp.createGroup('outlet')
+ full = grp.createGroup('full')
+ full.createDimension('cell',1)
+ for var in ['i','j','hru_org','hru_dst','d8']:
+  full.createVariable(var,'i4',('cell',))
+ full.variables['hru_dst'][:] = nhru
+ summary = grp.createGroup('summary')
+ summary.createDimension('hru',1)
+ for var in ['hru_org','hru_dst','counts']:
+  summary.createVariable(var,'i4',('hru',))
+ summary.variables['hru_org'][:] = 0
+ summary.variables['hru_dst'][:] = nhru
+ summary.variables['counts'][:] = 1
+
+ #Parameters (loam soil, grassland/cropland/forest)
+ slope = np.random.uniform(0.001,0.2,nhru)
+ dem = 100.0 + np.cumsum(np.random.uniform(0.0,0.5,nhru))
+ parameters = {
+  'slope':slope,
+  'area_pct':100*area/np.sum(area),
+  'land_cover':np.random.choice([5,10,12,13],nhru),
+  'channel':(carea > 10**6).astype(np.float64),
+  'dem':dem,
+  'soil_texture_class':6*np.ones(nhru),
+  'ti':np.log(carea/dx/np.tan(slope)),
+  'carea':carea,
+  'area':area,
+  'BB':np.random.uniform(4.0,6.0,nhru),
+  'F11':-0.327*np.ones(nhru),
+  'SATPSI':np.random.uniform(0.2,0.5,nhru),
+  'SATDW':1.43e-5*np.ones(nhru),
+  'QTZ':0.4*np.ones(nhru),
+  'clay':np.random.uniform(5.0,40.0,nhru),
+  'WLTSMC':0.066*np.ones(nhru),
+  'MAXSMC':np.random.uniform(0.4,0.48,nhru),
+  'DRYSMC':0.066*np.ones(nhru),
+  'REFSMC':np.random.uniform(0.28,0.33,nhru),
+  'SATDK':10**np.random.uniform(-6,-5,nhru),
+  'mannings':np.where(carea >= 10**5,0.03,0.15),
+  'm':np.random.uniform(0.5,2.0,nhru),
+  'psoil':np.ones(nhru),
+  'pksat':np.ones(nhru),
+  'sdmax':5.0*np.ones(nhru),
+  'hand':dem - np.min(dem),
+  'centroid_lats':35.0 + np.random.uniform(0.0,0.05,nhru),
+  'centroid_lons':-85.0 + np.random.uniform(0.0,0.05,nhru),
+  'irrig_land':np.random.randint(0,2,nhru),
+  'start_growing_season':4*np.ones(nhru),
+  'end_growing_season':9*np.ones(nhru),
+  }
+ grp = fp.createGroup('parameters')
+ for var in parameters:
+  grp.createVariable(var,'f4',('hsu',))
+  grp.variables[var][:] = parameters[var]
+ if hwu == True:
+  grp.createVariable('hru_min_dist','f4',('hsu','hsu'))
+  grp.variables['hru_min_dist'][:] = np.random.uniform(0.1,5.0,(nhru,nhru))
+
+ #Meteorology (diurnal cycle and intermittent storms)
+ hours = np.array([date.hour for date in dates])[:,np.newaxis]
+ diurnal = np.maximum(np.sin(np.pi*(hours - 6)/12.0),0.0)
+ noise = np.random.uniform(0.9,1.1,(1,nhru))
+ storm = (np.random.uniform(0.0,1.0,(ntime,1)) > 0.9)
+ meteorology = {
+  'lwdown':300.0 + 50*diurnal*noise,
+  'swdown':800.0*diurnal*noise,
+  'psurf':95000.0*np.ones((1,nhru)) + np.zeros((ntime,1)),
+  'wind':2.0 + 2*diurnal*noise,
+  'tair':285.0 + 8*diurnal*noise,
+  'spfh':0.008*np.ones((1,nhru)) + np.zeros((ntime,1)),
+  'precip':storm*np.random.uniform(0.0,5e-3,(ntime,1))*noise,
+  }
+ grp = fp.createGroup('meteorology')
+ for var in meteorology:
+  grp.createVariable(var,'f4',('time','hsu'))
+  grp.variables[var][:] = meteorology[var]
+ var = grp.createVariable('time','f8',('time',))
+ var.units = 'hours since %4d-01-01' % idate.year
+ var.calendar = 'standard'
+ var[:] = nc.date2num(dates,units=var.units,calendar=var.calendar)
+
+ #Water use (m/s)
+ grp = fp.createGroup('water_use')
+ if hwu == True:
+  for var in ['industrial','domestic','livestock']:
+   grp.createVariable(var,'f4',('time','hsu'))
+   grp.variables[var][:] = 1e-9*np.ones((ntime,1))*noise
+  var = grp.createVariable('time','f8',('time',))
+  var.units = 'hours since %4d-01-01' % idate.year
+  var.calendar = 'standard'
+  var[:] = nc.date2num(dates,units=var.units,calendar=var.calendar)
+
+ fp.close()
+
+ return
+
+def Create_Metadata(workspace,input_file,subsurface_module,hwu,ncores,dt,idate,fdate):
+
+ #Model configuration of a benchmark case (the agriculture demand is left out as it
+ #requires crop calendars)
+ metadata = {
+  'dt':dt,
+  'dz':[0.05,0.05,0.1,0.1,0.2,0.2,0.3,0.3,0.35,0.35],
+  'ncores':ncores,
+  'idate':idate,
+  'fdate':fdate,
+  'mkl_flag':False,
+  'input_file':input_file,
+  'surface_flow_flag':True,
+  'subsurface_module':subsurface_module,
+  'water_management':{'hwu_flag':hwu,'hwu_gw_flag':hwu,'hwu_sf_flag':hwu,
+                      'hwu_agric_flag':False,'hwu_domest_flag':hwu,
+                      'hwu_indust_flag':hwu,'hwu_lstock_flag':hwu},
+  'output':{'dir':'%s/output' % workspace,
+            'vars':['smc','lh','sh','g','trad','runoff','prcp','wtd','totsmc','smc_root']},
+  'restart':{'dir':'%s/restart' % workspace,'flag':False},
+  'profiling':{'enabled':True,'file':'%s/profile.json' % workspace},
+  }
+
+ return metadata
+
+def Run_Case(case_file):
+
+ #Run a single case (called in a separate process)
+ import HydroBlocks
+ case = json.load(open(case_file))
+ info = case['metadata']
+ info['idate'] = datetime.datetime.strptime(info['idate'],'%Y-%m-%d')
+ info['fdate'] = datetime.datetime.strptime(info['fdate'],'%Y-%m-%d')
+ timing = {}
+ tic = time.time()
+ HB = HydroBlocks.initialize(info)
+ timing['initialize'] = time.time() - tic
+ tic = time.time()
+ HB.run(info)
+ timing['run'] = time.time() - tic
+ nsteps = HB.itime
+ tic = time.time()
+ HB.finalize()
+ timing['finalize'] = time.time() - tic
+ output = {'timing':timing,'nsteps':nsteps,
+           'max_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0}
+ if os.path.exists(info['profiling']['file']):
+  output['profile'] = json.load(open(info['profiling']['file']))
+ json.dump(output,open(case['result'],'w'),indent=1)
+
+ return
+
+def Commit():
+
+ #Commit of the tree being benchmarked
+ try:
+  return subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=dir,
+                                 stderr=subprocess.STDOUT).decode().strip()
+ except Exception:
+  return 'unknown'
+
+def Run_Benchmarks(args):
+
+ idate = datetime.datetime(2004,1,1)
+ fdate = idate + datetime.timedelta(days=args.days)
+ os.system('mkdir -p %s' % args.workspace)
+ results = {'commit':Commit(),
+            'date':datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'host':platform.node(),
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'ncores':args.ncores,
+            'days':args.days,
+            'dt':args.dt,
+            'cases':[]}
+
+ for nhru in args.nhru:
+  for hwu in [False,True]:
+   #The water allocation uses dense nhru x nhru matrices
+   if (hwu == True) and ((args.no_hwu == True) or (nhru > args.max_nhru_hwu)): continue
+   input_file = '%s/input_%d_hwu%d.nc' % (args.workspace,nhru,hwu)
+   tic = time.time()
+   Create_Synthetic_Catchment(input_file,nhru,idate,fdate,args.dt,hwu)
+   tcreate = time.time() - tic
+   for subsurface_module in args.modules:
+    name = '%s_nhru%d_hwu%d' % (subsurface_module,nhru,hwu)
+    workspace = '%s/%s' % (args.workspace,name)
+    os.system('rm -rf %s' % workspace)
+    os.system('mkdir -p %s' % workspace)
+    metadata = Create_Metadata(workspace,input_file,subsurface_module,hwu,args.ncores,args.dt,
+                               idate.strftime('%Y-%m-%d'),fdate.strftime('%Y-%m-%d'))
+    case = {'metadata':metadata,'result':'%s/result.json' % workspace}
+    case_file = '%s/case.json' % workspace
+    json.dump(case,open(case_file,'w'),indent=1)
+    print('Running %s' % name,flush=True)
+    tic = time.time()
+    log = open('%s/log.txt' % workspace,'w')
+    status = subprocess.call([sys.executable,os.path.abspath(__file__),'--case',case_file],
+                             cwd='%s/../' % dir,stdout=log,stderr=subprocess.STDOUT)
+    log.close()
+    result = {'name':name,'nhru':nhru,'hwu':hwu,'subsurface_module':subsurface_module,
+              'status':'ok' if status == 0 else 'failed','wall_time':time.time() - tic,
+              'input_creation_time':tcreate}
+    if (status == 0) and os.path.exists(case['result']):
+     result.update(json.load(open(case['result'])))
+    results['cases'].append(result)
+    print(' %s %.2f s' % (result['status'],result['wall_time']),flush=True)
+    json.dump(results,open(args.output,'w'),indent=1)
+
+ return results
+
+if __name__ == '__main__':
+
+ parser = argparse.ArgumentParser(description='HydroBlocks synthetic catchment benchmark')
+ parser.add_argument('--nhru',type=int,nargs='+',default=[100,1000,10000,50000])
+ parser.add_argument('--modules',nargs='+',default=['dtopmodel','richards'])
+ parser.add_argument('--days',type=int,default=7)
+ parser.add_argument('--dt',type=float,default=3600.0)
+ parser.add_argument('--ncores',type=int,default=1)
+ parser.add_argument('--no-hwu',dest='no_hwu',action='store_true')
+ parser.add_argument('--max-nhru-hwu',dest='max_nhru_hwu',type=int,default=1000)
+ parser.add_argument('--workspace',default='/tmp/hydroblocks_benchmarks')
+ parser.add_argument('--output',default=None)
+ parser.add_argument('--case',default=None)
+ args = parser.parse_args()
+
+ if args.case is not None:
+  Run_Case(args.case)
+ else:
+  if args.output is None: args.output = 'benchmarks_%s.json' % Commit()
+  Run_Benchmarks(args)
@@ -4,6 +4,7 @@ import time
 import scipy
 import scipy.sparse
 import scipy.sparse.linalg
+from scipy.sparse import _sparsetools
 import copy
 
 class Dynamic_Topmodel:
@@ -71,6 +72,17 @@ class Dynamic_Topmodel:
   #weights
   self.flow_matrix = []
 
+  #Solver of the kinematic wave system (e.g., solvers.Topological_Solver; Sparse_Solver if None)
+  self.solver = None
+
+  #Pipelined routing (opt-in): the surface is solved on a thread with the excess runoff
+  #of the previous time step (ex1) while the subsurface is solved. It needs its own
+  #solver (the solvers have work arrays).
+  self.pipelined = False
+  self.solver_surface = None
+  self.executor = None
+  self.ex1 = np.zeros(ngroups,dtype=np.float64)
+
   #Error information
   self.water_balance_error_surface = 0
 
@@ -78,10 +90,18 @@ class Dynamic_Topmodel:
   self.storage_mask_subsurface = np.zeros(ngroups,dtype=np.int32)
   self.storage_mask_surface = np.zeros(ngroups,dtype=np.int32)
 
-  #Point to the solver
+  #Work arrays of the time step (see Work; one set per flow, which can be solved at
+  #the same time when pipelined)
+  self.work_subsurface = {}
+  self.work_surface = {}
+
+  #Point to the solver (MKL only when it was requested)
   if mkl_flag == True:
-   import dynamic_topmodel_tools as dtt
-   self.dtt = dtt
+   try:
+    import dynamic_topmodel_tools as dtt
+    self.dtt = dtt
+   except ImportError:
+    exit('Error: The mkl kinematic wave solver needs dynamic_topmodel_tools (built with MKL); use kinematic_wave_solver auto, compiled, topological or spsolve instead')
 
   #Flags
   self.surface_flow_flag = True
@@ -95,11 +115,30 @@ class Dynamic_Topmodel:
   maxntt = np.int32(1) #maximum number of sub timesteps
   isw = np.float64(0.5) #implicit scheme weight
   
-  #Update the subsurface runoff
-  if self.subsurface_flow_flag == True: self.update_subsurface(ncores,maxntt,isw)
-
-  #Update the surface runoff
-  if self.surface_flow_flag == True: self.update_surface(ncores,maxntt,isw)
+  if self.pipelined and self.subsurface_flow_flag and self.surface_flow_flag:
+
+   #The surface only uses the excess runoff as recharge, so it is routed with the
+   #excess of the previous time step while the subsurface is solved. The subsurface is
+   #unchanged and the water is conserved (the surface storage plus the outflow equals
+   #the sequential result minus dt*ex of the last time step, which is still pending),
+   #but the excess reaches the surface one time step later: the surface storages can
+   #differ by up to about dt*ex of one time step and the cumulative outflow by ~1%
+   #(unittests.py, test_pipelined_routing).
+   if self.executor is None:
+    import concurrent.futures
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+   self.ex1[:] = self.ex
+   surface = self.executor.submit(self.update_surface,ncores,maxntt,isw,self.ex1)
+   self.update_subsurface(ncores,maxntt,isw)
+   surface.result()
+
+  else:
+
+   #Update the subsurface runoff
+   if self.subsurface_flow_flag == True: self.update_subsurface(ncores,maxntt,isw)
+
+   #Update the surface runoff
+   if self.surface_flow_flag == True: self.update_surface(ncores,maxntt,isw)
 
   #Check catchment water balance
   #self.check_water_balance()
@@ -143,11 +182,13 @@ class Dynamic_Topmodel:
 
   return
 
- def update_surface(self,ncores,maxntt,isw):
+ def update_surface(self,ncores,maxntt,isw,ex=None):
 
   #Set the recharge to be the sum of surface and excess runoff
+  if ex is None: ex = self.ex
+  work = self.work_surface
   self.recharge1_surface[:] = self.recharge_surface
-  self.recharge_surface[:] = self.qsurf + self.ex
+  np.add(self.qsurf,ex,out=self.recharge_surface)
 
   #Remember the previous time step storage
   self.storage1_surface[:] = self.storage_surface[:] #HERE
@@ -156,11 +197,11 @@ class Dynamic_Topmodel:
   if self.qout1_surface[0] == -9999.0:
    self.qout1_surface[:] = 0.0
    self.qin1_surface[:] = 0.0
-   self.celerity_surface[:] = Calculate_Celerity_Surface(self.storage_surface,self.mannings,self.beta)
+   self.celerity_surface[:] = Calculate_Celerity_Surface(self.storage_surface,self.mannings,self.beta,work)
   
   #Update the celerity
   self.celerity1_surface[:] = self.celerity_surface[:]
-  self.celerity_surface[:] = Calculate_Celerity_Surface(self.storage_surface,self.mannings,self.beta)
+  self.celerity_surface[:] = Calculate_Celerity_Surface(self.storage_surface,self.mannings,self.beta,work)
 
   #Set the storage mask
   self.storage_mask_surface[:] = 1 
@@ -174,7 +215,8 @@ class Dynamic_Topmodel:
              self.qout1_surface,self.qin1_surface,
              self.area,self.dx,self.dt,self.celerity_surface,self.celerity1_surface,
              self.flow_matrix,
-             self.qin_outlet_surface,self.area_outlet,ncores,maxntt,isw)
+             self.qin_outlet_surface,self.area_outlet,ncores,maxntt,isw,
+             self.solver if self.solver_surface is None else self.solver_surface,work)
   else:self.dtt.update(self.recharge_surface,self.storage_surface,self.qout_surface,self.qin_surface,
              self.recharge1_surface,self.storage1_surface,self.qout1_surface,self.qin1_surface,
              self.area,self.dx,self.dt,self.celerity_surface,self.celerity1_surface,
@@ -186,7 +228,9 @@ class Dynamic_Topmodel:
   #Determine the amount of water that is "missing"
   #missing = np.sum(self.area[self.storage_surface < 0.0]*self.storage_surface[self.storage_surface < 0.0])
   #self.storage_surface[-1] = self.storage_surface[-1] + missing/self.area[-1]
-  self.storage_surface[self.storage_surface < 0] = 0.0
+  negative = Work(work,'negative_storage',self.storage_surface,bool)
+  np.less(self.storage_surface,0,out=negative)
+  np.copyto(self.storage_surface,0.0,where=negative)
 
   return
 
@@ -201,18 +245,21 @@ class Dynamic_Topmodel:
    self.c[:] = Calculate_Celerity_Subsurface(self.m,self.q_subsurface)
    self.c1[:] = self.c[:]
 
-  #Update the celerity
-  self.q_subsurface[:] = Calculate_Flux_Subsurface(self.si,self.T0,self.beta,self.m,self.sdmax)
+  #Update the celerity (Calculate_Celerity_Subsurface)
+  work = self.work_subsurface
+  self.q_subsurface[:] = Calculate_Flux_Subsurface(self.si,self.T0,self.beta,self.m,self.sdmax,work)
   self.c1[:] = self.c[:]
-  self.c[:] = Calculate_Celerity_Subsurface(self.m,self.q_subsurface)
+  np.divide(self.q_subsurface,self.m,out=self.c)
 
   #Set the storage mask
   self.storage_mask_subsurface[:] = 1
   #self.storage_mask_subsurface[self.si >= self.sdmax] = 0
 
   #Set deficit in the form that the solver wants
-  si = np.copy(-self.si)
-  si1 = np.copy(-self.si1)
+  si = Work(work,'si',self.si)
+  si1 = Work(work,'si1',self.si1)
+  np.negative(self.si,out=si)
+  np.negative(self.si1,out=si1)
  
   #Solve for the given time step
   if self.mkl_flag == False:(si,si1,self.qout,self.qout1,self.qin,self.qin1,self.c,
@@ -220,7 +267,7 @@ class Dynamic_Topmodel:
              self.r1,si1,self.qout1,self.qin1,
              self.area,self.dx,self.dt,self.c,self.c1,
              self.flow_matrix,
-             self.qin_outlet,self.area_outlet,ncores,maxntt,isw)
+             self.qin_outlet,self.area_outlet,ncores,maxntt,isw,self.solver,work)
   else:self.dtt.update(self.r,si,self.qout,self.qin,
              self.r1,si1,self.qout1,self.qin1,
              self.area,self.dx,self.dt,self.c,self.c1,self.storage_mask_subsurface,
@@ -228,69 +275,118 @@ class Dynamic_Topmodel:
              ncores,maxntt,isw)
 
   #Revert the deficits to their original form
-  self.si[:] = -si
-  self.si1[:] = -si1
+  np.negative(si,out=self.si)
+  np.negative(si1,out=self.si1)
 
   #Set the excess runoff
-  self.ex[:] = 0
+  (negative,positive) = (Work(work,'negative_si',self.si,bool),Work(work,'positive_si',self.si,bool))
+  np.less(self.si,0,out=negative)
+  np.logical_not(negative,out=positive)
   #print self.si,self.dt
-  self.ex[self.si < 0] = -self.si[self.si < 0]/self.dt
-  self.si[self.si < 0] = 0.0
+  np.negative(self.si,out=self.ex)
+  np.divide(self.ex,self.dt,out=self.ex)
+  np.copyto(self.ex,0.0,where=positive)
+  np.copyto(self.si,0.0,where=negative)
 
   #Memorize the recharge for the time step
   self.r1[:] = self.r
 
   return
 
+def Work(work,name,like,dtype=None):
+
+ #Work array of the time step, allocated in the first call of a work dict that is kept
+ #across the time steps (a new array every call without one)
+ if work is None: return np.zeros_like(like,dtype=dtype)
+ if name not in work: work[name] = np.zeros_like(like,dtype=dtype)
+ return work[name]
+
+def Transposed_Product(F,x,out):
+
+ #out = x*F for the csr flow matrix, accumulated in out in the same order as scipy
+ #(the csc product of the transpose)
+ if F.format != 'csr':
+  out[:] = x*F
+  return out
+ out[:] = 0.0
+ _sparsetools.csc_matvec(F.shape[1],F.shape[0],F.indptr,F.indices,F.data,x,out)
+ return out
+
 def Update(recharge,storage,qout,qin,recharge1,storage1,qout1,qin1,
                   area,dx,dt,celerity,celerity1,flow_matrix,
-                  qin_outlet,area_outlet,nthreads,maxntt,w):
+                  qin_outlet,area_outlet,nthreads,maxntt,w,solver=None,work=None):
+
+ #The expressions are evaluated in place in the work arrays (work, see Work) in the
+ #same order as written in the comments. storage and qin are updated in place.
 
  #Determine the appropriate time step
- dt_minimum = np.min(np.abs(dx/celerity))
+ #Number of sub time steps from the largest Courant number (dt/min(dx/c) without
+ #dividing by the zero celerities)
  #ntt = 1*(int(np.ceil(dt/dt_minimum)) + 1)
- ntt = int(np.ceil(dt/dt_minimum))
+ #ntt = int(np.ceil(dt*np.max(np.abs(celerity)/dx)))
+ courant = Work(work,'courant',celerity)
+ np.abs(celerity,out=courant)
+ np.divide(courant,dx,out=courant)
+ ntt = int(np.ceil(dt*np.max(courant)))
  if ntt == 0:ntt = 1
  if ntt > maxntt: ntt = maxntt
  dtt = dt/ntt
 
- #Initialize variables to average the sub time steps
- qout_ = np.zeros(storage.size,dtype=np.float64)
-
  #Define some constatns
- I = scipy.sparse.identity(storage.size)
  F = flow_matrix
- scarea = area/dx
- dummy1 = scipy.sparse.dia_matrix(F.shape)
- dummy2 = scipy.sparse.dia_matrix(F.shape)
- dummy2.setdiag(scarea)
-
- for itime in xrange(ntt):
+ scarea = Work(work,'scarea',area)
+ np.divide(area,dx,out=scarea)
+ #Without a solver set up at initialization the pattern of the system is assembled
+ #once for all the substeps
+ if solver is None:
+  from pyDTopmodel.solvers import Sparse_Solver
+  solver = Sparse_Solver(flow_matrix,area,dx)
+ (p1,p2,denominator) = (Work(work,'p1',qout),Work(work,'p2',qout),Work(work,'denominator',qout))
+ (tmp,negative) = (Work(work,'tmp',qout),Work(work,'negative',qout,bool))
+
+ for itime in range(ntt):
 
   #Solve the kinematic wave for this time step
   #Define the constants
-  denominator = (1 + dtt*w*celerity/dx)
-  numerator1 = qout1 + dtt*w*celerity*recharge + dtt*(1.0 - w)*celerity1*((qin1 - qout1)/dx + recharge1)
-  numerator2 = dtt*w*celerity/dx
-  p1 = numerator1/denominator
-  p2 = numerator2/denominator
-  dummy1.setdiag(p2/scarea)
-  b = p1
-  A = ((F*dummy1).T*dummy2).T
+  #numerator1 = qout1 + dtt*w*celerity*recharge + dtt*(1.0 - w)*celerity1*((qin1 - qout1)/dx + recharge1)
+  np.multiply(dtt*w,celerity,out=p2)
+  np.multiply(p2,recharge,out=p1)
+  np.add(qout1,p1,out=p1)
+  np.subtract(qin1,qout1,out=tmp)
+  np.divide(tmp,dx,out=tmp)
+  np.add(tmp,recharge1,out=tmp)
+  np.multiply(dtt*(1.0 - w),celerity1,out=denominator)
+  np.multiply(denominator,tmp,out=tmp)
+  np.add(p1,tmp,out=p1)
+  #numerator2 = dtt*w*celerity/dx
+  np.divide(p2,dx,out=p2)
+  #denominator = (1 + dtt*w*celerity/dx)
+  np.add(1,p2,out=denominator)
+  #p1 = numerator1/denominator
+  #p2 = numerator2/denominator
+  np.divide(p1,denominator,out=p1)
+  np.divide(p2,denominator,out=p2)
 
   #Solve for this time step
-  tmp = scipy.sparse.linalg.spsolve((I-A).T,b)
-  #print tmp
-  qout[:] = tmp[:]
+  qout[:] = solver.solve(p1,p2)
 
   #Set all negative fluxes to 0 
-  qout[qout < 0.0] = 0.0
+  np.less(qout,0.0,out=negative)
+  np.copyto(qout,0.0,where=negative)
 
   #Calculate qin
-  qin = (scarea*qout*F)/scarea
+  #qin = (scarea*qout*F)/scarea
+  np.multiply(scarea,qout,out=tmp)
+  Transposed_Product(F,tmp,qin)
+  np.divide(qin,scarea,out=qin)
 
   #Adjust the storages
-  storage = storage + dtt*((qin - qout)/dx + recharge)
+  #storage = storage + dtt*((qin - qout)/dx + recharge)
+  np.subtract(qin,qout,out=tmp)
+  np.divide(tmp,dx,out=tmp)
+  np.add(tmp,recharge,out=tmp)
+  np.multiply(dtt,tmp,out=tmp)
+  np.add(storage,tmp,out=storage)
 
   #Set the next time step's info
   qout1[:] = qout[:]
@@ -298,11 +394,92 @@ def Update(recharge,storage,qout,qin,recharge1,storage1,qout1,qin1,
 
  return (storage,storage1,qout,qout1,qin,qin1,celerity,celerity1)
 
-def Calculate_Flux_Subsurface(si,T0,beta,m,sdmax):
+class Lateral_Divergence:
+
+ #Distribute the net lateral outflow (m2/s -> mm/s) over the soil layers below the
+ #water table, weighted by the layer thickness. Zero where the water table is below
+ #the soil column. The layer thicknesses are fixed, so the cumulative depths and the
+ #thickness below each possible first saturated layer are computed once and the
+ #work arrays (in the memory layout of sldpth) are reused: a call does not allocate.
+ #zwt must have the dtype of sldpth (as in Noah-MP).
+
+ def __init__(self,sldpth):
+
+  (nhru,nsoil) = sldpth.shape
+  rows = np.arange(nhru)
+  self.nsoil = nsoil
+  self.sldpth = sldpth
+  self.cs = np.empty_like(sldpth)
+  self.cs[...] = np.cumsum(sldpth,axis=1)
+  self.below = np.zeros(sldpth.shape,dtype=sldpth.dtype)
+  for idx in range(nsoil): self.below[:,idx] = np.sum(sldpth[rows,idx:],axis=1)
+  self.offset = nsoil*rows
+  #Work arrays
+  self.depth = np.zeros(nhru,dtype=sldpth.dtype)
+  self.unsaturated = np.zeros_like(sldpth,dtype=bool)
+  self.count = np.zeros_like(sldpth,dtype=np.intp)
+  self.first = np.zeros(nhru,dtype=np.intp)
+  self.index = np.zeros(nhru,dtype=np.intp)
+  self.norm = np.zeros(nhru,dtype=sldpth.dtype)
+  self.dq = np.zeros(nhru,dtype=np.float64)
+  self.fraction = np.zeros_like(sldpth)
+  self.flux = np.zeros_like(sldpth,dtype=np.float64)
 
- tmp = T0*np.sin(beta)*(np.exp(-si/m*np.cos(beta)) - np.exp(-sdmax/m*np.cos(beta)))
+  return
+
+ def __call__(self,zwt,qout,qin,out):
+
+  #First saturated layer, i.e., the number of layers above the water table (nsoil
+  #where the water table is below the soil column)
+  np.abs(zwt,out=self.depth)
+  np.less_equal(self.cs,self.depth[:,np.newaxis],out=self.unsaturated)
+  np.copyto(self.count,self.unsaturated)
+  np.sum(self.count,axis=1,out=self.first)
+
+  #Thickness of the layers from the first saturated layer down
+  np.minimum(self.first,self.nsoil-1,out=self.index)
+  np.add(self.index,self.offset,out=self.index)
+  np.take(self.below,self.index,out=self.norm,mode='clip')
+
+  #Distribute the net outflow (m2/s -> mm/s)
+  np.subtract(qout,qin,out=self.dq)
+  np.divide(self.sldpth,self.norm[:,np.newaxis],out=self.fraction)
+  np.multiply(self.fraction,1000,out=self.fraction)
+  np.copyto(self.flux,self.fraction)
+  np.multiply(self.flux,self.dq[:,np.newaxis],out=self.flux)
+  np.copyto(self.flux,0,where=self.unsaturated)
+  np.copyto(out,self.flux)
+
+  return out
+
+def Calculate_Lateral_Divergence(sldpth,zwt,qout,qin):
+
+ #One call of Lateral_Divergence (the time loop keeps an instance)
+ hdiv = np.zeros(sldpth.shape,dtype=sldpth.dtype)
+ return Lateral_Divergence(sldpth)(zwt.astype(sldpth.dtype),qout,qin,hdiv)
+
+def Calculate_Flux_Subsurface(si,T0,beta,m,sdmax,work=None):
+
+ #tmp = T0*np.sin(beta)*(np.exp(-si/m*np.cos(beta)) - np.exp(-sdmax/m*np.cos(beta)))
+ #(in place in the work arrays, see Work)
+ (tmp,cos,decay) = (Work(work,'flux',si),Work(work,'flux_cos',si),Work(work,'flux_decay',si))
+ np.cos(beta,out=cos)
+ np.negative(si,out=tmp)
+ np.divide(tmp,m,out=tmp)
+ np.multiply(tmp,cos,out=tmp)
+ np.exp(tmp,out=tmp)
+ np.negative(sdmax,out=decay)
+ np.divide(decay,m,out=decay)
+ np.multiply(decay,cos,out=decay)
+ np.exp(decay,out=decay)
+ np.subtract(tmp,decay,out=tmp)
+ np.sin(beta,out=decay)
+ np.multiply(T0,decay,out=decay)
+ np.multiply(decay,tmp,out=tmp)
  #tmp = T0*np.tan(beta)*(np.exp(-si/m))
- tmp[tmp < 0] = 0
+ negative = Work(work,'flux_negative',si,bool)
+ np.less(tmp,0,out=negative)
+ np.copyto(tmp,0,where=negative)
  return tmp
  #return T0*np.sin(beta)*(np.exp(-si/m*np.cos(beta)) - np.exp(-sdmax/m*np.cos(beta)))
  #return T0*np.tan(beta)*(np.exp(-si/m))
@@ -321,10 +498,20 @@ def Calculate_Flux_Surface(storage_surface,surface_velocity):
 
  return surface_velocity*storage_surface
 
-def Calculate_Celerity_Surface(h,n,beta):
+def Calculate_Celerity_Surface(h,n,beta,work=None):
 
  a = 1.67
- b = np.tan(beta)**0.5/n
- c = a*b*h**(a-1)
- c[c > 2.0] = 2.0
+ #b = np.tan(beta)**0.5/n
+ #c = a*b*h**(a-1)
+ #(in place in the work arrays, see Work)
+ (c,power) = (Work(work,'celerity',h),Work(work,'celerity_power',h))
+ np.tan(beta,out=c)
+ np.sqrt(c,out=c)
+ np.divide(c,n,out=c)
+ np.multiply(a,c,out=c)
+ np.power(h,a-1,out=power)
+ np.multiply(c,power,out=c)
+ above = Work(work,'celerity_above',h,bool)
+ np.greater(c,2.0,out=above)
+ np.copyto(c,2.0,where=above)
  return c
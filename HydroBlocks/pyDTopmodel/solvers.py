@@ -0,0 +1,269 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+class Sparse_Solver:
+
+ #Solves the implicit kinematic wave system of Update, (I - A)^T qout = p1, with the
+ #sparse LU (spsolve). (I - A)^T = I - diag(p2)*G with G[j,i] = scarea_i*F_ij/scarea_j
+ #does not change its pattern, so it is assembled once (in csc) with the identity and
+ #the weights of every value and each substep only fills the values in place.
+
+ def __init__(self,flow_matrix,area,dx):
+
+  F = scipy.sparse.csr_matrix(flow_matrix,dtype=np.float64)
+  n = F.shape[0]
+  scarea = area/dx
+  self.n = n
+
+  #Pattern of I - diag(p2)*G (the row of every value is in indices)
+  G = scipy.sparse.csc_matrix(scipy.sparse.diags(1.0/scarea)*F.T*scipy.sparse.diags(scarea))
+  coo = G.tocoo()
+  rows = np.concatenate([coo.row,np.arange(n)])
+  cols = np.concatenate([coo.col,np.arange(n)])
+  self.matrix = scipy.sparse.csc_matrix((np.ones(rows.size),(rows,cols)),shape=(n,n))
+  self.matrix.sum_duplicates()
+  self.matrix.sort_indices()
+  cols = np.repeat(np.arange(n),np.diff(self.matrix.indptr))
+  self.identity = np.array(self.matrix.indices == cols,dtype=np.float64)
+  self.weights = np.asarray(G[self.matrix.indices,cols],dtype=np.float64).ravel()
+  self.matrix.data[:] = self.identity
+
+  #Work array
+  self.values = np.zeros(self.matrix.nnz,dtype=np.float64)
+
+  return
+
+ def solve(self,p1,p2):
+
+  #data = I - p2[row]*weights
+  np.take(p2,self.matrix.indices,out=self.values)
+  np.multiply(self.values,self.weights,out=self.values)
+  np.subtract(self.identity,self.values,out=self.matrix.data)
+
+  return scipy.sparse.linalg.spsolve(self.matrix,p1)
+
+class Topological_Solver:
+
+ #Solves the implicit kinematic wave system of Update, (I - A)^T qout = p1 with
+ #A = diag(scarea)*F*diag(p2/scarea), i.e., for every hru j
+ #
+ #  qout_j - p2_j*sum_i(scarea_i*F_ij*qout_i)/scarea_j = p1_j
+ #
+ #F only connects an hru to the hrus downslope of it, so with the hrus ordered from
+ #upstream to downstream the system is lower triangular and it is solved by forward
+ #substitution in O(nnz). The ordering (and the sparsity pattern in that order) is
+ #computed once from F. Return flow (cycles in F) is found as the strongly connected
+ #components of the network; the hrus of each cycle are kept together in the order
+ #and only the blocks around them are solved with the sparse LU (spsolve).
+
+ def __init__(self,flow_matrix,area,dx,min_triangular=1000,nthreads=1):
+
+  (Gp,diagonal,component,size) = self.ordering(flow_matrix,area,dx,nthreads)
+  n = self.n
+
+  #Segments of the order of each group: long runs of hrus outside cycles are solved by
+  #forward substitution and everything else (cycles and the short runs between them)
+  #with the sparse LU in the same order (the blocks are lower triangular, so there is
+  #only fill within the cycles)
+  self.groups = []
+  for (ga,gb) in zip(self.gstart[0:-1],self.gstart[1:]):
+   cyclic = size[component[ga:gb]] > 1
+   cyclic = np.concatenate([[False,],cyclic,[False,]]).astype(np.int8)
+   edges = ga + np.where(np.diff(cyclic) != 0)[0]
+   (tri_a,tri_b) = (np.concatenate([[ga,],edges[1::2]]),np.concatenate([edges[0::2],[gb,]]))
+   m = (tri_b - tri_a) >= min_triangular
+   m[0] = m[0] | (edges.size == 0)
+   (tri_a,tri_b) = (tri_a[m],tri_b[m])
+   segments = []
+   a = ga
+   for (ta,tb) in zip(tri_a,tri_b):
+    if ta > a: segments.append(self.segment(Gp,diagonal,ga,a,ta,True))
+    if tb > ta: segments.append(self.segment(Gp,diagonal,ga,ta,tb,False))
+    a = tb
+   if a < gb: segments.append(self.segment(Gp,diagonal,ga,a,gb,True))
+   self.groups.append(segments)
+
+  #The groups are solved in parallel (the sparse solves release the GIL)
+  self.executor = None
+  if len(self.groups) > 1:
+   import concurrent.futures
+   self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.groups))
+
+  #Work arrays (in the order of the solver)
+  self.p1 = np.zeros(n,dtype=np.float64)
+  self.p2 = np.zeros(n,dtype=np.float64)
+  self.x = np.zeros(n,dtype=np.float64)
+  self.qout = np.zeros(n,dtype=np.float64)
+
+  return
+
+ def ordering(self,flow_matrix,area,dx,nthreads):
+
+  #Orders the hrus along the flow network and returns the inflow operator, F_jj, the
+  #strongly connected component of each hru (all in that order) and the component sizes.
+  #The hrus of each basin (weakly connected component) are contiguous and the basins
+  #are split into nthreads groups of about the same size (gstart) that do not exchange
+  #water.
+  F = scipy.sparse.csr_matrix(flow_matrix,dtype=np.float64)
+  n = F.shape[0]
+  scarea = area/dx
+  self.n = n
+
+  #Inflow operator: G[j,i] = scarea_i*F_ij/scarea_j (without the diagonal F_jj)
+  G = scipy.sparse.csr_matrix(F.T)
+  diagonal = np.array(G.diagonal(),dtype=np.float64)
+  G.setdiag(0.0)
+  G.eliminate_zeros()
+  G = scipy.sparse.csr_matrix(scipy.sparse.diags(1.0/scarea)*G*scipy.sparse.diags(scarea))
+
+  #Strongly connected components (cycles of the flow network)
+  (ncomponents,component) = scipy.sparse.csgraph.connected_components(G,directed=True,connection='strong')
+  size = np.bincount(component,minlength=ncomponents)
+  self.ncycles = int(np.sum(size > 1))
+  self.ncyclic = int(np.sum(size[component] > 1))
+
+  #Topological order of the components: peel the components whose inflows are all
+  #known, one level at a time
+  coo = G.tocoo()
+  (dst,src) = (component[coo.row],component[coo.col])
+  m = dst != src
+  C = scipy.sparse.csr_matrix((np.ones(np.sum(m)),(src[m],dst[m])),shape=(ncomponents,ncomponents))
+  indegree = np.diff(scipy.sparse.csr_matrix(C.T).indptr)
+  level = np.zeros(ncomponents,dtype=np.int64)
+  frontier = np.where(indegree == 0)[0]
+  self.nlevels = 0
+  while frontier.size > 0:
+   level[frontier] = self.nlevels
+   self.nlevels += 1
+   successors = C[frontier,:].indices
+   indegree -= np.bincount(successors,minlength=ncomponents)
+   frontier = np.unique(successors[indegree[successors] == 0])
+
+  #Basins (weakly connected components)
+  (self.nbasins,basin) = scipy.sparse.csgraph.connected_components(G,directed=True,connection='weak')
+
+  #Order of the hrus (the hrus of a basin and of a component are contiguous)
+  self.order = np.lexsort((component,level[component],basin))
+  Gp = scipy.sparse.csr_matrix(G[self.order,:][:,self.order])
+  Gp.sort_indices()
+  diagonal = diagonal[self.order]
+  component = component[self.order]
+
+  #Groups of basins with about the same number of hrus (at least 1000 hrus per group
+  #for the threads to pay off)
+  basin = basin[self.order]
+  ends = np.concatenate([np.where(basin[1:] != basin[:-1])[0] + 1,[n,]])
+  ngroups = max(1,min(nthreads,self.nbasins,n//1000))
+  cuts = ends[np.searchsorted(ends,n*np.arange(1,ngroups)/ngroups)]
+  self.gstart = np.unique(np.concatenate([[0,],cuts,[n,]]))
+
+  return (Gp,diagonal,component,size)
+
+ def segment(self,Gp,diagonal,ga,a,b,cyclic):
+
+  #Pattern of I - diag(p2)*(G + diag(F_jj)) for the hrus a:b and where its values go
+  inner = scipy.sparse.csr_matrix(Gp[a:b,a:b] + scipy.sparse.identity(b-a))
+  inner.sort_indices()
+  rows = np.repeat(np.arange(b-a),np.diff(inner.indptr))
+  isdiag = inner.indices == rows
+  weights = scipy.sparse.csr_matrix(Gp[a:b,a:b])
+  weights.sort_indices()
+  #The matrix is assembled once and its values are filled in place by solve
+  matrix = scipy.sparse.csr_matrix((np.zeros(inner.nnz,dtype=np.float64),inner.indices,inner.indptr),shape=(b-a,b-a))
+  segment = {'a':a,'b':b,'cyclic':cyclic,'matrix':matrix,
+             'diag':np.where(isdiag)[0],'offdiag':np.where(~isdiag)[0],
+             'rows':rows[~isdiag],'weights':weights.data,'diagonal':diagonal[a:b],
+             'ga':ga,'outer':scipy.sparse.csr_matrix(Gp[a:b,ga:a]) if a > ga else None}
+
+  return segment
+
+ def solve(self,p1,p2):
+
+  #Forward substitution over the segments of each group. The solution is returned in a
+  #work array of the solver.
+  np.take(p1,self.order,out=self.p1)
+  np.take(p2,self.order,out=self.p2)
+  if self.executor is None: self.substitute(self.groups[0])
+  else: list(self.executor.map(self.substitute,self.groups))
+  self.qout[self.order] = self.x
+
+  return self.qout
+
+ def substitute(self,segments):
+
+  #The inflow from the upstream segments of the group is known
+  (p1o,p2o,x) = (self.p1,self.p2,self.x)
+  for segment in segments:
+   (ga,a,b) = (segment['ga'],segment['a'],segment['b'])
+   rhs = np.copy(p1o[a:b])
+   if segment['outer'] is not None: rhs += p2o[a:b]*(segment['outer']*x[ga:a])
+   M = segment['matrix']
+   M.data[segment['diag']] = 1.0 - p2o[a:b]*segment['diagonal']
+   M.data[segment['offdiag']] = -p2o[a:b][segment['rows']]*segment['weights']
+   if segment['cyclic']: x[a:b] = scipy.sparse.linalg.spsolve(M,rhs,permc_spec='NATURAL')
+   else: x[a:b] = scipy.sparse.linalg.spsolve_triangular(M,rhs,lower=True)
+
+  return
+
+class Compiled_Solver(Topological_Solver):
+
+ #Same ordering as Topological_Solver with the forward substitution done by the
+ #compiled kinematic_wave_tools module (gfortran only, no MKL). The cycles are solved
+ #by Gauss-Seidel within each strongly connected component (it converges since less
+ #than all the outflow of an hru returns to it) until the largest change is below
+ #tolerance times the largest outflow of the cycle. The groups of basins are solved in
+ #parallel with OpenMP. If a cycle does not converge within maxiter iterations (an hru
+ #that returns almost all its outflow to itself) the system is solved again with the
+ #sparse LU of Sparse_Solver.
+
+ def __init__(self,flow_matrix,area,dx,tolerance=1e-13,maxiter=1000,nthreads=1):
+
+  from pyDTopmodel import kinematic_wave_tools
+  self.kwt = kinematic_wave_tools
+  (Gp,diagonal,component,size) = self.ordering(flow_matrix,area,dx,nthreads)
+  n = self.n
+
+  #Arrays of the compiled solver (0 based indices)
+  self.tolerance = tolerance
+  self.maxiter = maxiter
+  self.corder = np.array(self.order,dtype=np.int32)
+  self.indptr = np.array(Gp.indptr,dtype=np.int32)
+  #(with an unused last value so that the arrays are never empty)
+  self.indices = np.array(np.concatenate([Gp.indices,[0,]]),dtype=np.int32)
+  self.weights = np.array(np.concatenate([Gp.data,[0.0,]]),dtype=np.float64)
+  self.diagonal = np.array(diagonal,dtype=np.float64)
+  starts = np.where(component[1:] != component[:-1])[0] + 1
+  self.bstart = np.concatenate([[0,],starts,[n,]]).astype(np.int32)
+  self.bgroup = np.searchsorted(self.bstart,self.gstart).astype(np.int32)
+  self.nthreads = nthreads
+
+  #Sparse LU for the substeps with unconverged cycles (assembled on first use)
+  self.system = (flow_matrix,area,dx)
+  self.fallback = None
+  self.nfallback = 0
+
+  #Work arrays (in the order of the solver)
+  self.p1 = np.zeros(n,dtype=np.float64)
+  self.p2 = np.zeros(n,dtype=np.float64)
+  self.x = np.zeros(n,dtype=np.float64)
+  self.qout = np.zeros(n,dtype=np.float64)
+
+  return
+
+ def solve(self,p1,p2):
+
+  nfailed = self.kwt.solve(p1,p2,self.qout,self.corder,self.indptr,self.indices,self.weights,
+                 self.diagonal,self.bstart,self.bgroup,self.p1,self.p2,self.x,self.tolerance,
+                 self.maxiter,self.nthreads)
+
+  #Unconverged cycles
+  if nfailed > 0:
+   if self.fallback is None:
+    print('Warning: %d cycles of the kinematic wave did not converge in %d iterations, solving with the sparse LU' % (nfailed,self.maxiter))
+    self.fallback = Sparse_Solver(*self.system)
+   self.qout[:] = self.fallback.solve(p1,p2)
+   self.nfallback += 1
+
+  return self.qout
@@ -35,6 +35,11 @@ os.system(cmd)
 #Move to the previous directory
 os.system('mv dynamic_topmodel_tools*.so ../dynamic_topmodel_tools.so')
 
+#Compile the kinematic wave solver that does not need MKL (gfortran/OpenMP only)
+cmd = 'f2py -c kinematic_wave_tools.f90 -m kinematic_wave_tools -lgomp --fcompiler=gnu95 --f90flags="-w -O3 -funroll-loops -fopenmp"'
+os.system(cmd)
+os.system('mv kinematic_wave_tools*.so ../kinematic_wave_tools.so')
+
 #Remove the temporary file
 os.system('rm -f tmp.f90')
 os.system('rm -f *.mod')
@@ -0,0 +1,86 @@
+subroutine solve(p1,p2,qout,order,indptr,indices,weights,diagonal,bstart,bgroup,&
+                 p1o,p2o,x,tolerance,maxiter,nthreads,nfailed,n,nnz,nblocks,ngroups)
+
+ !Solves the implicit kinematic wave system (I - A)^T qout = p1 of Update by forward
+ !substitution over the hrus in flow order (see solvers.Compiled_Solver). Row k of
+ !the weights holds the inflows to the k-th hru of the order (0 based positions of
+ !the order). Each block (bstart) is a strongly connected component: blocks of one
+ !hru are solved directly and the cycles by Gauss-Seidel until the largest change is
+ !below tolerance times the largest outflow of the cycle; nfailed counts the cycles
+ !that did not converge within maxiter iterations (the caller solves the system
+ !again directly). The groups of blocks (bgroup) do not exchange water and are solved
+ !in parallel.
+ implicit none
+ !f2py threadsafe
+ integer*4,intent(in) :: n,nnz,nblocks,ngroups,maxiter,nthreads
+ real*8,intent(in) :: tolerance
+ real*8,intent(in),dimension(n) :: p1,p2,diagonal
+ real*8,intent(inout),dimension(n) :: qout,p1o,p2o,x
+ integer*4,intent(in),dimension(n) :: order
+ integer*4,intent(in),dimension(n+1) :: indptr
+ integer*4,intent(in),dimension(nnz) :: indices
+ real*8,intent(in),dimension(nnz) :: weights
+ integer*4,intent(in),dimension(nblocks+1) :: bstart
+ integer*4,intent(in),dimension(ngroups+1) :: bgroup
+ integer*4,intent(out) :: nfailed
+ integer*4 :: ig,ib,k,jj,iter
+ real*8 :: s,xk,change,scale
+
+ nfailed = 0
+ !$omp parallel num_threads(nthreads) private(ig,ib,k,jj,iter,s,xk,change,scale)
+
+ !Move the coefficients to the order of the solver
+ !$omp do schedule(static)
+ do k = 1,n
+  p1o(k) = p1(order(k)+1)
+  p2o(k) = p2(order(k)+1)
+ enddo
+ !$omp end do
+
+ !$omp do schedule(dynamic,1) reduction(+:nfailed)
+ do ig = 1,ngroups
+  do ib = bgroup(ig)+1,bgroup(ig+1)
+   if (bstart(ib+1) - bstart(ib) .eq. 1) then
+    !Outside of the cycles all the inflows are known
+    k = bstart(ib+1)
+    s = 0.0
+    do jj = indptr(k)+1,indptr(k+1)
+     s = s + weights(jj)*x(indices(jj)+1)
+    enddo
+    x(k) = (p1o(k) + p2o(k)*s)/(1.0 - p2o(k)*diagonal(k))
+   else
+    !Cycle (return flow)
+    do k = bstart(ib)+1,bstart(ib+1)
+     x(k) = 0.0
+    enddo
+    do iter = 1,maxiter
+     change = 0.0
+     scale = 0.0
+     do k = bstart(ib)+1,bstart(ib+1)
+      s = 0.0
+      do jj = indptr(k)+1,indptr(k+1)
+       s = s + weights(jj)*x(indices(jj)+1)
+      enddo
+      xk = (p1o(k) + p2o(k)*s)/(1.0 - p2o(k)*diagonal(k))
+      change = max(change,abs(xk - x(k)))
+      scale = max(scale,abs(xk))
+      x(k) = xk
+     enddo
+     if (change .le. tolerance*scale) exit
+    enddo
+    if (iter .gt. maxiter) nfailed = nfailed + 1
+   endif
+  enddo
+ enddo
+ !$omp end do
+
+ !Move the solution back to the order of the hrus
+ !$omp do schedule(static)
+ do k = 1,n
+  qout(order(k)+1) = x(k)
+ enddo
+ !$omp end do
+
+ !$omp end parallel
+
+end subroutine solve
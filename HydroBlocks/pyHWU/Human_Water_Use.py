@@ -50,15 +50,18 @@ class Human_Water_Use:
     'agriculture':[12,14],
     'surface_water':[11,17]}
 
-  # Calc topographic index
-  self.beta = HB.input_fp.groups['parameters'].variables['slope'][:] #Noemi
-  m = HB.input_fp.groups['parameters'].variables['m'][:] #Depth to bedrock #Noemi
-  pct = HB.input_fp.groups['parameters'].variables['area_pct'][:]/100.0
+  # Calc topographic index (parameters of all the cells, i.e. tiled over the ensemble members)
+  self.beta = HB.read_parameter('slope') #Noemi
+  m = HB.read_parameter('m') #Depth to bedrock #Noemi
+  pct = HB.read_parameter('area_pct')/100.0
   af=10 #anisotropic factor
-  T0 = af*HB.input_fp.groups['parameters'].variables['SATDK'][:]*m
-  self.sti = HB.input_fp.groups['parameters'].variables['ti'][:] #Noemi
-  self.sti = self.sti -(np.log(T0)-np.sum(pct*np.log(T0)))
-  self.dem = HB.input_fp.groups['parameters'].variables['dem'][:]
+  T0 = af*HB.read_parameter('SATDK')*m
+  self.sti = HB.read_parameter('ti') #Noemi
+  # (relative to the mean transmissivity of each member)
+  lnT0 = np.log(T0)
+  lnTe = np.sum((pct*lnT0).reshape(HB.nens,HB.nhru_catchment),axis=1)
+  self.sti = self.sti -(lnT0-np.repeat(lnTe,HB.nhru_catchment))
+  self.dem = HB.read_parameter('dem')
  
  
   # GROUNDWATER supply variables
@@ -410,8 +413,8 @@ class Human_Water_Use:
 
 
  def Calc_Human_Water_Demand_Supply(self,HB,date):
-   NOAH = HB.noahmp
-   area = np.copy(self.area)
+   NOAH = HB.state
+   area = self.area
     
    # Only calculate water demand and update allocations at the dta time step.
    if (date.hour*3600.0)%self.dta == 0.0:
@@ -478,7 +481,7 @@ class Human_Water_Use:
 
 
  def Calc_Water_Supply(self,HB):
-  NOAH = HB.noahmp
+  NOAH = HB.state
   ncells = NOAH.ncells
   sldpth = NOAH.sldpth
  
@@ -509,7 +512,7 @@ class Human_Water_Use:
 
 
  def Water_Supply_Abstraction(self, HB, date):
-  NOAH = HB.noahmp
+  NOAH = HB.state
   ncells = NOAH.ncells
   sldpth = NOAH.sldpth
   nsoils = np.arange(NOAH.sh2o.shape[1])
@@ -537,13 +540,13 @@ class Human_Water_Use:
     #if (date.hour*3600)%self.dta == 0: print 'gw:', self.alloc_gw
     
     if HB.subsurface_module == 'dtopmodel':
-      NOAH.dzwt[m] = (NOAH.dzwt-(self.alloc_gw))[m]  # m
+      np.subtract(NOAH.dzwt,self.alloc_gw,out=NOAH.dzwt,where=m)  # m
     
     elif HB.subsurface_module == 'richards':
          
       dsm = NOAH.sh2o - NOAH.smcref[:,np.newaxis]
       dsm[dsm<0]=0
-      volume_avail  = np.array([ dsm[i,:]*sldpth[i,:] for i in range(ncells) ]) #m per layer
+      volume_avail  = dsm*sldpth #m per layer
       volume_final = np.copy(volume_avail)
       voli = np.copy(self.alloc_gw)
   
@@ -604,12 +607,11 @@ class Human_Water_Use:
    if self.hwu_agric_flag  == True:# and (date.hour*3600)%self.dta == 0:
         
     # Add as irrigation the amount of water that was allocated
-    self.irrigation = np.copy(self.alloc_agric)*(1000.0/HB.noahmp.dt)  #from m/tstep to mm/s
-    m = (self.mask_irrig == True)
+    np.multiply(self.alloc_agric,1000.0/HB.state.dt,out=self.irrigation)  #from m/tstep to mm/s
     #print self.irrigation
     #print self.irrigation[m]
     #print 'irrig',np.sum(self.irrigation)*(HB.noahmp.dt/1000.0)
-    HB.noahmp.prcp[m] = (HB.noahmp.prcp + self.irrigation)[m] #mm/s
+    np.add(HB.state.prcp,self.irrigation,out=HB.state.prcp,where=self.mask_irrig) #mm/s
     # Include irrigation efficiency later on
 
   return
@@ -799,7 +801,7 @@ class Human_Water_Use:
 
 
  def Agriculture_Demand(self,HB,date):
-  NOAH = HB.noahmp
+  NOAH = HB.state
       
   demand_agric = np.copy(self.Calculate_Irrigation_Deficit(NOAH)) # m
   demand_agric = demand_agric/0.85 # Efficiency
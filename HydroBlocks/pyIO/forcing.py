@@ -0,0 +1,254 @@
+import numpy as np
+import time
+import concurrent.futures
+from pyIO.lock import hdf5_lock
+
+class Forcing_Reader:
+
+ #Serves the per time step forcing of a netcdf group from blocks of time steps
+ #that are read with a single slab read per variable. With prefetch enabled the
+ #next block is decoded by a background thread into a second buffer while the
+ #model runs, and moving to the next block only swaps the two buffers.
+
+ def __init__(self,fp,group,vars,itime,ntime,block_size,prefetch=False):
+
+  self.fp = fp
+  self.group = group
+  self.vars = vars
+  self.itime = itime #record of the first model time step
+  self.ntime = ntime #number of model time steps
+  self.block_size = max(int(block_size),1)
+  self.prefetch = prefetch
+
+  #Double buffer (the current block and the block being prefetched)
+  with hdf5_lock:
+   nhru = len(fp.dimensions['hsu'])
+   dtypes = {}
+   for var in vars: dtypes[var] = fp.groups[group].variables[var].dtype
+  self.buffers = []
+  nbuffers = 1
+  if self.prefetch: nbuffers = 2
+  for ibuf in range(nbuffers):
+   buffer = {'i0':0,'i1':0,'data':{}}
+   for var in vars:
+    buffer['data'][var] = np.zeros((self.block_size,nhru),dtype=dtypes[var])
+   self.buffers.append(buffer)
+  self.current = self.buffers[0]
+  self.spare = self.buffers[-1]
+
+  #Background thread
+  self.pending = None
+  if self.prefetch: self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+  #Time (seconds) the caller waited on the forcing I/O and bytes read
+  self.wait_time = 0.0
+  self.bytes_read = 0
+
+  return
+
+ def read(self,itime):
+
+  #Move to the block that holds this time step if necessary
+  if (itime < self.current['i0']) or (itime >= self.current['i1']): self.swap(itime)
+
+  #Serve the time step from memory
+  i = itime - self.current['i0']
+  output = {}
+  for var in self.vars:output[var] = self.current['data'][var][i,:]
+
+  return output
+
+ def swap(self,itime):
+
+  tic = time.time()
+
+  #Wait for the prefetched block (discard it if it does not hold this time step)
+  if self.pending is not None:
+   self.pending.result()
+   self.pending = None
+   if (itime < self.spare['i0']) or (itime >= self.spare['i1']): self.load_block(self.spare,itime)
+  else:
+   self.load_block(self.spare,itime)
+
+  #Swap the buffers
+  self.current,self.spare = self.spare,self.current
+
+  #Decode the next block in the background
+  if self.prefetch and (self.current['i1'] < self.ntime):
+   self.pending = self.executor.submit(self.load_block,self.spare,self.current['i1'])
+
+  self.wait_time += time.time() - tic
+
+  return
+
+ def load_block(self,buffer,itime):
+
+  #Define the block
+  i0 = itime
+  i1 = min(itime + self.block_size,self.ntime)
+  if i1 <= i0: i1 = i0 + 1
+
+  #Read all the time steps of the block for each variable
+  r0 = self.itime + i0
+  r1 = self.itime + i1
+  with hdf5_lock:
+   grp = self.fp.groups[self.group]
+   for var in self.vars:
+    buffer['data'][var][0:i1-i0,:] = np.ma.getdata(grp.variables[var][r0:r1,:])
+    self.bytes_read += buffer['data'][var][0:i1-i0,:].nbytes
+  buffer['i0'] = i0
+  buffer['i1'] = i1
+
+  return
+
+ def close(self,):
+
+  #Stop the background thread
+  if self.pending is not None:
+   self.pending.result()
+   self.pending = None
+  if self.prefetch: self.executor.shutdown(wait=True)
+
+  return
+
+class Shared_Forcing_Reader:
+
+ #Serves the per time step forcing from a copy of the segment's forcing in shared
+ #memory (one .npy file per variable, /dev/shm by default) that is memory mapped
+ #by every process running the same catchment. The copy is keyed by the input file
+ #(path, size and modification time), the group, the variables and the records.
+ #Its users hold a shared flock on <copy>.lock while they map it; the first one
+ #takes an exclusive flock to load it from the netcdf file, and a loader that dies
+ #releases its flock so that the next process reloads the copy. The last user to
+ #close the reader removes the copy.
+
+ def __init__(self,fp,file,group,vars,itime,ntime,block_size,dir,timeout=3600.0):
+
+  import os
+  import json
+  import fcntl
+  import shutil
+  import hashlib
+
+  self.group = group
+  self.vars = vars
+  self.timeout = timeout
+  self.wait_time = 0.0
+  self.bytes_read = 0
+
+  #Directory of the shared copy
+  stat = os.stat(file)
+  key = json.dumps([os.path.abspath(file),stat.st_size,stat.st_mtime,group,vars,int(itime),int(ntime)])
+  self.dir = '%s/hydroblocks_forcing_%s' % (dir,hashlib.sha1(key.encode()).hexdigest()[0:16])
+  self.lock_file = '%s.lock' % self.dir
+  self.fd = None
+  complete = '%s/complete' % self.dir
+
+  tic = time.time()
+  self.acquire(fcntl.LOCK_SH)
+  if os.path.exists(complete) == False:
+   #Load the copy (the directory can hold the partial copy of a dead loader)
+   fcntl.flock(self.fd,fcntl.LOCK_UN)
+   self.acquire(fcntl.LOCK_EX)
+   if os.path.exists(complete) == False:
+    shutil.rmtree(self.dir,ignore_errors=True)
+    os.makedirs(self.dir)
+    try:
+     self.load(fp,itime,ntime,block_size)
+    except BaseException:
+     shutil.rmtree(self.dir,ignore_errors=True)
+     self.release()
+     raise
+    open(complete,'w').close()
+  self.wait_time += time.time() - tic
+
+  #Map the variables
+  self.data = {}
+  for var in vars:
+   self.data[var] = np.load('%s/%s.npy' % (self.dir,var),mmap_mode='r')
+
+  #Keep a shared lock while the copy is in use
+  fcntl.flock(self.fd,fcntl.LOCK_SH)
+
+  return
+
+ def acquire(self,operation):
+
+  #flock the lock file of the copy (reopened if the last user removed it meanwhile)
+  import os
+  import fcntl
+  tic = time.time()
+  while True:
+   if self.fd is None: self.fd = os.open(self.lock_file,os.O_RDWR|os.O_CREAT,0o666)
+   try:
+    fcntl.flock(self.fd,operation|fcntl.LOCK_NB)
+   except BlockingIOError:
+    if time.time() - tic > self.timeout:
+     exit('Error: Timed out waiting for the shared forcing in %s' % self.dir)
+    time.sleep(0.1)
+    continue
+   try:
+    if os.stat(self.lock_file).st_ino == os.fstat(self.fd).st_ino: return
+   except FileNotFoundError:
+    pass
+   os.close(self.fd)
+   self.fd = None
+
+ def release(self,):
+
+  import os
+  if self.fd is not None: os.close(self.fd)
+  self.fd = None
+
+  return
+
+ def load(self,fp,itime,ntime,block_size):
+
+  import os
+  with hdf5_lock: nhru = len(fp.dimensions['hsu'])
+  block_size = max(int(block_size),1)
+  for var in self.vars:
+   with hdf5_lock: dtype = fp.groups[self.group].variables[var].dtype
+   file = '%s/%s.npy' % (self.dir,var)
+   data = np.lib.format.open_memmap('%s.tmp' % file,mode='w+',dtype=dtype,shape=(ntime,nhru))
+   for i0 in range(0,ntime,block_size):
+    i1 = min(i0 + block_size,ntime)
+    with hdf5_lock:
+     data[i0:i1,:] = np.ma.getdata(fp.groups[self.group].variables[var][itime+i0:itime+i1,:])
+    self.bytes_read += data[i0:i1,:].nbytes
+   data.flush()
+   del data
+   os.replace('%s.tmp' % file,file)
+
+  return
+
+ def read(self,itime):
+
+  #Views of the time step in the shared copy
+  output = {}
+  for var in self.vars:output[var] = self.data[var][itime,:]
+
+  return output
+
+ def close(self,):
+
+  import os
+  import fcntl
+  import shutil
+
+  #Unmap the variables
+  self.data = {}
+  if self.fd is None: return
+
+  #Remove the shared copy if no other process is using it
+  fcntl.flock(self.fd,fcntl.LOCK_UN)
+  try:
+   fcntl.flock(self.fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+   if os.stat(self.lock_file).st_ino == os.fstat(self.fd).st_ino:
+    shutil.rmtree(self.dir,ignore_errors=True)
+    os.remove(self.lock_file)
+  except (BlockingIOError,FileNotFoundError):
+   pass
+  self.release()
+
+  return
@@ -0,0 +1,7 @@
+import threading
+
+#The netcdf/hdf5 libraries are not built thread safe. Every library call that can
+#overlap an I/O thread (forcing prefetch, asynchronous output flush and restart or
+#checkpoint writers) must hold this lock, in those threads and in the main thread
+#(creating/opening/closing files and reading the input file while they run).
+hdf5_lock = threading.RLock()
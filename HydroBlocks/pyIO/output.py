@@ -0,0 +1,190 @@
+import numpy as np
+import threading
+import queue
+import time
+from pyIO.lock import hdf5_lock
+
+class Output_Buffer:
+
+ #Stages consecutive time steps of the output variables in preallocated arrays
+ #and writes them to the netcdf file as one contiguous [t0:t1,...] slab per variable.
+ #With asynchronous set, full buffers are handed to a writer thread through a
+ #bounded queue so that the time loop keeps going while hdf5 writes.
+
+ def __init__(self,variables,buffer_size,asynchronous=False,queue_size=2):
+
+  self.variables = variables #netcdf variables (time is the first dimension)
+  self.buffer_size = max(int(buffer_size),1)
+  self.asynchronous = asynchronous
+
+  #Pool of staging buffers (one staged, queue_size queued and one being written)
+  nbuffers = 1
+  if self.asynchronous: nbuffers = queue_size + 2
+  self.free = queue.Queue()
+  for ibuf in range(nbuffers):
+   data = {}
+   for var in variables:
+    ncvar = variables[var]
+    data[var] = np.zeros((self.buffer_size,) + ncvar.shape[1:],dtype=ncvar.dtype)
+   self.free.put(data)
+  self.data = self.free.get()
+  self.t0 = 0 #record of the first staged time step
+  self.n = 0 #number of staged time steps
+
+  #Writer thread
+  self.error = None
+  if self.asynchronous:
+   self.queue = queue.Queue(maxsize=max(int(queue_size),1))
+   self.writer = threading.Thread(target=self.write_loop)
+   self.writer.daemon = True
+   self.writer.start()
+
+  #Statistics
+  self.blocked_time = 0.0 #time (seconds) the caller was blocked by the writer
+  self.drain_time = 0.0 #time (seconds) spent draining the queue on close
+  self.max_backlog = 0 #maximum number of queued buffers
+  self.nflush = 0
+  self.bytes_written = 0
+
+  return
+
+ def stage(self,itime,values):
+
+  #Only consecutive records can be staged together
+  if (self.n > 0) and (itime != self.t0 + self.n): self.flush()
+  if self.n == 0: self.t0 = itime
+
+  #Stage the time step
+  for var in self.variables:
+   self.data[var][self.n] = values[var]
+  self.n += 1
+
+  #Write the buffer once it is full
+  if self.n == self.buffer_size: self.flush()
+
+  return
+
+ def flush(self,):
+
+  if self.n == 0: return
+  if self.error is not None: raise self.error
+  self.nflush += 1
+
+  if self.asynchronous == False:
+   self.write(self.data,self.t0,self.n)
+  else:
+   #Queue the buffer and continue staging in a free one
+   tic = time.time()
+   self.queue.put((self.data,self.t0,self.n))
+   self.max_backlog = max(self.max_backlog,self.queue.qsize())
+   self.data = self.free.get()
+   self.blocked_time += time.time() - tic
+  self.n = 0
+
+  return
+
+ def write(self,data,t0,n):
+
+  with hdf5_lock:
+   for var in self.variables:
+    self.variables[var][t0:t0+n] = data[var][0:n]
+    self.bytes_written += data[var][0:n].nbytes
+
+  return
+
+ def write_loop(self,):
+
+  while True:
+   item = self.queue.get()
+   if item is None: break
+   (data,t0,n) = item
+   try:
+    self.write(data,t0,n)
+   except Exception as error:
+    self.error = error
+   self.free.put(data)
+   self.queue.task_done()
+
+  return
+
+ def sync(self,):
+
+  #Write the staged time steps and wait until the writer thread is done with them
+  self.flush()
+  if self.asynchronous:
+   tic = time.time()
+   self.queue.join()
+   self.blocked_time += time.time() - tic
+  if self.error is not None: raise self.error
+
+  return
+
+ def close(self,):
+
+  #Write the remaining time steps
+  self.flush()
+
+  #Drain the queue and stop the writer thread
+  if self.asynchronous:
+   tic = time.time()
+   self.queue.put(None)
+   self.writer.join()
+   self.asynchronous = False
+   self.drain_time += time.time() - tic
+  if self.error is not None: raise self.error
+
+  return
+
+class Output_Aggregator:
+
+ #Accumulates the output variables in memory over an output period
+ #(mean, sum, min, max or instantaneous) and returns one record per period
+
+ def __init__(self,shapes,modes):
+
+  self.modes = modes
+  self.accumulators = {}
+  self.output = {}
+  for var in shapes:
+   if modes[var] not in ['mean','sum','min','max','instantaneous']:
+    exit('Error: Unknown aggregation mode %s for %s' % (modes[var],var))
+   self.accumulators[var] = np.zeros(shapes[var],dtype=np.float64)
+   self.output[var] = np.zeros(shapes[var],dtype=np.float64)
+  self.count = 0
+  self.reset()
+
+  return
+
+ def reset(self,):
+
+  for var in self.accumulators:
+   mode = self.modes[var]
+   if mode == 'min': self.accumulators[var][...] = np.inf
+   elif mode == 'max': self.accumulators[var][...] = -np.inf
+   else: self.accumulators[var][...] = 0.0
+  self.count = 0
+
+  return
+
+ def accumulate(self,values):
+
+  for var in self.accumulators:
+   mode = self.modes[var]
+   acc = self.accumulators[var]
+   if mode in ['mean','sum']: np.add(acc,values[var],out=acc)
+   elif mode == 'min': np.minimum(acc,values[var],out=acc)
+   elif mode == 'max': np.maximum(acc,values[var],out=acc)
+   elif mode == 'instantaneous': acc[...] = values[var]
+  self.count += 1
+
+  return
+
+ def record(self,):
+
+  #Finalize the period and start the next one
+  for var in self.accumulators:
+   if self.modes[var] == 'mean': np.divide(self.accumulators[var],self.count,out=self.output[var])
+   else: self.output[var][...] = self.accumulators[var]
+  self.reset()
+
+  return self.output
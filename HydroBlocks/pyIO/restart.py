@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import h5py
+from pyIO.lock import hdf5_lock
+
+#Restart files store all the state arrays packed in a single contiguous byte record
+#(one dataset, optionally gzip compressed) together with its layout and a version
+#tag. Files without the tag are read as the legacy format (one dataset per array).
+RESTART_FORMAT = 'hydroblocks_restart'
+RESTART_VERSION = 1
+
+#Noah-MP state saved in the restart file
+NOAHMP_STATE = ['smceq','albold','sneqvo','stc','sh2o','smc','tah','eah','fwet',
+                'canliq','canice','tv','tg','qsfc1d','qsnow','isnow','zsnso',
+                'sndpth','swe','snice','snliq','zwt','wa','wt','wslake','lfmass',
+                'rtmass','stmass','wood','stblcp','fastcp','plai','psai','cm','ch',
+                'tauss','smcwtd','deeprech','rech']
+
+#Noah-MP variables that are also carried from one time step to the next within a
+#run (saved in the checkpoints on top of the restart state)
+NOAHMP_CHECKPOINT = ['runsf','runsb','si0','si1','zwt0','minzwt','dzwt','hdiv','ficeold',
+                     'fsno','emissi','trad','salb','t2mv','t2mb','q2mv','q2mb','ponding',
+                     'ponding1','ponding2','qsnbot','tgv','tgb','fveg','fvgmax','fvegmp',
+                     'fsh','ssoil','fira','ecan','esoil','tr','evc','fcev','fgev','fctr',
+                     'rssun','rssha','chv','chb','chleaf','chuc','chv2','chb2','irc','irg',
+                     'irb','shc','shg','shb','evg','evb','ghv','ghb','errwat','root_depth']
+
+def Pack_State(state):
+
+ #Copy the arrays into one contiguous byte record (8 byte aligned)
+ layout = []
+ offset = 0
+ for var in state:
+  array = np.asarray(state[var])
+  layout.append({'name':var,'dtype':array.dtype.str,'shape':list(array.shape),'offset':offset})
+  offset += 8*((array.nbytes + 7)//8)
+ record = np.zeros(offset,dtype=np.uint8)
+ for (item,var) in zip(layout,state):
+  array = np.ascontiguousarray(state[var])
+  record[item['offset']:item['offset']+array.nbytes] = array.view(np.uint8).ravel()
+
+ return (record,layout)
+
+def Unpack_State(record,layout):
+
+ #Views of the arrays in the record (no copy)
+ state = {}
+ for item in layout:
+  dtype = np.dtype(item['dtype'])
+  count = int(np.prod(item['shape']))
+  state[item['name']] = np.frombuffer(record,dtype=dtype,count=count,
+                                      offset=item['offset']).reshape(item['shape'])
+
+ return state
+
+def Collect_State(obj,prefix,state,scalars,ndim=None):
+
+ #Add the numpy arrays (and numeric scalars) that are attributes of obj
+ for var in vars(obj):
+  value = getattr(obj,var)
+  if isinstance(value,np.ndarray):
+   if (ndim is not None) and (value.ndim != ndim): continue
+   state['%s/%s' % (prefix,var)] = value
+  elif isinstance(value,(int,float,np.integer,np.floating)) and not isinstance(value,bool):
+   scalars['%s/%s' % (prefix,var)] = value.item() if isinstance(value,np.generic) else value
+
+ return
+
+def Scatter_State(obj,prefix,state,scalars):
+
+ #Copy the saved arrays (in place) and scalars back into obj
+ for key in state:
+  (group,var) = key.split('/',1)
+  if group != prefix: continue
+  value = getattr(obj,var,None)
+  if isinstance(value,np.ndarray) and (value.shape == state[key].shape): value[...] = state[key]
+  else: setattr(obj,var,np.copy(state[key]))
+ for key in scalars:
+  (group,var) = key.split('/',1)
+  if group != prefix: continue
+  setattr(obj,var,scalars[key])
+
+ return
+
+def Write_Restart(file,record,layout,compression=None,attributes=None):
+
+ #Write to a temporary file and move it into place so a partial file is never left behind
+ tmp = '%s.tmp' % file
+ with hdf5_lock:
+  fp = h5py.File(tmp,'w')
+  fp.attrs['format'] = RESTART_FORMAT
+  fp.attrs['version'] = RESTART_VERSION
+  fp.attrs['layout'] = json.dumps(layout)
+  if attributes is not None: fp.attrs['attributes'] = json.dumps(attributes)
+  if compression is None:
+   fp.create_dataset('state',data=record)
+  else:
+   fp.create_dataset('state',data=record,compression='gzip',compression_opts=compression,
+                     chunks=(min(record.size,2**22),))
+  fp.close()
+ os.replace(tmp,file)
+
+ return
+
+def Read_Restart(file,attributes=False):
+
+ with hdf5_lock:
+  fp = h5py.File(file,'r')
+  if fp.attrs.get('format',None) != RESTART_FORMAT:
+   #Legacy format (one dataset per array)
+   state = {}
+   for var in fp: state[var] = fp[var][:]
+   fp.close()
+   if attributes: return (state,{})
+   return state
+  version = int(fp.attrs['version'])
+  if version > RESTART_VERSION:
+   fp.close()
+   exit('Error: Restart file %s has version %d (supported up to %d)' % (file,version,RESTART_VERSION))
+  layout = json.loads(fp.attrs['layout'])
+  info = json.loads(fp.attrs.get('attributes','{}'))
+  #Single bulk read of the record
+  dataset = fp['state']
+  record = np.empty(dataset.shape,dtype=np.uint8)
+  dataset.read_direct(record)
+  fp.close()
+
+ if attributes: return (Unpack_State(record,layout),info)
+ return Unpack_State(record,layout)
+
+def Latest_Checkpoint(dir):
+
+ #Most recent checkpoint in dir that can be read back (None if there is none)
+ if os.path.exists(dir) == False: return None
+ files = sorted([file for file in os.listdir(dir) if file.startswith('checkpoint_') and file.endswith('.h5')])
+ for file in files[::-1]:
+  try:
+   with hdf5_lock:
+    fp = h5py.File('%s/%s' % (dir,file),'r')
+    valid = (fp.attrs.get('format',None) == RESTART_FORMAT) and ('state' in fp)
+    info = json.loads(fp.attrs.get('attributes','{}'))
+    fp.close()
+  except Exception:
+   valid = False
+  if valid and ('date' in info): return ('%s/%s' % (dir,file),info)
+
+ return None
+
+class Restart_Writer:
+
+ #Packs the state when save is called (so the model can keep going) and writes
+ #the record on a background thread when asynchronous is set
+
+ def __init__(self,compression=None,asynchronous=True):
+
+  self.compression = compression
+  self.asynchronous = asynchronous
+  self.thread = None
+  self.error = None
+  self.write_time = 0.0
+
+  return
+
+ def save(self,file,state,attributes=None):
+
+  #Only one restart is written at a time
+  self.wait()
+
+  (record,layout) = Pack_State(state)
+  if self.asynchronous == False:
+   self.write(file,record,layout,attributes)
+   self.wait()
+  else:
+   self.thread = threading.Thread(target=self.write,args=(file,record,layout,attributes))
+   self.thread.daemon = True
+   self.thread.start()
+
+  return
+
+ def write(self,file,record,layout,attributes=None):
+
+  tic = time.time()
+  try:
+   Write_Restart(file,record,layout,self.compression,attributes)
+  except Exception as error:
+   self.error = error
+  self.write_time += time.time() - tic
+
+  return
+
+ def wait(self,):
+
+  if self.thread is not None:
+   self.thread.join()
+   self.thread = None
+  if self.error is not None:
+   error = self.error
+   self.error = None
+   raise error
+
+  return
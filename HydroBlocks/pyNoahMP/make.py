@@ -9,6 +9,14 @@ os.system('make')
 #Create signature file
 cmd = 'f2py pyNoahMP.f90 -h NoahMP.pyf -m NoahMP --overwrite-signature'
 os.system(cmd)
+#Release the GIL in run_model (lets the forcing/output threads run during the time step)
+lines = open('NoahMP.pyf').read().split('\n')
+fp = open('NoahMP.pyf','w')
+for line in lines:
+ fp.write(line + '\n')
+ if line.strip().startswith('subroutine run_model('):
+  fp.write(line[0:len(line)-len(line.lstrip())] + '    threadsafe\n')
+fp.close()
 #Create driver library
 cmd = 'f2py --debug -lgomp -c NoahMP.pyf *.o ../Utility_routines/*.o --fcompiler=gnu95 -L/lib64 -L/usr/lib64 --f90flags="-w -fopenmp -g -Werror -fmodule-private -fimplicit-none -fbounds-check -fcheck=array-temps,bounds,do,mem,pointer"'
 
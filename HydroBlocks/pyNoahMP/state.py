@@ -0,0 +1,29 @@
+import numpy as np
+
+#Noah-MP module arrays used by the time step (forcing, state, fluxes and the
+#parameters read by the water balance, output and human water use routines)
+STATE_ARRAYS = ['lwdn','swdn','psfc','p_ml','u_ml','v_ml','t_ml','q_ml','qsfc1d','prcp',
+                'co2air','o2air','sldpth','zsoil','smc','sh2o','stc','tv','zwt','wa','wt',
+                'swe','canliq','canice','dzwt','si0','si1','hdiv','runsf','runsb','ecan',
+                'etran','esoil','fsh','fcev','fgev','fctr','ssoil','fira','sav','sag','trad',
+                'salb','vegtyp','smcref','smcmax','wltsmc0','satdk0','drysmc0','maxsmc0',
+                'bb0','satpsi0','root_depth']
+
+#Noah-MP module scalars that are fixed once the model is initialized
+STATE_SCALARS = ['ncells','nsoil','nsnow','dt']
+
+class NoahMP_State:
+
+ #Numpy views of the Noah-MP module arrays bound once after the arrays are allocated.
+ #Every attribute access on the f2py module goes through its lookup and creates a new
+ #array object; the views share the memory of the module arrays, so they see (and
+ #make) the same updates. The arrays must only be updated in place ([...] = ...).
+
+ def __init__(self,model):
+
+  for var in STATE_ARRAYS:
+   setattr(self,var,getattr(model,var).view(np.ndarray))
+  for var in STATE_SCALARS:
+   setattr(self,var,np.asarray(getattr(model,var))[()])
+
+  return
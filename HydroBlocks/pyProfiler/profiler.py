@@ -0,0 +1,107 @@
+import json
+import time
+import tracemalloc
+
+class Profiler:
+
+ #Accumulates the wall time and the number of calls of each phase of the time
+ #loop together with a set of counters (e.g., bytes read/written). A phase is
+ #timed with tic/toc so that a disabled profiler only costs a function call.
+ #With allocations set (debug), the peak memory allocated within each call of a
+ #phase is traced (tracemalloc, which numpy reports its arrays to) and, once warm
+ #is set by the caller (e.g., after the first time step), the calls that allocate
+ #threshold bytes or more are counted. The phases must not be nested in that mode.
+
+ def __init__(self,enabled=False,allocations=False,threshold=2**20):
+
+  self.enabled = enabled
+  self.phases = {} #phase -> {'calls','time'}
+  self.counters = {}
+  self.allocations = enabled and allocations
+  self.threshold = threshold #bytes
+  self.allocated = 0 #traced memory at tic
+  self.warm = False
+  if self.allocations and (tracemalloc.is_tracing() == False): tracemalloc.start()
+
+  return
+
+ def tic(self,):
+
+  if self.enabled == False: return 0.0
+  if self.allocations:
+   tracemalloc.reset_peak()
+   self.allocated = tracemalloc.get_traced_memory()[0]
+  return time.perf_counter()
+
+ def toc(self,phase,tic):
+
+  if self.enabled == False: return
+  dt = time.perf_counter() - tic
+  if phase not in self.phases: self.phases[phase] = {'calls':0,'time':0.0}
+  self.phases[phase]['calls'] += 1
+  self.phases[phase]['time'] += dt
+  if self.allocations: self.count_allocations(phase,tracemalloc.get_traced_memory()[1] - self.allocated)
+
+  return
+
+ def count_allocations(self,phase,peak):
+
+  #Peak bytes allocated during the call
+  stats = self.phases[phase]
+  if 'peak_bytes' not in stats:
+   stats.update({'warmup_peak_bytes':0,'peak_bytes':0,'large_allocations':0,'warm_calls':0})
+  if self.warm == False:
+   stats['warmup_peak_bytes'] = max(stats['warmup_peak_bytes'],peak)
+   return
+  stats['warm_calls'] += 1
+  stats['peak_bytes'] = max(stats['peak_bytes'],peak)
+  if peak >= self.threshold: stats['large_allocations'] += 1
+
+  return
+
+ def allocation_report(self,):
+
+  #One line per phase: calls after the warm up that allocated threshold bytes or more
+  lines = []
+  for phase in sorted(self.phases):
+   stats = self.phases[phase]
+   if 'peak_bytes' not in stats: continue
+   lines.append('Allocations %s: %d of %d calls >= %d bytes (peak %d bytes, warm up %d bytes)' % (
+                phase,stats['large_allocations'],stats['warm_calls'],self.threshold,
+                stats['peak_bytes'],stats['warmup_peak_bytes']))
+
+  return lines
+
+ def count(self,counter,value):
+
+  if self.enabled == False: return
+  self.counters[counter] = self.counters.get(counter,0) + value
+
+  return
+
+ def summary(self,total=None):
+
+  #Per phase time (seconds), calls, mean time per call (ms) and fraction of the total
+  if total is None: total = sum([self.phases[phase]['time'] for phase in self.phases])
+  output = {'phases':{},'counters':dict(self.counters),'total_time':total}
+  for phase in self.phases:
+   (calls,seconds) = (self.phases[phase]['calls'],self.phases[phase]['time'])
+   output['phases'][phase] = {'calls':calls,
+                              'time':seconds,
+                              'mean_time_ms':1000*seconds/max(calls,1),
+                              'fraction':seconds/total if total > 0 else 0.0}
+   for var in ['peak_bytes','warmup_peak_bytes','large_allocations','warm_calls']:
+    if var in self.phases[phase]: output['phases'][phase][var] = self.phases[phase][var]
+
+  return output
+
+ def dump(self,file,total=None,**kwargs):
+
+  if self.enabled == False: return
+  output = self.summary(total)
+  output.update(kwargs)
+  fp = open(file,'w')
+  json.dump(output,fp,indent=1,sort_keys=True)
+  fp.close()
+
+  return
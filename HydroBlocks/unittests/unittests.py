@@ -4,12 +4,70 @@ import unittest
 import sys
 sys.path.append('../')
 from pyDTopmodel import dynamic_topmodel
+from pyDTopmodel import solvers
 from pyRichards import richards
+from pyIO import forcing
+from pyIO import output
+from pyIO import restart
+from pyProfiler.profiler import Profiler
 #import pyDTopmodel.dynamic_topmodel_tools as dtt
 import numpy as np
 import scipy
 import scipy.sparse
+import scipy.sparse.linalg
 import time
+import os
+import fcntl
+import shutil
+import tempfile
+import threading
+import netCDF4 as nc
+import h5py
+import datetime
+
+def Synthetic_Flow_Network(nhru):
+
+ #Downslope network with a few return flows
+ rows = np.repeat(np.arange(nhru-1),2)
+ cols = np.minimum(rows + np.random.randint(low=1,high=20,size=rows.size),nhru-1)
+ back = np.random.choice(np.arange(1,nhru),size=50,replace=False)
+ rows = np.concatenate([rows,back,np.arange(nhru)])
+ cols = np.concatenate([cols,back-1,np.arange(nhru)])
+ data = np.concatenate([np.random.uniform(size=cols.size-nhru),0.05*np.ones(nhru)])
+ tmp = scipy.sparse.csr_matrix((data,(rows,cols)),shape=(nhru,nhru))
+ sums = np.array(tmp.sum(axis=1))[:,0]
+ flow_matrix = scipy.sparse.csr_matrix(scipy.sparse.diags(1.0/sums)*tmp)
+ area = np.random.uniform(low=900,high=90000,size=nhru)
+ dx = np.random.uniform(low=30,high=300,size=nhru)
+
+ return (flow_matrix,area,dx)
+
+def Synthetic_Forcing_File(file,nhru,ntime,vars):
+
+ #Input file with a forcing group of random time series
+ fp = nc.Dataset(file,'w',format='NETCDF4')
+ fp.createDimension('hsu',nhru)
+ fp.createDimension('time',ntime)
+ grp = fp.createGroup('meteorology')
+ data = {}
+ for var in vars:
+  data[var] = np.random.uniform(size=(ntime,nhru)).astype(np.float32)
+  grp.createVariable(var,'f4',('time','hsu'))[:] = data[var]
+ fp.close()
+
+ return data
+
+def Lateral_Divergence_Reference(sldpth,zwt,qout,qin):
+
+ #Per hru distribution of the net lateral outflow over the saturated layers
+ hdiv = np.zeros(sldpth.shape,dtype=np.float32)
+ for ihru in range(sldpth.shape[0]):
+  m = np.cumsum(sldpth[ihru,:]) > np.abs(zwt[ihru])
+  if np.sum(m) > 0:
+   idx = np.where(m)[0][0]
+   fs = sldpth[ihru,idx:]/np.sum(sldpth[ihru,idx:])
+   hdiv[ihru,idx:] = 1000*fs*(qout[ihru]-qin[ihru])
+ return hdiv
 
 class Richards(unittest.TestCase):
 
@@ -28,7 +86,7 @@ class Richards(unittest.TestCase):
    #choose layer
    psi = []
    bpsi = []
-   for il in xrange(nsoil):
+   for il in range(nsoil):
     psi.append(model.calculate_soil_moisture_potential(il))
     tmp = model.theta[:,il]
     m = (tmp <= (1+eps)*model.thetar)
@@ -77,16 +135,16 @@ class Richards(unittest.TestCase):
    model.width = scipy.sparse.csr_matrix(tsymm)
    model.I = model.width.copy()
    model.I[model.I != 0] = 1
-   print '%d connections out of %d possible connections' % (np.sum(model.width != 0),nhru*nhru)
+   print('%d connections out of %d possible connections' % (np.sum(model.width != 0),nhru*nhru))
    #update (dense)
    tic = time.time()
    model.update(type='dense')
-   print 'dense',time.time()-tic
+   print('dense',time.time()-tic)
    hdiv = np.copy(model.hdiv)
    #update (sparse)
    tic = time.time()
    model.update(type='sparse')
-   print 'sparse',time.time()-tic
+   print('sparse',time.time()-tic)
    bhdiv = np.copy(model.hdiv)
    #compare
    self.assertTrue(np.allclose(hdiv,bhdiv,rtol=1e-10, atol=1e-50))
@@ -108,6 +166,49 @@ class DynamicTopmodel(unittest.TestCase):
     output = dynamic_topmodel.Calculate_Flux_Subsurface(si,T0,beta,m,sdmax)
     self.assertTrue(np.allclose(output,np.array([4.54218782e-08,]),rtol=1e-05, atol=1e-08))
 
+  def test_lateral_divergence(self):
+    np.random.seed(1)
+    nhru = 100
+    sldpth = np.random.uniform(0.05,0.5,(nhru,4)).astype(np.float32)
+    zwt = np.random.uniform(-2.5,0.0,nhru).astype(np.float32)
+    qout = np.random.uniform(0.0,1e-3,nhru)
+    qin = np.random.uniform(0.0,1e-3,nhru)
+    output = dynamic_topmodel.Calculate_Lateral_Divergence(sldpth,zwt,qout,qin)
+    self.assertTrue(np.array_equal(output,Lateral_Divergence_Reference(sldpth,zwt,qout,qin)))
+
+  def test_lateral_divergence_preallocated(self):
+    np.random.seed(1)
+    nhru = 100
+    sldpth = np.asfortranarray(np.random.uniform(0.05,0.5,(nhru,4)).astype(np.float32))
+    lateral_divergence = dynamic_topmodel.Lateral_Divergence(sldpth)
+    hdiv = np.zeros(sldpth.shape,dtype=np.float32,order='F')
+    for i in range(3):
+     zwt = np.random.uniform(-2.5,0.0,nhru).astype(np.float32)
+     qout = np.random.uniform(0.0,1e-3,nhru)
+     qin = np.random.uniform(0.0,1e-3,nhru)
+     lateral_divergence(zwt,qout,qin,hdiv)
+     self.assertTrue(np.array_equal(hdiv,Lateral_Divergence_Reference(sldpth,zwt,qout,qin)))
+
+  def test_lateral_divergence_allocations(self):
+    np.random.seed(1)
+    nhru = 50000
+    sldpth = np.asfortranarray(np.random.uniform(0.05,0.5,(nhru,4)).astype(np.float32))
+    lateral_divergence = dynamic_topmodel.Lateral_Divergence(sldpth)
+    hdiv = np.zeros(sldpth.shape,dtype=np.float32,order='F')
+    zwt = np.random.uniform(-2.5,0.0,nhru).astype(np.float32)
+    qout = np.random.uniform(0.0,1e-3,nhru)
+    qin = np.random.uniform(0.0,1e-3,nhru)
+    #Same threshold as the model (HydroBlocks.segment_information)
+    profiler = Profiler(True,True,max(4*nhru,16*np.getbufsize()))
+    for itime in range(5):
+     t0 = profiler.tic()
+     lateral_divergence(zwt,qout,qin,hdiv)
+     profiler.toc('lateral_divergence',t0)
+     profiler.warm = True
+    stats = profiler.summary()['phases']['lateral_divergence']
+    self.assertEqual(stats['warm_calls'],4)
+    self.assertEqual(stats['large_allocations'],0)
+
   def test_kinematic_wave_solution_python_explicit_onlyrecharge(self):
 
     nhru = 2
@@ -220,6 +321,221 @@ class DynamicTopmodel(unittest.TestCase):
     qout_true = np.array([0.666666,0.888888])
     self.assertTrue(np.allclose(qout,qout_true,rtol=1e-05, atol=1e-08))
 
+  def test_kinematic_wave_solution_topological_implicit_3hru_returnflow3(self):
+
+    nhru = 3
+    qout = np.zeros(nhru)
+    qin = np.zeros(nhru)
+    storage1 = np.zeros(nhru)
+    qin1 = np.zeros(nhru)
+    qin_outlet = np.zeros(nhru)
+    area_outlet = np.zeros(nhru)
+    storage = 0.0*np.ones(nhru)
+    qout1 = np.ones(nhru)
+    recharge1 = 1.0*np.ones(nhru)
+    recharge = 1.0*np.ones(nhru)
+    celerity = 1.0*np.ones(nhru)
+    celerity1 = np.ones(nhru)
+    area = 1.0*np.ones(nhru)
+    dx = 1.0*np.ones(nhru)
+    dt = 2.0
+    nthreads = 1
+    maxntt = 1
+    w = 0.5
+    flow_matrix = scipy.sparse.csr_matrix(np.array([[0.,1.,0],[0.,0.,1.],[0.,0.,0.5]]))
+    solver = solvers.Topological_Solver(flow_matrix,area,dx)
+    (storage,storage1,qout,qout1,qin,qin1,celerity,celerity1) = dynamic_topmodel.Update(recharge,
+     storage,qout,qin,recharge1,storage1,qout1,qin1,area,dx,dt,celerity,celerity1,flow_matrix,
+     qin_outlet,area_outlet,nthreads,maxntt,w,solver)
+    qout_true = np.array([1.0,1.5,2.333333])
+    self.assertTrue(np.allclose(qout,qout_true,rtol=1e-05, atol=1e-08))
+
+  def test_kinematic_wave_solution_topological_implicit_3hru_backflow(self):
+
+    nhru = 3
+    qout = np.zeros(nhru)
+    qin = np.zeros(nhru)
+    storage1 = np.zeros(nhru)
+    qin1 = np.zeros(nhru)
+    qin_outlet = np.zeros(nhru)
+    area_outlet = np.zeros(nhru)
+    storage = 0.0*np.ones(nhru)
+    qout1 = np.ones(nhru)
+    recharge1 = 1.0*np.ones(nhru)
+    recharge = 1.0*np.ones(nhru)
+    celerity = 1.0*np.ones(nhru)
+    celerity1 = np.ones(nhru)
+    area = 1.0*np.ones(nhru)
+    dx = 1.0*np.ones(nhru)
+    dt = 2.0
+    nthreads = 1
+    maxntt = 1
+    w = 0.5
+    flow_matrix = scipy.sparse.csr_matrix(np.array([[0.,1.,0],[0.5,0.,0.5],[0.,0.,0]]))
+    solver = solvers.Topological_Solver(flow_matrix,area,dx)
+    self.assertEqual(solver.ncyclic,2)
+    (storage,storage1,qout,qout1,qin,qin1,celerity,celerity1) = dynamic_topmodel.Update(recharge,
+     storage,qout,qin,recharge1,storage1,qout1,qin1,area,dx,dt,celerity,celerity1,flow_matrix,
+     qin_outlet,area_outlet,nthreads,maxntt,w,solver)
+    qout_true = np.array([1.42857142857,1.71428571429,1.42857142857])
+    self.assertTrue(np.allclose(qout,qout_true,rtol=1e-05, atol=1e-08))
+
+  def test_topological_solver_sparse_comparison(self):
+
+    np.random.seed(1)
+    nhru = 5000
+    (flow_matrix,area,dx) = Synthetic_Flow_Network(nhru)
+    solver = solvers.Topological_Solver(flow_matrix,area,dx)
+    for i in range(3):
+     p1 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     p2 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     qout = solver.solve(p1,p2)
+     #Baseline
+     scarea = area/dx
+     A = scipy.sparse.diags(scarea)*flow_matrix*scipy.sparse.diags(p2/scarea)
+     bqout = scipy.sparse.linalg.spsolve(scipy.sparse.csc_matrix((scipy.sparse.identity(nhru) - A).T),p1)
+     self.assertTrue(np.allclose(qout,bqout,rtol=1e-10, atol=1e-50))
+    self.assertTrue(solver.ncycles > 0)
+
+  def test_topological_solver_basins(self):
+
+    np.random.seed(1)
+    nhru = 2000
+    #Four basins that are solved on two threads
+    basins = [Synthetic_Flow_Network(nhru) for i in range(4)]
+    flow_matrix = scipy.sparse.block_diag([basin[0] for basin in basins],format='csr')
+    area = np.concatenate([basin[1] for basin in basins])
+    dx = np.concatenate([basin[2] for basin in basins])
+    solver = solvers.Topological_Solver(flow_matrix,area,dx,nthreads=2)
+    self.assertEqual(solver.nbasins,4)
+    self.assertEqual(solver.gstart.size,3)
+    p1 = np.random.uniform(low=0.0,high=1.0,size=4*nhru)
+    p2 = np.random.uniform(low=0.0,high=1.0,size=4*nhru)
+    qout = solver.solve(p1,p2)
+    #Baseline
+    bqout = solvers.Sparse_Solver(flow_matrix,area,dx).solve(p1,p2)
+    self.assertTrue(np.allclose(qout,bqout,rtol=1e-10, atol=1e-50))
+
+  def test_pipelined_routing(self):
+
+    #Sequential and pipelined (surface with the excess runoff of the previous time step)
+    def run(pipelined,nhru=200,nsteps=96):
+     np.random.seed(1)
+     rows = np.arange(1,nhru)
+     cols = np.array([np.random.randint(max(0,i-5),i) for i in rows])
+     flow_matrix = scipy.sparse.csr_matrix((np.ones(nhru-1),(rows,cols)),shape=(nhru,nhru))
+     flow_matrix.setdiag(flow_matrix.diagonal())
+     model = dynamic_topmodel.Dynamic_Topmodel(nhru,1,False)
+     model.dt = 3600.0
+     model.area[:] = np.random.uniform(low=900,high=9000,size=nhru)
+     model.dx[:] = 30.0
+     model.m[:] = 0.1
+     model.sdmax[:] = 1.0
+     model.T0[:] = 1e-4
+     model.beta[:] = np.random.uniform(low=0.01,high=0.2,size=nhru)
+     model.mannings[:] = 0.03
+     model.si[:] = np.random.uniform(low=0.0,high=0.05,size=nhru)
+     model.flow_matrix = flow_matrix
+     model.solver = solvers.Topological_Solver(flow_matrix,model.area,model.dx)
+     if pipelined:
+      model.pipelined = True
+      model.solver_surface = solvers.Topological_Solver(flow_matrix,model.area,model.dx)
+     si = []
+     outflow = 0.0 #hru 0 drains out of the domain
+     for itime in range(nsteps):
+      model.r[:] = 1e-5*((itime//24) % 2 == 0)*np.random.uniform(low=0.5,high=1.5,size=nhru)
+      model.qsurf[:] = 0.2*model.r
+      model.update(1)
+      si.append(np.copy(model.si))
+      outflow += model.dt*model.area[0]/model.dx[0]*model.qout_surface[0]
+     volume = np.sum(model.area*model.storage_surface) + outflow
+     pending = model.dt*np.sum(model.area*model.ex)
+     return (np.array(si),outflow,volume,pending)
+    (si,outflow,volume,pending) = run(False)
+    (psi,poutflow,pvolume,ppending) = run(True)
+    #The subsurface is not changed
+    self.assertTrue(np.array_equal(si,psi))
+    #The water is conserved (the excess runoff of the last time step is still pending)
+    self.assertTrue(ppending > 0.0)
+    self.assertTrue(np.allclose(volume,pvolume + ppending,rtol=1e-10, atol=0.0))
+    #The cumulative outflow is only shifted by the delayed excess runoff (about 1% here)
+    self.assertTrue(np.abs(outflow - poutflow) <= 0.05*outflow)
+
+  def test_sparse_solver_sparse_comparison(self):
+
+    np.random.seed(1)
+    nhru = 5000
+    (flow_matrix,area,dx) = Synthetic_Flow_Network(nhru)
+    solver = solvers.Sparse_Solver(flow_matrix,area,dx)
+    for i in range(3):
+     p1 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     p2 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     qout = solver.solve(p1,p2)
+     #Baseline (assembled for every solve)
+     scarea = area/dx
+     A = scipy.sparse.diags(scarea)*flow_matrix*scipy.sparse.diags(p2/scarea)
+     bqout = scipy.sparse.linalg.spsolve(scipy.sparse.csc_matrix((scipy.sparse.identity(nhru) - A).T),p1)
+     self.assertTrue(np.allclose(qout,bqout,rtol=1e-10, atol=1e-50))
+
+  def test_compiled_solver_sparse_comparison(self):
+
+    try:
+     from pyDTopmodel import kinematic_wave_tools
+    except ImportError:
+     self.skipTest('kinematic_wave_tools is not compiled')
+    np.random.seed(1)
+    nhru = 5000
+    (flow_matrix,area,dx) = Synthetic_Flow_Network(nhru)
+    solver = solvers.Compiled_Solver(flow_matrix,area,dx,nthreads=2)
+    baseline = solvers.Topological_Solver(flow_matrix,area,dx)
+    for i in range(3):
+     p1 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     p2 = np.random.uniform(low=0.0,high=1.0,size=nhru)
+     qout = np.copy(solver.solve(p1,p2))
+     bqout = baseline.solve(p1,p2)
+     self.assertTrue(np.allclose(qout,bqout,rtol=1e-10, atol=1e-50))
+
+  def test_compiled_solver_unconverged_cycle(self):
+
+    try:
+     from pyDTopmodel import kinematic_wave_tools
+    except ImportError:
+     self.skipTest('kinematic_wave_tools is not compiled')
+    #3 hru cycle that keeps almost all its water (Gauss-Seidel needs ~10^4 iterations)
+    flow_matrix = scipy.sparse.csr_matrix(np.array([[0.,1.,0],[0.,0.,1.],[1.,0.,0.]]))
+    area = np.ones(3)
+    dx = np.ones(3)
+    solver = solvers.Compiled_Solver(flow_matrix,area,dx)
+    baseline = solvers.Sparse_Solver(flow_matrix,area,dx)
+    p1 = np.array([1.0,2.0,3.0])
+    p2 = 0.999*np.ones(3)
+    qout = np.copy(solver.solve(p1,p2))
+    bqout = baseline.solve(p1,p2)
+    self.assertEqual(solver.nfallback,1)
+    self.assertTrue(np.allclose(qout,bqout,rtol=1e-10, atol=1e-50))
+
+  def test_kinematic_wave_solver_mkl_fallback(self):
+
+    import HydroBlocks
+    from unittest import mock
+    try:
+     from pyDTopmodel import kinematic_wave_tools
+     auto = 'compiled'
+    except ImportError:
+     auto = 'topological'
+    HB = HydroBlocks.HydroBlocks.__new__(HydroBlocks.HydroBlocks)
+    #MKL is not available (dynamic_topmodel_tools cannot be imported)
+    with mock.patch.dict(sys.modules,{'dynamic_topmodel_tools':None}):
+     #The legacy mkl_flag falls back to the auto solver
+     (HB.metadata,HB.mkl_flag) = ({},True)
+     self.assertEqual(HB.resolve_kinematic_wave_solver(),auto)
+     (HB.metadata,HB.mkl_flag) = ({'kinematic_wave_solver':'auto'},True)
+     self.assertEqual(HB.resolve_kinematic_wave_solver(),auto)
+     #An explicit mkl solver is still required
+     (HB.metadata,HB.mkl_flag) = ({'kinematic_wave_solver':'mkl'},False)
+     self.assertEqual(HB.resolve_kinematic_wave_solver(),'mkl')
+     self.assertRaises(SystemExit,dynamic_topmodel.Dynamic_Topmodel,10,1,True)
+
   '''def test_kinematic_wave_solution_mkl_explicit(self):
 
     nhru = 2
@@ -720,7 +1036,388 @@ class DynamicTopmodel(unittest.TestCase):
     qout_true = np.array([1.42857142857,1.71428571429,1.42857142857])
     self.assertTrue(np.allclose(qout,qout_true,rtol=1e-05, atol=1e-08))'''
 
-suite = unittest.TestLoader().loadTestsFromTestCase(Richards)
-unittest.TextTestRunner(verbosity=2).run(suite)
-#suite = unittest.TestLoader().loadTestsFromTestCase(DynamicTopmodel)
-#unittest.TextTestRunner(verbosity=2).run(suite)
+class Forcing(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.file = '%s/input.nc' % self.dir
+    self.vars = ['tair','precip']
+    self.data = Synthetic_Forcing_File(self.file,20,50,self.vars)
+    self.fp = nc.Dataset(self.file)
+
+  def tearDown(self):
+    self.fp.close()
+    shutil.rmtree(self.dir)
+
+  def forcing_reader(self,prefetch,order):
+    reader = forcing.Forcing_Reader(self.fp,'meteorology',self.vars,5,40,8,prefetch)
+    for itime in order:
+      output = reader.read(itime)
+      for var in self.vars: self.assertTrue(np.array_equal(output[var],self.data[var][5+itime]))
+    reader.close()
+
+  def test_forcing_reader_sequential(self):
+    self.forcing_reader(False,range(40))
+
+  def test_forcing_reader_random(self):
+    self.forcing_reader(False,np.random.randint(0,40,size=100))
+
+  def test_forcing_reader_prefetch_sequential(self):
+    self.forcing_reader(True,range(40))
+
+  def test_forcing_reader_prefetch_random(self):
+    self.forcing_reader(True,np.random.randint(0,40,size=100))
+
+  def shared_reader(self,timeout=3600.0):
+    return forcing.Shared_Forcing_Reader(self.fp,self.file,'meteorology',self.vars,5,40,8,self.dir,timeout)
+
+  def test_shared_forcing_reader_cleanup(self):
+    reader1 = self.shared_reader()
+    reader2 = self.shared_reader()
+    for itime in range(40):
+      output = reader2.read(itime)
+      for var in self.vars: self.assertTrue(np.array_equal(output[var],self.data[var][5+itime]))
+    #The copy stays until its last user closes it
+    reader1.close()
+    self.assertTrue(os.path.exists('%s/complete' % reader2.dir))
+    reader2.close()
+    self.assertFalse(os.path.exists(reader2.dir))
+    self.assertFalse(os.path.exists(reader2.lock_file))
+
+  def test_shared_forcing_reader_dead_loader(self):
+    #Partial copy of a loader that died before completing it
+    reader = self.shared_reader()
+    reader.close()
+    os.makedirs(reader.dir)
+    np.save('%s/tair.npy' % reader.dir,np.zeros((40,20),dtype=np.float32))
+    #Loader that is still running (its lock is released when it dies)
+    fd = os.open(reader.lock_file,os.O_RDWR|os.O_CREAT)
+    fcntl.flock(fd,fcntl.LOCK_EX)
+    threading.Timer(0.5,os.close,[fd]).start()
+    reader = self.shared_reader(timeout=60.0)
+    self.assertTrue(reader.wait_time >= 0.4)
+    for itime in range(40):
+      output = reader.read(itime)
+      for var in self.vars: self.assertTrue(np.array_equal(output[var],self.data[var][5+itime]))
+    reader.close()
+    self.assertFalse(os.path.exists(reader.dir))
+
+class Output(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fp = nc.Dataset('%s/output.nc' % self.dir,'w',format='NETCDF4')
+    self.fp.createDimension('time',30)
+    self.fp.createDimension('hru',10)
+    self.fp.createDimension('soil',4)
+    self.variables = {'trad':self.fp.createVariable('trad','f4',('time','hru')),
+                      'smc':self.fp.createVariable('smc','f4',('time','hru','soil'))}
+
+  def tearDown(self):
+    self.fp.close()
+    shutil.rmtree(self.dir)
+
+  def output_buffer(self,asynchronous):
+    buffer = output.Output_Buffer(self.variables,7,asynchronous,queue_size=1)
+    data = {'trad':np.random.uniform(size=(30,10)).astype(np.float32),
+            'smc':np.random.uniform(size=(30,10,4)).astype(np.float32)}
+    #(with a gap, so that the staged records are not all consecutive)
+    records = list(range(0,12)) + list(range(15,30))
+    for itime in records[0:20]:
+      buffer.stage(itime,{'trad':data['trad'][itime],'smc':data['smc'][itime]})
+    buffer.sync()
+    for var in data: self.assertTrue(np.array_equal(self.variables[var][records[0:20]],data[var][records[0:20]]))
+    for itime in records[20:]:
+      buffer.stage(itime,{'trad':data['trad'][itime],'smc':data['smc'][itime]})
+    buffer.close()
+    for var in data: self.assertTrue(np.array_equal(self.variables[var][records],data[var][records]))
+    self.assertEqual(buffer.bytes_written,len(records)*(10 + 40)*4)
+
+  def test_output_buffer(self):
+    self.output_buffer(False)
+
+  def test_output_buffer_asynchronous(self):
+    self.output_buffer(True)
+
+  def test_output_aggregator(self):
+    modes = {'mean':'mean','sum':'sum','min':'min','max':'max','instantaneous':'instantaneous'}
+    shapes = {}
+    for var in modes: shapes[var] = (10,4)
+    aggregator = output.Output_Aggregator(shapes,modes)
+    for period in range(2):
+      values = np.random.uniform(size=(24,10,4))
+      for itime in range(24): aggregator.accumulate(dict([(var,values[itime]) for var in modes]))
+      record = aggregator.record()
+      self.assertTrue(np.allclose(record['mean'],np.mean(values,axis=0)))
+      self.assertTrue(np.allclose(record['sum'],np.sum(values,axis=0)))
+      self.assertTrue(np.array_equal(record['min'],np.min(values,axis=0)))
+      self.assertTrue(np.array_equal(record['max'],np.max(values,axis=0)))
+      self.assertTrue(np.array_equal(record['instantaneous'],values[-1]))
+      self.assertEqual(aggregator.count,0)
+
+class Restart(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.state = {'smc':np.random.uniform(size=(10,4)).astype(np.float32),
+                  'zwt':np.random.uniform(size=10),
+                  'isnow':np.random.randint(-3,1,size=10).astype(np.int32),
+                  'si':np.random.uniform(size=(3,))}
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def compare(self,state):
+    self.assertEqual(sorted(state.keys()),sorted(self.state.keys()))
+    for var in self.state:
+      self.assertEqual(state[var].dtype,self.state[var].dtype)
+      self.assertTrue(np.array_equal(state[var],self.state[var]))
+
+  def test_restart(self):
+    for compression in [None,4]:
+      file = '%s/restart_%s.h5' % (self.dir,compression)
+      (record,layout) = restart.Pack_State(self.state)
+      restart.Write_Restart(file,record,layout,compression,{'date':'2004-01-02 00:00:00'})
+      self.compare(restart.Read_Restart(file))
+      (state,attributes) = restart.Read_Restart(file,attributes=True)
+      self.compare(state)
+      self.assertEqual(attributes['date'],'2004-01-02 00:00:00')
+
+  def test_restart_writer(self):
+    for asynchronous in [False,True]:
+      file = '%s/restart_%s.h5' % (self.dir,asynchronous)
+      writer = restart.Restart_Writer(None,asynchronous)
+      writer.save(file,self.state)
+      writer.wait()
+      self.compare(restart.Read_Restart(file))
+
+  def test_restart_legacy(self):
+    file = '%s/legacy.h5' % self.dir
+    fp = h5py.File(file,'w')
+    for var in self.state: fp[var] = self.state[var]
+    fp.close()
+    self.compare(restart.Read_Restart(file))
+    self.assertEqual(restart.Read_Restart(file,attributes=True)[1],{})
+
+  def test_restart_version(self):
+    file = '%s/restart.h5' % self.dir
+    (record,layout) = restart.Pack_State(self.state)
+    restart.Write_Restart(file,record,layout)
+    fp = h5py.File(file,'a')
+    fp.attrs['version'] = restart.RESTART_VERSION + 1
+    fp.close()
+    self.assertRaises(SystemExit,restart.Read_Restart,file)
+
+  def test_latest_checkpoint(self):
+    (record,layout) = restart.Pack_State(self.state)
+    for day in [1,2]:
+      restart.Write_Restart('%s/checkpoint_2004-01-0%d_000000.h5' % (self.dir,day),record,layout,
+                            attributes={'date':'2004-01-0%d 00:00:00' % day})
+    #(a checkpoint that was not completely written is skipped)
+    open('%s/checkpoint_2004-01-03_000000.h5' % self.dir,'w').close()
+    (file,info) = restart.Latest_Checkpoint(self.dir)
+    self.assertEqual(os.path.basename(file),'checkpoint_2004-01-02_000000.h5')
+    self.assertEqual(info['date'],'2004-01-02 00:00:00')
+
+class Checkpoint(unittest.TestCase):
+
+  def setUp(self):
+    try:
+     from pyNoahMP.NoahMP import model
+    except ImportError:
+     self.skipTest('pyNoahMP is not compiled')
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_checkpoint_resume(self):
+    import HydroBlocks
+    sys.path.append('../benchmarks')
+    import benchmarks
+    idate = datetime.datetime(2004,1,1)
+    fdate = datetime.datetime(2004,1,3)
+    benchmarks.Create_Synthetic_Catchment('%s/input.nc' % self.dir,50,idate,fdate,3600.0)
+    info = benchmarks.Create_Metadata(self.dir,'%s/input.nc' % self.dir,'dtopmodel',False,1,3600.0,idate,fdate)
+    info['output']['frequency'] = 'dt'
+    info['checkpoint'] = {'interval_days':1}
+    #Run the segment with a checkpoint after the first day (the driver leaves the CO2
+    #partial pressure of Noah-MP uninitialized, see Run_Ensemble)
+    HB = HydroBlocks.initialize(info)
+    HB.noahmp.co2pp[:] = 0.0
+    HB.run(info)
+    HB.finalize()
+    file = '%s/restart/checkpoints/checkpoint_2004-01-02_000000.h5' % self.dir
+    (state,attributes) = restart.Read_Restart(file,attributes=True)
+    fp = nc.Dataset('%s/output/2004-01-01.nc' % self.dir)
+    baseline = fp.groups['data'].variables['trad'][:]
+    fp.close()
+    #Resume from the checkpoint in a new model
+    HB = HydroBlocks.initialize(info)
+    HB.noahmp.co2pp[:] = 0.0
+    HB.resume(file)
+    self.assertEqual(HB.itime,24)
+    (rstate,rscalars) = HB.checkpoint_state()
+    #(Noah-MP does not initialize all the variables, e.g., errwat, so they can hold nans)
+    for var in state: self.assertTrue(np.array_equal(rstate[var],state[var],equal_nan=True))
+    self.assertEqual(rscalars,attributes['scalars'])
+    HB.run(info)
+    HB.finalize()
+    #The records before the checkpoint are kept and the rest are written again
+    fp = nc.Dataset('%s/output/2004-01-01.nc' % self.dir)
+    trad = fp.groups['data'].variables['trad'][:]
+    fp.close()
+    self.assertTrue(np.array_equal(trad[0:24],baseline[0:24]))
+    self.assertTrue(np.all(np.isfinite(trad[24:])))
+
+class Ensemble(unittest.TestCase):
+
+  def setUp(self):
+    try:
+     from pyNoahMP.NoahMP import model
+    except ImportError:
+     self.skipTest('pyNoahMP is not compiled')
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_ensemble_groundwater_supply(self):
+    import concurrent.futures
+    import multiprocessing
+    sys.path.append('../benchmarks')
+    import benchmarks
+    idate = datetime.datetime(2004,1,1)
+    fdate = datetime.datetime(2004,1,2)
+    nhru = 50
+    benchmarks.Create_Synthetic_Catchment('%s/input.nc' % self.dir,nhru,idate,fdate,3600.0,hwu=True)
+    info = benchmarks.Create_Metadata(self.dir,'%s/input.nc' % self.dir,'dtopmodel',False,1,3600.0,idate,fdate)
+    info['water_management']['hwu_gw_flag'] = True
+    info['ensemble'] = {'members':2}
+    #Noah-MP keeps state in the module globals of the library between the models of a
+    #process, so the members are only identical in a new process (as in Driver)
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1,mp_context=context) as executor:
+     output = executor.submit(Run_Ensemble,info).result()
+    self.assertEqual(output['nhru'],2*nhru)
+    #The members are not connected
+    F = output['flow_matrix']
+    self.assertEqual(F[0:nhru,nhru:].nnz + F[nhru:,0:nhru].nnz,0)
+    self.assertEqual((F[0:nhru,0:nhru] != F[nhru:,nhru:]).nnz,0)
+    #The groundwater supply arrays hold every cell of the ensemble
+    for var in ['sti','beta','dem','well_depth','supply_gw','alloc_gw','mask_gw']:
+      self.assertEqual(np.shape(output[var]),(2*nhru,))
+    self.assertTrue(np.array_equal(output['sti'][0:nhru],output['sti'][nhru:]))
+    #Identical members give identical results
+    smc = output['smc']
+    self.assertTrue(np.array_equal(smc[0:nhru],smc[nhru:]))
+
+def Run_Ensemble(info):
+
+  #Run the ensemble of Ensemble.test_ensemble_groundwater_supply (in its own process)
+  import HydroBlocks
+  HB = HydroBlocks.initialize(info)
+  #The driver does not set the CO2 partial pressure of Noah-MP (co2pp is left
+  #uninitialized), so it is given the same value in every cell of the members
+  HB.noahmp.co2pp[:] = 0.0
+  output = {'nhru':HB.nhru,'flow_matrix':HB.dtopmodel.flow_matrix.copy()}
+  for var in ['sti','beta','dem','well_depth','supply_gw','alloc_gw','mask_gw']:
+    output[var] = np.copy(getattr(HB.hwu,var))
+  HB.run(info)
+  output['smc'] = np.copy(HB.noahmp.smc)
+  HB.finalize()
+  return output
+
+class Spinup(unittest.TestCase):
+
+  def setUp(self):
+    try:
+     from pyNoahMP.NoahMP import model
+    except ImportError:
+     self.skipTest('pyNoahMP is not compiled')
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def spinup(self,info):
+    import HydroBlocks
+    HB = HydroBlocks.initialize(info)
+    smc = np.copy(HB.noahmp.smc)
+    HB.run(info)
+    HB.finalize()
+    return (smc,sorted(os.listdir('%s/spinup' % self.dir)))
+
+  def test_spinup_cache(self):
+    sys.path.append('../benchmarks')
+    import benchmarks
+    idate = datetime.datetime(2004,1,1)
+    fdate = datetime.datetime(2004,1,2)
+    file = '%s/input.nc' % self.dir
+    benchmarks.Create_Synthetic_Catchment(file,50,idate,fdate,3600.0)
+    info = benchmarks.Create_Metadata(self.dir,file,'dtopmodel',False,1,3600.0,idate,fdate)
+    info['spinup'] = {'enabled':True,'max_cycles':2,'cache_dir':'%s/spinup' % self.dir,
+                      'tolerance':{'smc':1.0,'zwt':100.0,'si':100.0}}
+    #Cache miss (spin up and cache the state)
+    (smc,files) = self.spinup(info)
+    self.assertEqual(len(files),1)
+    #Cache hit (same input file and configuration)
+    (csmc,cfiles) = self.spinup(info)
+    self.assertEqual(cfiles,files)
+    self.assertTrue(np.array_equal(csmc,smc,equal_nan=True))
+    #Cache miss (new parameters, even with the same size and modification time)
+    stat = os.stat(file)
+    fp = nc.Dataset(file,'a')
+    fp.groups['parameters'].variables['SATDK'][:] = 2*fp.groups['parameters'].variables['SATDK'][:]
+    fp.close()
+    os.utime(file,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+    self.assertEqual(os.stat(file).st_size,stat.st_size)
+    (psmc,pfiles) = self.spinup(info)
+    self.assertEqual(len(pfiles),2)
+
+class Allocations(unittest.TestCase):
+
+  def setUp(self):
+    try:
+     from pyNoahMP.NoahMP import model
+    except ImportError:
+     self.skipTest('pyNoahMP is not compiled')
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_warm_time_step(self):
+    import HydroBlocks
+    sys.path.append('../benchmarks')
+    import benchmarks
+    idate = datetime.datetime(2004,1,1)
+    fdate = datetime.datetime(2004,1,2)
+    nhru = 2000
+    benchmarks.Create_Synthetic_Catchment('%s/input.nc' % self.dir,nhru,idate,fdate,3600.0)
+    info = benchmarks.Create_Metadata(self.dir,'%s/input.nc' % self.dir,'dtopmodel',False,1,3600.0,idate,fdate)
+    info['profiling'] = {'enabled':True,'allocations':True,'file':'%s/profile.json' % self.dir}
+    #The output and the forcing of the segment are written and read in one block each
+    #(the I/O is not part of the time step)
+    info['output']['buffer_size'] = 48
+    info['forcing'] = {'block_size':48}
+    HB = HydroBlocks.initialize(info)
+    HB.run(info)
+    phases = HB.profiler.summary()['phases']
+    HB.finalize()
+    #Once warmed up (the first time step), no phase of a time step allocates
+    #allocation_threshold bytes or more
+    for phase in ['update_input','water_energy_balance','noahmp.run_model','update_subsurface','update_output']:
+      self.assertEqual(phases[phase]['warm_calls'],23*phases[phase]['calls']//24)
+      self.assertEqual(phases[phase]['large_allocations'],0)
+
+if __name__ == '__main__':
+ suite = unittest.TestLoader().loadTestsFromTestCase(Richards)
+ unittest.TextTestRunner(verbosity=2).run(suite)
+ suite = unittest.TestLoader().loadTestsFromTestCase(DynamicTopmodel)
+ unittest.TextTestRunner(verbosity=2).run(suite)
+ suite = unittest.TestLoader().loadTestsFromTestCase(Forcing)
+ unittest.TextTestRunner(verbosity=2).run(suite)
+ for case in [Output,Restart,Checkpoint,Ensemble,Spinup,Allocations]:
+  suite = unittest.TestLoader().loadTestsFromTestCase(case)
+  unittest.TextTestRunner(verbosity=2).run(suite)